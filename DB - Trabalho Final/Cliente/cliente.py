@@ -8,17 +8,120 @@ import json
 import time
 import base64
 import zipfile
-import io
 import traceback
+import struct
+import collections
+import hashlib
+import queue
+import functools
+import tempfile
+import zlib
+import bisect
+import sqlite3
+import hmac
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import filedialog, messagebox, Entry, Label, Button, ttk, simpledialog
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 BUFFER_SIZE = 4096
+BUSY_MAX_RETRIES = 5
+TRANSFER_MAX_RETRIES = 5
+TRANSFER_RETRY_DELAY = 2
+UPLOAD_STATE_SUFFIX = ".upload.json"
+DOWNLOAD_STATE_SUFFIX = ".json"
+
+# Nomes descriptografados mantidos em memória e tamanho dos lotes descriptografados por vez
+# ao receber uma listagem
+FILENAME_CACHE_SIZE = 100000
+FILENAME_BATCH_SIZE = 2000
+# Listagem paginada (LIST_PAGE): a primeira página aparece logo; as seguintes são pedidas
+# quando a rolagem passa de LIST_PREFETCH_FRACTION da lista já carregada.
+LIST_PAGE_SIZE = 500
+LIST_PREFETCH_FRACTION = 0.8
+# Cache local de pastas entre sessões: um SQLite por usuário e servidor em LISTING_CACHE_DIR,
+# criptografado com uma chave derivada da chave do usuário. Gravações seguidas da mesma
+# pasta dentro de LISTING_CACHE_WRITE_DELAY segundos viram uma só.
+LISTING_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".savebox")
+LISTING_CACHE_MAX_FOLDERS = 500
+LISTING_CACHE_WRITE_DELAY = 1.0
+# Formato de arquivo criptografado em blocos (construção STREAM): cabeçalho com magic, versão,
+# tamanho do bloco e prefixo do nonce; cada bloco leva o próprio tag e o nonce
+# prefixo|índice|último. Blobs antigos (iv|dados|tag em um único GCM) continuam legíveis.
+# Na versão 2 cada bloco é comprimido antes de ser criptografado e vira um registro
+# [tamanho][dados criptografados|tag]; o cabeçalho ganha o algoritmo de compressão.
+CHUNKED_MAGIC = b'SBE'
+CHUNKED_VERSION = 1
+CHUNKED_COMPRESSED_VERSION = 2
+CHUNKED_HEADER = struct.Struct('!3sBI7s')
+COMPRESSED_HEADER = struct.Struct('!3sBI7sB')
+RECORD_LENGTH = struct.Struct('!I')
+ENCRYPTION_CHUNK_SIZE = 64 * 1024
+GCM_TAG_SIZE = 16
+LEGACY_IV_SIZE = 12
+
+# Compressão antes da criptografia (zstd quando o pacote zstandard está instalado, senão zlib)
+COMPRESSION_ENABLED = True
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESSION_MIN_SAVING = 0.05
+INCOMPRESSIBLE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp4', '.avi', '.mkv', '.mov',
+                             '.mp3', '.flac', '.ogg', '.zip', '.rar', '.gz', '.bz2', '.xz', '.7z', '.zst')
+
+# Blocos criptografados que podem ficar prontos à frente do envio no upload
+UPLOAD_PIPELINE_DEPTH = 8
+
+# Arquivos a partir deste tamanho são transferidos em intervalos por várias conexões
+PARALLEL_TRANSFER_MIN_SIZE = 64 * 1024 * 1024
+PARALLEL_TRANSFER_STREAMS = 4
+
+# Conexões de dados ociosas mantidas abertas para a próxima transferência (cada uma ocupa
+# uma vaga no servidor); são fechadas após DATA_POOL_IDLE_TIMEOUT segundos sem uso
+DATA_POOL_MAX_IDLE = 1
+DATA_POOL_IDLE_TIMEOUT = 30
+
+# Protocolo binário: magic, versão, opcode, flags, id da requisição, tamanho do payload
+FRAME_MAGIC = b'SB'
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sBBBIQ')
+META_LENGTH = struct.Struct('!I')
+FLAG_ERROR = 0x01
+FLAG_MORE = 0x02
+COMMAND_OPCODES = {
+    "AUTH": 1,
+    "REGISTER": 2,
+    "LIST": 3,
+    "CREATE_FOLDER": 4,
+    "UPLOAD": 5,
+    "DOWNLOAD": 6,
+    "DOWNLOAD_FOLDER_AS_ZIP": 7,
+    "UPLOAD_ZIP_AS_FOLDER": 8,
+    "DELETE": 9,
+    "GET_STATS": 10,
+    "UPLOAD_BEGIN": 11,
+    "UPLOAD_STATUS": 12,
+    "UPLOAD_APPEND": 13,
+    "UPLOAD_COMMIT": 14,
+    "DOWNLOAD_RANGE": 15,
+    "TRANSFER_STREAMS": 16,
+    "RESUME": 17,
+    "LIST_PAGE": 18,
+    "CHANGES_SINCE": 19,
+}
 
 
 def resource_path(relative_path):
@@ -79,53 +182,416 @@ def decrypt_filename(key: bytes, encrypted_name: str) -> str:
         return encrypted_name
 
 
+class FilenameCache:
+    # Nomes criptografados -> nomes originais da chave da sessão, com descarte LRU. Um único
+    # AESGCM é reaproveitado para todos os nomes; o formato é o mesmo de encrypt_filename
+    # (iv | tag | dados, em base64).
+    def __init__(self, key, max_entries=FILENAME_CACHE_SIZE):
+        self.aead = AESGCM(key)
+        self.max_entries = max_entries
+        self.names = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _remember(self, encrypted_name, name):
+        with self.lock:
+            self.names[encrypted_name] = name
+            self.names.move_to_end(encrypted_name)
+            if len(self.names) > self.max_entries:
+                self.names.popitem(last=False)
+
+    def encrypt(self, filename):
+        iv = os.urandom(12)
+        sealed = self.aead.encrypt(iv, filename.encode('utf-8'), None)
+        encrypted_name = base64.urlsafe_b64encode(iv + sealed[-GCM_TAG_SIZE:] + sealed[:-GCM_TAG_SIZE]).decode('utf-8')
+        self._remember(encrypted_name, filename)
+        return encrypted_name
+
+    def decrypt(self, encrypted_name):
+        with self.lock:
+            name = self.names.get(encrypted_name)
+            if name is not None:
+                self.names.move_to_end(encrypted_name)
+                return name
+
+        try:
+            encrypted_bytes_with_meta = base64.urlsafe_b64decode(encrypted_name.encode('utf-8'))
+            iv, tag, encrypted_data = encrypted_bytes_with_meta[:12], encrypted_bytes_with_meta[12:28], encrypted_bytes_with_meta[28:]
+            name = self.aead.decrypt(iv, encrypted_data + tag, None).decode('utf-8')
+        except Exception:
+            # Nomes que não são desta chave aparecem como estão, como em decrypt_filename.
+            return encrypted_name
+        self._remember(encrypted_name, name)
+        return name
+
+
+def load_upload_state(state_path, local_path, login, remote_folder):
+    # Estado de um upload interrompido; só vale para o mesmo arquivo, sem alterações, enviado
+    # pelo mesmo usuário para a mesma pasta.
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        stats = os.stat(local_path)
+    except (OSError, ValueError):
+        return None
+
+    if (state.get('source_size'), state.get('source_mtime'), state.get('login'), state.get('remote_folder')) != \
+       (stats.st_size, stats.st_mtime, login, remote_folder):
+        return None
+    return state
+
+
+def save_transfer_state(state_path, state):
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+
+def load_download_state(state_path):
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def split_ranges(total_size, count):
+    # Divide [0, total_size) em até count intervalos contíguos: [(início, tamanho), ...]
+    if total_size == 0 or count <= 1:
+        return [(0, total_size)]
+    part_size = -(-total_size // count)
+    return [(start, min(part_size, total_size - start)) for start in range(0, total_size, part_size)]
+
+
+def chunk_nonce(nonce_prefix, index, last):
+    return nonce_prefix + struct.pack('!IB', index, 1 if last else 0)
+
+
+def compress_chunk(data, compression):
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress_chunk(data, compression, max_size):
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise Exception("Arquivo comprimido com zstd: instale o pacote 'zstandard' para abri-lo.")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    raise ValueError("Algoritmo de compressão desconhecido.")
+
+
+def choose_compression(filename, sample):
+    # Formatos já comprimidos são pulados pela extensão; nos demais uma amostra do início
+    # precisa diminuir ao menos COMPRESSION_MIN_SAVING para valer a pena.
+    if not COMPRESSION_ENABLED or not sample or filename.lower().endswith(INCOMPRESSIBLE_EXTENSIONS):
+        return COMPRESSION_NONE
+    compression = COMPRESSION_ZSTD if zstandard is not None else COMPRESSION_ZLIB
+    if len(compress_chunk(sample, compression)) > len(sample) * (1 - COMPRESSION_MIN_SAVING):
+        return COMPRESSION_NONE
+    return compression
+
+
+class ChunkedEncryptor:
+    # Criptografa bloco a bloco; quem chama indica qual é o último bloco. Com o mesmo
+    # nonce_prefix cada bloco sai idêntico, então um trecho do blob pode ser regerado.
+    def __init__(self, key, chunk_size=ENCRYPTION_CHUNK_SIZE, nonce_prefix=None, compression=COMPRESSION_NONE):
+        self.aead = AESGCM(key)
+        self.nonce_prefix = nonce_prefix or os.urandom(7)
+        if compression:
+            self.header = COMPRESSED_HEADER.pack(CHUNKED_MAGIC, CHUNKED_COMPRESSED_VERSION, chunk_size, self.nonce_prefix, compression)
+        else:
+            self.header = CHUNKED_HEADER.pack(CHUNKED_MAGIC, CHUNKED_VERSION, chunk_size, self.nonce_prefix)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.index = 0
+
+    def encrypt_chunk(self, data, last):
+        if self.compression:
+            data = compress_chunk(data, self.compression)
+        encrypted_chunk = self.aead.encrypt(chunk_nonce(self.nonce_prefix, self.index, last), data, self.header)
+        self.index += 1
+        if self.compression:
+            return RECORD_LENGTH.pack(len(encrypted_chunk)) + encrypted_chunk
+        return encrypted_chunk
+
+
+class ChunkedDecryptor:
+    # Recebe o blob em pedaços de qualquer tamanho e devolve o texto claro de cada bloco
+    # assim que ele é verificado; um bloco adulterado é detectado ao chegar, sem esperar o fim.
+    # head são os primeiros bytes do blob (ao menos COMPRESSED_HEADER.size); o que passar do
+    # cabeçalho deve ser entregue depois em update().
+    def __init__(self, key, head):
+        magic, version = head[:len(CHUNKED_MAGIC)], head[len(CHUNKED_MAGIC)]
+        if magic != CHUNKED_MAGIC or version not in (CHUNKED_VERSION, CHUNKED_COMPRESSED_VERSION):
+            raise ValueError("Formato de arquivo criptografado desconhecido.")
+        if version == CHUNKED_COMPRESSED_VERSION:
+            _, _, self.chunk_size, self.nonce_prefix, self.compression = COMPRESSED_HEADER.unpack_from(head)
+            self.header = bytes(head[:COMPRESSED_HEADER.size])
+        else:
+            _, _, self.chunk_size, self.nonce_prefix = CHUNKED_HEADER.unpack_from(head)
+            self.compression = COMPRESSION_NONE
+            self.header = bytes(head[:CHUNKED_HEADER.size])
+        self.aead = AESGCM(key)
+        self.header_size = len(self.header)
+        self.buffer = bytearray()
+        self.index = 0
+        # Posição no blob logo após o último bloco já devolvido
+        self.consumed = len(self.header)
+
+    def _next_record_size(self):
+        if not self.compression:
+            return self.chunk_size + GCM_TAG_SIZE
+        if len(self.buffer) < RECORD_LENGTH.size:
+            return None
+        return RECORD_LENGTH.size + RECORD_LENGTH.unpack_from(self.buffer)[0]
+
+    def _decrypt_chunk(self, record, last):
+        encrypted_chunk = record[RECORD_LENGTH.size:] if self.compression else record
+        data = self.aead.decrypt(chunk_nonce(self.nonce_prefix, self.index, last), bytes(encrypted_chunk), self.header)
+        self.index += 1
+        if self.compression:
+            data = decompress_chunk(data, self.compression, self.chunk_size)
+        return data
+
+    def update(self, data):
+        # Um bloco só é o último se nada vier depois dele, então o bloco final fica no buffer até finalize().
+        self.buffer += data
+        output = []
+        while True:
+            record_size = self._next_record_size()
+            if record_size is None or len(self.buffer) <= record_size:
+                break
+            output.append(self._decrypt_chunk(self.buffer[:record_size], False))
+            del self.buffer[:record_size]
+            self.consumed += record_size
+        return b''.join(output)
+
+    def finalize(self):
+        return self._decrypt_chunk(self.buffer, True)
+
+
+def is_chunked_blob(header):
+    # Um blob antigo começa com um iv aleatório; a chance de imitar magic e versão é de 1 em 2^31.
+    return len(header) >= CHUNKED_HEADER.size and header[:len(CHUNKED_MAGIC)] == CHUNKED_MAGIC and \
+        header[len(CHUNKED_MAGIC)] in (CHUNKED_VERSION, CHUNKED_COMPRESSED_VERSION)
+
+
+class EncryptedLayout:
+    # Onde começa cada bloco do blob que será gerado a partir de path. Sem compressão os blocos
+    # têm tamanho fixo; com compressão o tamanho de cada registro só se sabe comprimindo, então
+    # uma primeira passada calcula as posições e o tamanho total que o upload declara de início.
+    # A mesma passada calcula o SHA-256 do arquivo (com hash_source ela é feita mesmo sem compressão).
+    def __init__(self, path, compression=COMPRESSION_NONE, chunk_size=ENCRYPTION_CHUNK_SIZE, hash_source=False):
+        self.path = path
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.plaintext_size = os.path.getsize(path)
+        self.chunk_count = max(1, -(-self.plaintext_size // chunk_size))
+        self.header_size = COMPRESSED_HEADER.size if compression else CHUNKED_HEADER.size
+
+        self.record_offsets = [self.header_size] if compression else None
+        self.source_sha256 = None
+        if compression or hash_source:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for _ in range(self.chunk_count):
+                    chunk = f.read(chunk_size)
+                    digest.update(chunk)
+                    if compression:
+                        record_size = RECORD_LENGTH.size + len(compress_chunk(chunk, compression)) + GCM_TAG_SIZE
+                        self.record_offsets.append(self.record_offsets[-1] + record_size)
+            self.source_sha256 = digest.hexdigest()
+        self.size = self.record_offset(self.chunk_count)
+
+    def record_offset(self, index):
+        if self.record_offsets:
+            return self.record_offsets[index]
+        return self.header_size + index * (self.chunk_size + GCM_TAG_SIZE) - (self.chunk_count * self.chunk_size - self.plaintext_size if index == self.chunk_count else 0)
+
+    def record_index(self, position):
+        if self.record_offsets:
+            return max(0, bisect.bisect_right(self.record_offsets, position) - 1)
+        return max(0, (position - self.header_size) // (self.chunk_size + GCM_TAG_SIZE))
+
+
+def plan_upload_layout(path):
+    with open(path, 'rb') as f:
+        sample = f.read(ENCRYPTION_CHUNK_SIZE)
+    compression = choose_compression(os.path.basename(path), sample)
+    if not compression:
+        return EncryptedLayout(path, hash_source=True)
+
+    # A amostra pode enganar: se o arquivo inteiro quase não diminuir, vai sem compressão
+    # (aproveitando o SHA-256 da passada de compressão).
+    plain_layout = EncryptedLayout(path)
+    layout = EncryptedLayout(path, compression)
+    if layout.size > plain_layout.size * (1 - COMPRESSION_MIN_SAVING):
+        plain_layout.source_sha256 = layout.source_sha256
+        return plain_layout
+    return layout
+
+
+def iter_encrypted_range(key, layout, nonce_prefix, start, end):
+    # Gera os bytes [start, end) do blob criptografado de layout.path lendo só os blocos
+    # necessários; o resultado é idêntico ao trecho correspondente do blob inteiro.
+    encryptor = ChunkedEncryptor(key, layout.chunk_size, nonce_prefix, layout.compression)
+
+    if start < layout.header_size:
+        yield encryptor.header[start:min(end, layout.header_size)]
+
+    encryptor.index = layout.record_index(start)
+    position = layout.record_offset(encryptor.index)
+    with open(layout.path, 'rb') as f:
+        f.seek(encryptor.index * layout.chunk_size)
+        while position < end and encryptor.index < layout.chunk_count:
+            expected_length = min(layout.chunk_size, layout.plaintext_size - encryptor.index * layout.chunk_size)
+            data = f.read(layout.chunk_size)
+            if len(data) != expected_length:
+                raise Exception("O arquivo foi alterado durante o upload.")
+
+            record_end = layout.record_offset(encryptor.index + 1)
+            encrypted_chunk = encryptor.encrypt_chunk(data, last=encryptor.index == layout.chunk_count - 1)
+            if position + len(encrypted_chunk) != record_end:
+                raise Exception("O arquivo foi alterado durante o upload.")
+            yield encrypted_chunk[max(start - position, 0):end - position]
+            position = record_end
+
+
+def iter_pipelined(iterable, depth=UPLOAD_PIPELINE_DEPTH):
+    # Consome iterable em outra thread, até depth itens à frente de quem lê, para que a leitura
+    # e a criptografia de um bloco se sobreponham ao envio do anterior.
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            has_item, item = items.get()
+            if not has_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 def encrypt_file(key: bytes, in_path: str, out_path: str):
-    iv = os.urandom(12)
-    encryptor = Cipher(algorithms.AES(key), modes.GCM(iv), backend=default_backend()).encryptor()
-    
+    encryptor = ChunkedEncryptor(key)
+
     with open(in_path, 'rb') as f_in, open(out_path, 'wb') as f_out:
-        f_out.write(iv)
-        
+        f_out.write(encryptor.header)
+
+        # Lê um bloco adiantado para saber qual é o último.
+        chunk = f_in.read(encryptor.chunk_size)
         while True:
-            chunk = f_in.read(BUFFER_SIZE)
-            if not chunk:
+            next_chunk = f_in.read(encryptor.chunk_size)
+            f_out.write(encryptor.encrypt_chunk(chunk, last=not next_chunk))
+            if not next_chunk:
                 break
-            encrypted_chunk = encryptor.update(chunk)
-            f_out.write(encrypted_chunk)
-            
-        f_out.write(encryptor.finalize() + encryptor.tag)
+            chunk = next_chunk
 
 
-def decrypt_file(key: bytes, in_path: str, out_path: str):
-    with open(in_path, 'rb') as f_in:
-        iv = f_in.read(12) 
-        tag = f_in.seek(-16, os.SEEK_END)
-        tag = f_in.read(16)
-        
-        f_in.seek(12)
-        encrypted_data = f_in.read(os.path.getsize(in_path) - 12 - 16)
-        
+def decrypt_stream(key, f_in, size, f_out):
+    # Descriptografa os size bytes de f_in em f_out com memória constante. No formato antigo
+    # o tag fica no fim, então f_in precisa aceitar seek() (arquivos e membros de ZIP aceitam).
+    header = f_in.read(COMPRESSED_HEADER.size)
+
+    if is_chunked_blob(header):
+        decryptor = ChunkedDecryptor(key, header)
+        f_out.write(decryptor.update(header[decryptor.header_size:]))
+        for chunk in iter(lambda: f_in.read(ENCRYPTION_CHUNK_SIZE), b''):
+            f_out.write(decryptor.update(chunk))
+        f_out.write(decryptor.finalize())
+        return
+
+    # Formato antigo: iv | dados | tag, verificado só no final.
+    iv = header[:LEGACY_IV_SIZE]
+    f_in.seek(size - GCM_TAG_SIZE)
+    tag = f_in.read(GCM_TAG_SIZE)
+    remaining = size - GCM_TAG_SIZE - LEGACY_IV_SIZE
+    f_in.seek(LEGACY_IV_SIZE)
+
     decryptor = Cipher(algorithms.AES(key), modes.GCM(iv, tag), backend=default_backend()).decryptor()
-    decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
-    
-    with open(out_path, 'wb') as f_out:
-        f_out.write(decrypted_data)
+    while remaining > 0:
+        chunk = f_in.read(min(ENCRYPTION_CHUNK_SIZE, remaining))
+        remaining -= len(chunk)
+        f_out.write(decryptor.update(chunk))
+    f_out.write(decryptor.finalize())
 
 
-def encrypt_data(key: bytes, data: bytes) -> bytes:
-    iv = os.urandom(12)
-    encryptor = Cipher(algorithms.AES(key), modes.GCM(iv), backend=default_backend()).encryptor()
-    
-    encrypted_data = encryptor.update(data) + encryptor.finalize()
-    
-    return iv + encrypted_data + encryptor.tag
+def write_atomically(out_path, write):
+    # write(f) grava em um temporário no mesmo diretório, que só substitui out_path se terminar
+    # sem erro; um destino existente nunca fica pela metade.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out_path)), prefix=os.path.basename(out_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            write(f_out)
+        os.replace(temp_path, out_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def decrypt_file(key: bytes, in_path: str, out_path: str):
+    with open(in_path, 'rb') as f_in:
+        write_atomically(out_path, lambda f_out: decrypt_stream(key, f_in, os.path.getsize(in_path), f_out))
+
+
+def encrypt_data(key: bytes, data: bytes, compression=COMPRESSION_NONE) -> bytes:
+    encryptor = ChunkedEncryptor(key, compression=compression)
+    chunk_size = encryptor.chunk_size
+    offsets = range(0, len(data), chunk_size) or [0]
+
+    encrypted_chunks = [encryptor.header]
+    for offset in offsets:
+        encrypted_chunks.append(encryptor.encrypt_chunk(data[offset:offset + chunk_size], last=offset + chunk_size >= len(data)))
+    return b''.join(encrypted_chunks)
+
+
+def encrypt_stream(key, source, destination, compression=COMPRESSION_NONE, head=b''):
+    # Mesmo formato de encrypt_data, lendo de source e gravando em destination bloco a bloco;
+    # head é o começo de source que já foi lido (a amostra usada para escolher a compressão).
+    encryptor = ChunkedEncryptor(key, compression=compression)
+    destination.write(encryptor.header)
+    chunk = head + source.read(encryptor.chunk_size - len(head))
+    while True:
+        next_chunk = source.read(encryptor.chunk_size)
+        destination.write(encryptor.encrypt_chunk(chunk, last=not next_chunk))
+        if not next_chunk:
+            return
+        chunk = next_chunk
 
 
 def decrypt_data(key: bytes, encrypted_data: bytes) -> bytes:
     try:
-        iv = encrypted_data[:12]
-        tag = encrypted_data[-16:]
-        data_to_decrypt = encrypted_data[12:-16]
+        if is_chunked_blob(encrypted_data):
+            decryptor = ChunkedDecryptor(key, encrypted_data[:COMPRESSED_HEADER.size])
+            return decryptor.update(encrypted_data[decryptor.header_size:]) + decryptor.finalize()
+
+        iv = encrypted_data[:LEGACY_IV_SIZE]
+        tag = encrypted_data[-GCM_TAG_SIZE:]
+        data_to_decrypt = encrypted_data[LEGACY_IV_SIZE:-GCM_TAG_SIZE]
         
         decryptor = Cipher(algorithms.AES(key), modes.GCM(iv, tag), backend=default_backend()).decryptor()
         
@@ -135,16 +601,330 @@ def decrypt_data(key: bytes, encrypted_data: bytes) -> bytes:
         return encrypted_data 
 
 
+class ServerBusyError(Exception):
+    def __init__(self, retry_after_ms):
+        super().__init__(f"Servidor ocupado, tente novamente em {retry_after_ms} ms.")
+        self.retry_after_ms = retry_after_ms
+
+
+class FrameResponse(collections.namedtuple('FrameResponse', 'request_id flags meta body_length')):
+    @property
+    def ok(self):
+        return not self.flags & FLAG_ERROR
+
+
+class FramedConnection:
+    # Cada requisição vai em um quadro [FRAME_HEADER][META_LENGTH][meta][corpo]. Como as
+    # respostas trazem o id da requisição, várias requisições podem ser enviadas antes
+    # de ler as respostas (pipelining). O lock serializa o uso do socket entre threads.
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.RLock()
+        self.last_request_id = 0
+
+
+    def send_request(self, command, *args, body_length=0):
+        self.last_request_id = (self.last_request_id + 1) % 2**32
+        meta = '|'.join(str(arg) for arg in args).encode('utf-8')
+        header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, COMMAND_OPCODES[command], 0,
+                                   self.last_request_id, META_LENGTH.size + len(meta) + body_length)
+        self.sock.sendall(header + META_LENGTH.pack(len(meta)) + meta)
+        return self.last_request_id
+
+
+    def send_body(self, data):
+        self.sock.sendall(data)
+
+
+    def recv_exact(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("A conexão com o servidor foi perdida.")
+            data += chunk
+        return bytes(data)
+
+
+    def read_response(self):
+        magic = self.recv_exact(len(FRAME_MAGIC))
+        if magic != FRAME_MAGIC:
+            # Antes de qualquer quadro o servidor pode recusar a conexão com BUSY|ms.
+            message = magic
+            while True:
+                chunk = self.sock.recv(BUFFER_SIZE)
+                if not chunk: break
+                message += chunk
+            parts = message.decode('utf-8', errors='replace').split('|')
+            if parts[0] == "BUSY":
+                raise ServerBusyError(int(parts[1]))
+            raise ConnectionError(f"Resposta inesperada do servidor: {parts[0]}")
+
+        _, version, _, flags, request_id, length = FRAME_HEADER.unpack(magic + self.recv_exact(FRAME_HEADER.size - len(magic)))
+        meta_length, = META_LENGTH.unpack(self.recv_exact(META_LENGTH.size))
+        meta = self.recv_exact(meta_length).decode('utf-8')
+        return FrameResponse(request_id, flags, meta, length - META_LENGTH.size - meta_length)
+
+
+    def iter_body(self, size):
+        bytes_received = 0
+        while bytes_received < size:
+            chunk = self.sock.recv(min(size - bytes_received, BUFFER_SIZE))
+            if not chunk: break
+            bytes_received += len(chunk)
+            yield chunk
+
+
+    def iter_chunked_body(self, response):
+        # Respostas com FLAG_MORE continuam nos quadros seguintes da mesma requisição.
+        while True:
+            yield from self.iter_body(response.body_length)
+            if not response.flags & FLAG_MORE:
+                return
+            response = self.read_response()
+            if not response.ok:
+                raise ConnectionError(response.meta)
+
+
+    def discard_body(self, response):
+        for _ in self.iter_body(response.body_length):
+            pass
+
+
+    def collect_responses(self, request_ids, on_progress=None):
+        # Quadros FLAG_MORE sem corpo próprio (progresso) são repassados a on_progress.
+        responses = {}
+        while len(responses) < len(request_ids):
+            response = self.read_response()
+            self.discard_body(response)
+            if response.flags & FLAG_MORE:
+                if on_progress is not None:
+                    on_progress(response)
+                continue
+            responses[response.request_id] = response
+        return [responses[request_id] for request_id in request_ids]
+
+
+    def request(self, command, *args):
+        return self.pipeline((command, *args))[0]
+
+
+    def pipeline(self, *requests):
+        with self.lock:
+            request_ids = [self.send_request(command, *args) for command, *args in requests]
+            return self.collect_responses(request_ids)
+
+
+    def close(self):
+        self.sock.close()
+
+
+class TransferProgress:
+    # Soma o progresso das conexões de uma transferência paralela para a barra de progresso.
+    def __init__(self, client, total_size, start_time, prefix):
+        self.client = client
+        self.total_size = total_size
+        self.start_time = start_time
+        self.prefix = prefix
+        self.done = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, done):
+        with self.lock:
+            self.done[key] = done
+            current = sum(self.done.values())
+        self.client._schedule_gui_update(self.client._update_progress_display, current, self.total_size, self.start_time, self.prefix)
+
+
+class ListingCache:
+    # Pastas já visitadas (itens com display_name, cursor, ordem e change_seq). Cada pasta é
+    # gravada comprimida e cifrada com AES-GCM, tendo como dado associado o identificador da
+    # pasta, um HMAC do caminho; assim o arquivo não revela a árvore nem permite trocar pastas.
+    def __init__(self, db_path, key):
+        derived = HKDF(algorithm=hashes.SHA256(), length=64, salt=None, info=b"savebox listing cache").derive(key)
+        self.aead = AESGCM(derived[:32])
+        self.index_key = derived[32:]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS folders (folder_id TEXT PRIMARY KEY, data BLOB NOT NULL, used REAL NOT NULL)")
+        self.conn.commit()
+
+    def _folder_id(self, folder):
+        return hmac.new(self.index_key, folder.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def load(self, folder):
+        with self.lock:
+            listing = self.pending.get(folder)
+        if listing is not None:
+            return listing
+
+        folder_id = self._folder_id(folder)
+        with self.db_lock:
+            if self.conn is None:
+                return None
+            row = self.conn.execute("SELECT data FROM folders WHERE folder_id = ?", (folder_id,)).fetchone()
+        if row is None:
+            return None
+        sealed = row[0]
+        try:
+            return json.loads(zlib.decompress(self.aead.decrypt(sealed[:12], sealed[12:], folder_id.encode())))
+        except Exception:
+            # Outra chave (a senha mudou) ou registro corrompido: a pasta vem do servidor.
+            return None
+
+    def store(self, folder, listing):
+        with self.lock:
+            schedule = not self.pending
+            self.pending[folder] = listing
+        if schedule:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        timer = threading.Timer(LISTING_CACHE_WRITE_DELAY, self.flush)
+        timer.daemon = True
+        timer.start()
+
+    def flush(self):
+        with self.lock:
+            pending = dict(self.pending)
+        if not pending:
+            return
+
+        rows = []
+        for folder, listing in pending.items():
+            folder_id = self._folder_id(folder)
+            nonce = os.urandom(12)
+            data = nonce + self.aead.encrypt(nonce, zlib.compress(json.dumps(listing).encode('utf-8')), folder_id.encode())
+            rows.append((folder_id, data, time.time()))
+        with self.db_lock:
+            if self.conn is not None:
+                self.conn.executemany("INSERT OR REPLACE INTO folders (folder_id, data, used) VALUES (?, ?, ?)", rows)
+                self.conn.execute("DELETE FROM folders WHERE folder_id NOT IN (SELECT folder_id FROM folders ORDER BY used DESC LIMIT ?)",
+                                  (LISTING_CACHE_MAX_FOLDERS,))
+                self.conn.commit()
+
+        # Pastas atualizadas durante a gravação continuam pendentes para a próxima.
+        with self.lock:
+            for folder, listing in pending.items():
+                if self.pending.get(folder) is listing:
+                    del self.pending[folder]
+            reschedule = bool(self.pending)
+        if reschedule:
+            self._schedule_flush()
+
+    def close(self):
+        self.flush()
+        with self.db_lock:
+            self.conn.close()
+            self.conn = None
+
+
+class TLSConnector:
+    # Abre conexões TLS com um único SSLContext e guarda a última sessão TLS de cada servidor.
+    # Novas conexões retomam essa sessão (ticket), sem o handshake completo nem a verificação
+    # do certificado.
+    def __init__(self, cafile):
+        self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+        self.context.check_hostname = False
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def connect(self, host, port):
+        with self.lock:
+            session = self.sessions.get((host, port))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        secure_sock = self.context.wrap_socket(sock, server_hostname=host, session=session)
+        secure_sock.connect((host, port))
+        return secure_sock
+
+    def save_session(self, address, secure_sock):
+        # No TLS 1.3 o ticket chega depois do handshake, junto da primeira resposta; por isso
+        # a sessão é guardada só depois de ler algo do servidor.
+        session = secure_sock.session
+        if session is not None and session.has_ticket:
+            with self.lock:
+                self.sessions[tuple(address)] = session
+
+
+class ConnectionPool:
+    # Conexões de dados já autenticadas, reaproveitadas entre transferências. Listagens e outros
+    # comandos curtos usam a conexão de controle, que fica livre durante uploads e downloads longos.
+    def __init__(self, open_connection, max_idle=DATA_POOL_MAX_IDLE, idle_timeout=DATA_POOL_IDLE_TIMEOUT):
+        self.open_connection = open_connection
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.closed = False
+        self.expiry_scheduled = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()[0]
+        return self.open_connection()
+
+    def release(self, conn):
+        with self.lock:
+            if not self.closed and len(self.idle) < self.max_idle:
+                self.idle.append((conn, time.monotonic()))
+                schedule = not self.expiry_scheduled
+                self.expiry_scheduled = True
+                if schedule:
+                    self._schedule_expiry(self.idle_timeout)
+                return
+        conn.close()
+
+    def _schedule_expiry(self, delay):
+        timer = threading.Timer(delay, self._expire_idle)
+        timer.daemon = True
+        timer.start()
+
+    def _expire_idle(self):
+        # Devolve ao servidor as vagas das conexões paradas há mais de idle_timeout segundos.
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            expired = [conn for conn, released in self.idle if released <= deadline]
+            self.idle = [(conn, released) for conn, released in self.idle if released > deadline]
+            if self.idle:
+                self._schedule_expiry(self.idle[0][1] - deadline)
+            else:
+                self.expiry_scheduled = False
+        for conn in expired:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle, self.closed = self.idle, [], True
+        for conn, _released in idle:
+            conn.close()
+
+
 class CloudClient:
     def __init__(self, root):
         self.root = root
         self.root.title("SB - SaveBox")
         self.user_salt = None
         self.encryption_key = None
-        self.sock = None
+        self.names = None
+        self.listing_cache = None
+        self.conn = None
+        self.tls = None
+        self.data_pool = None
+        self.reconnect_lock = threading.Lock()
+        self.session_token = None
         self.current_frame = None
         self.file_data = []
-        self.action_buttons = []
+        self.sort_state = ('name', False)
+        self.list_cursor = None
+        self.change_seq = None
+        self.list_generation = 0
+        self.loading_page = False
+        self.transfer_buttons = []
+        self.transfer_menu_items = []
         self.current_path = ""
         self.decrypted_path = ""
 
@@ -201,7 +981,11 @@ class CloudClient:
         self.empty_context_menu.add_command(label="Criar pasta de um .zip", command=self.upload_zip_as_folder)
         self.empty_context_menu.add_command(label="Baixar pasta atual como .zip", command=self.download_folder_as_zip)
         self.empty_context_menu.add_separator() 
-        self.empty_context_menu.add_command(label="Atualizar", command=self.refresh_files)
+        self.empty_context_menu.add_command(label="Atualizar", command=self.reload_files)
+
+        # Itens que iniciam transferências; os demais continuam disponíveis durante uma transferência
+        self.transfer_menu_items = [(self.file_context_menu, 0), (self.folder_context_menu, 0),
+                                    (self.empty_context_menu, 0), (self.empty_context_menu, 2), (self.empty_context_menu, 3)]
 
 
     def _show_context_menu(self, event):
@@ -224,7 +1008,7 @@ class CloudClient:
         if total_bytes == 0:
             percentage = 0
         else:
-            percentage = (current_bytes / total_bytes) * 100
+            percentage = min(current_bytes / total_bytes, 1) * 100
 
         self.progress_bar['value'] = percentage
         elapsed_time = time.time() - start_time
@@ -236,19 +1020,29 @@ class CloudClient:
         self.progress_label.config(text=status_text)
 
 
-    def _sort_and_display(self, sort_key, reverse_order):
+    def _sort_file_data(self):
+        # Tamanho e data já chegam ordenados do servidor (a ordenação é estável e só confirma);
+        # o nome é ordenado aqui porque o servidor só conhece os nomes criptografados.
+        sort_key, reverse_order = self.sort_state
         if sort_key == 'name':
-            self.file_data.sort(key=lambda item: item['name'].lower(), reverse=reverse_order)
+            self.file_data.sort(key=lambda item: item['display_name'].lower(), reverse=reverse_order)
         else:
             self.file_data.sort(key=lambda item: item[sort_key], reverse=reverse_order)
 
+
+    def _sort_and_display(self):
+        self._sort_file_data()
         self._populate_treeview()
 
 
     def _on_sort_select(self, event=None):
         selected_option_text = self.sort_combobox.get()
-        sort_key, reverse_order = self.sort_options[selected_option_text]
-        self._sort_and_display(sort_key, reverse_order)
+        self.sort_state = self.sort_options[selected_option_text]
+        if self.list_cursor is None:
+            # A pasta inteira já está carregada: basta reordenar.
+            self._sort_and_display()
+        else:
+            self.refresh_files()
 
 
     def _populate_treeview(self):
@@ -266,46 +1060,54 @@ class CloudClient:
             return
 
         for item in self.file_data:
-            encrypted_filename = item['name']
-            display_name = decrypt_filename(self.encryption_key, encrypted_filename)
-            item_type = item['type']
+            self._insert_tree_item(item)
 
-            if item_type == 'folder':
-                icon_to_use = self.folder_icon
+
+    def _insert_tree_item(self, item, index=tk.END):
+        encrypted_filename = item['name']
+        display_name = item['display_name']
+        item_type = item['type']
+
+        if item_type == 'folder':
+            icon_to_use = self.folder_icon
+        else:
+            if display_name.endswith('.txt'):
+                icon_to_use = self.text_icon
+            elif display_name.endswith('.pdf'):
+                icon_to_use = self.pdf_icon
+            elif display_name.endswith('.enc'):
+                icon_to_use = self.enc_icon
+            elif display_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
+                icon_to_use = self.image_icon
+            elif display_name.lower().endswith(('.mp4', '.avi', '.mkv', '.mov')):
+                icon_to_use = self.video_icon
+            elif display_name.lower().endswith(('.mp3', '.wav', '.flac')):
+                icon_to_use = self.audio_icon
+            elif display_name.lower().endswith(('.zip', '.rar', '.tar', '.gz')):
+                icon_to_use = self.zip_icon
+            elif display_name.lower().endswith(('.py', '.js', '.html', '.css', 'json', '.xml', '.java', '.c', '.cpp')):
+                icon_to_use = self.code_icon
+            elif display_name.lower().endswith(('.enc')):
+                icon_to_use = self.enc_icon
+            elif display_name.lower().endswith('.pem'):
+                icon_to_use = self.pem_icon
             else:
-                if display_name.endswith('.txt'):
-                    icon_to_use = self.text_icon
-                elif display_name.endswith('.pdf'):
-                    icon_to_use = self.pdf_icon
-                elif display_name.endswith('.enc'):
-                    icon_to_use = self.enc_icon
-                elif display_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                    icon_to_use = self.image_icon
-                elif display_name.lower().endswith(('.mp4', '.avi', '.mkv', '.mov')):
-                    icon_to_use = self.video_icon
-                elif display_name.lower().endswith(('.mp3', '.wav', '.flac')):
-                    icon_to_use = self.audio_icon
-                elif display_name.lower().endswith(('.zip', '.rar', '.tar', '.gz')):
-                    icon_to_use = self.zip_icon
-                elif display_name.lower().endswith(('.py', '.js', '.html', '.css', 'json', '.xml', '.java', '.c', '.cpp')):
-                    icon_to_use = self.code_icon
-                elif display_name.lower().endswith(('.enc')):
-                    icon_to_use = self.enc_icon
-                elif display_name.lower().endswith('.pem'):
-                    icon_to_use = self.pem_icon
-                else:
-                    icon_to_use = self.file_icon
-            
-            file_size = format_bytes(item['size']) if item_type == 'file' else ""
-            file_date_str = datetime.fromtimestamp(item['date']).strftime('%d/%m/%Y %H:%M:%S')
-            
-            tag_to_use = item_type if item_type == 'folder' else ''
-            
-            self.tree.insert('', tk.END, 
-                             text=f" {display_name}", 
-                             image=icon_to_use, 
-                             values=(file_size, file_date_str), 
-                             tags=(tag_to_use, encrypted_filename))
+                icon_to_use = self.file_icon
+        
+        if item_type == 'file':
+            file_size = format_bytes(item['size'])
+        else:
+            item_count = item.get('items', 0)
+            file_size = f"{item_count} {'item' if item_count == 1 else 'itens'}"
+        file_date_str = datetime.fromtimestamp(item['date']).strftime('%d/%m/%Y %H:%M:%S')
+        
+        tag_to_use = item_type if item_type == 'folder' else ''
+        
+        self.tree.insert('', index, iid=encrypted_filename,
+                         text=f" {display_name}", 
+                         image=icon_to_use, 
+                         values=(file_size, file_date_str), 
+                         tags=(tag_to_use, encrypted_filename))
 
 
     def _go_up_directory(self):
@@ -332,16 +1134,14 @@ class CloudClient:
 
             else:
                 self.current_path = os.path.join(self.current_path, item_name_encrypted).replace("\\", "/")
-                self.decrypted_path = os.path.join(self.decrypted_path, decrypt_filename(self.encryption_key, item_name_encrypted)).replace("\\", "/")
+                self.decrypted_path = os.path.join(self.decrypted_path, self.names.decrypt(item_name_encrypted)).replace("\\", "/")
                 self.refresh_files()
 
 
     def create_new_folder(self):
         folder_name = simpledialog.askstring("Nova Pasta", "Digite o nome da nova pasta:", parent=self.root)
         if folder_name:
-            key = self.encryption_key
-            
-            encrypted_folder_name = encrypt_filename(key, folder_name)
+            encrypted_folder_name = self.names.encrypt(folder_name)
             
             new_folder_path = os.path.join(self.current_path, encrypted_folder_name).replace("\\", "/")
             
@@ -351,87 +1151,281 @@ class CloudClient:
     def _create_folder_task(self, folder_path):
         try:
             self.update_status(f"Criando pasta '{os.path.basename(folder_path)}'...")
-            self.sock.send(f"CREATE_FOLDER|{folder_path}".encode('utf-8'))
-            response = self.sock.recv(BUFFER_SIZE).decode('utf-8').split('|')
-            if response[0] == "OK":
+            response, changes_response = self._control_pipeline(("CREATE_FOLDER", folder_path), self._changes_request())
+            if response.ok:
                 self.update_status("Pasta criada com sucesso.")
-                self.refresh_files()
+                self._apply_changes(changes_response)
             else:
-                messagebox.showerror("Erro", f"Não foi possível criar a pasta: {response[1]}")
+                messagebox.showerror("Erro", f"Não foi possível criar a pasta: {response.meta}")
         except Exception as e:
             messagebox.showerror("Erro de Rede", f"Falha ao se comunicar com o servidor: {e}")
 
 
+    def _list_request(self, cursor=''):
+        sort_key, reverse_order = self.sort_state
+        return ("LIST_PAGE", self.current_path, sort_key, int(reverse_order), LIST_PAGE_SIZE, cursor)
+
+
+    def _changes_request(self):
+        # Depois de uma alteração basta pedir o que mudou desde a última resposta; sem número de
+        # sequência (-1) o servidor responde com reset e a pasta é listada de novo.
+        return ("CHANGES_SINCE", self.change_seq if self.change_seq is not None else -1)
+
+
     def run_in_thread(self, target_func, *args, **kwargs):
         thread = threading.Thread(target=target_func, args=args, kwargs=kwargs)
         thread.daemon = True
         thread.start()
 
 
-    def _download_task(self, server_path, save_path, is_folder=False):
-        self._schedule_gui_update(self._disable_actions)
-        filesize, bytes_received = 0, 0
+    def _download_task(self, server_path, save_path, is_folder=False, expected_size=0):
+        self._schedule_gui_update(self._disable_transfer_actions)
         try:
-            command_to_send = "DOWNLOAD_FOLDER_AS_ZIP" if is_folder else "DOWNLOAD"
-            self.sock.send(f"{command_to_send}|{server_path}".encode('utf-8'))
-            
-            header = self.sock.recv(BUFFER_SIZE).decode('utf-8').split('|')
-            if header[0] != "OK":
-                self.update_status(f"Erro do servidor: {header[1]}"); return
-
-            filesize = int(header[1])
-            self.sock.send("OK".encode('utf-8'))
-            
-            start_time = time.time()
-            self._schedule_gui_update(self._update_progress_display, 0, filesize, start_time, "Baixando")
+            if is_folder:
+                self._download_folder_zip(server_path, save_path)
+            else:
+                self._download_file(server_path, save_path, expected_size)
 
-            in_memory_download = io.BytesIO()
-            while bytes_received < filesize:
-                chunk = self.sock.recv(min(filesize - bytes_received, BUFFER_SIZE))
-                if not chunk: break
-                in_memory_download.write(chunk)
-                bytes_received += len(chunk)
-                self._schedule_gui_update(self._update_progress_display, bytes_received, filesize, start_time, "Baixando")
+        except Exception as e:
+            self.update_status(f"Erro no processamento do download: {e}"); traceback.print_exc()
+        finally:
+            self._schedule_gui_update(self._enable_transfer_actions)
+            self.root.after(2000, lambda: self.progress_bar.config(value=0))
 
-            if bytes_received < filesize: self.update_status("Download falhou."); return
 
-            if is_folder:
-                self.update_status("Processando e descriptografando o .zip...")
-                in_memory_download.seek(0)
-                in_memory_final_zip = io.BytesIO()
+    def _download_file(self, server_path, save_path, expected_size=0):
+        # O conteúdo criptografado vai para <destino>.part; se a conexão cair, reconecta e pede
+        # só o que falta. Um .part deixado por uma tentativa anterior também é retomado.
+        # Arquivos grandes são baixados em intervalos, por conexões paralelas.
+        part_path = save_path + ".part"
+        state_path = part_path + DOWNLOAD_STATE_SUFFIX
+        start_time = time.time()
 
-                with zipfile.ZipFile(in_memory_download, 'r') as encrypted_zip, \
-                     zipfile.ZipFile(in_memory_final_zip, 'w', zipfile.ZIP_DEFLATED) as decrypted_zip:
-                    
-                    for item_info in encrypted_zip.infolist():
-                        encrypted_path = item_info.filename
-                        path_parts = encrypted_path.replace('\\', '/').rstrip('/').split('/')
-                        decrypted_parts = [decrypt_filename(self.encryption_key, part) for part in path_parts]
-                        decrypted_path = "/".join(decrypted_parts)
+        try:
+            state = load_download_state(state_path) if os.path.exists(part_path) else None
+            if (state and 'ranges' in state) or (state is None and expected_size >= PARALLEL_TRANSFER_MIN_SIZE):
+                state = self._with_reconnect(self._plan_ranged_download, server_path, part_path, state_path, state)
 
-                        if item_info.is_dir():
-                            decrypted_zip.writestr(decrypted_path + '/', b'')
-                        else:
-                            encrypted_content = encrypted_zip.read(item_info.filename)
-                            decrypted_content = decrypt_data(self.encryption_key, encrypted_content)
-                            decrypted_zip.writestr(decrypted_path, decrypted_content)
-                
-                self.update_status("Salvando arquivo .zip final...")
-                with open(save_path, 'wb') as f_out:
-                    f_out.write(in_memory_final_zip.getvalue())
-                self.update_status(f"Arquivo '{os.path.basename(save_path)}' salvo com sucesso!")
+            if state and 'ranges' in state:
+                self._receive_ranges(server_path, part_path, state_path, state, start_time)
             else:
-                self.update_status("Descriptografando arquivo...")
-                encrypted_content = in_memory_download.getvalue()
-                decrypted_content = decrypt_data(self.encryption_key, encrypted_content)
-                with open(save_path, 'wb') as f_out: f_out.write(decrypted_content)
-                self.update_status(f"Download de '{os.path.basename(save_path)}' concluído!")
+                state = self._with_reconnect(self._receive_file_range, server_path, part_path, state_path, start_time)
+        except (ConnectionError, OSError) as e:
+            self.update_status(f"Download interrompido: {e}. Baixe o arquivo novamente para continuar.")
+            return
 
-        except Exception as e:
-            self.update_status(f"Erro no processamento do download: {e}"); traceback.print_exc()
+        if 'header' in state:
+            os.replace(part_path, save_path)
+        else:
+            # Intervalos paralelos e blobs no formato antigo chegam criptografados.
+            self.update_status("Descriptografando arquivo...")
+            decrypt_file(self.encryption_key, part_path, save_path)
+            os.remove(part_path)
+
+        os.remove(state_path)
+        self.update_status(f"Download de '{os.path.basename(save_path)}' concluído!")
+
+
+    def _resume_point(self, part_path, state):
+        # Retorna (offset no blob, decryptor) para continuar o .part de um download sequencial.
+        if not state or not os.path.exists(part_path):
+            return 0, None
+        if 'header' not in state:
+            return os.path.getsize(part_path), None
+
+        # O .part tem o texto claro de blocos verificados; o último bloco gravado é baixado de
+        # novo, o que também cobre um download concluído que não chegou a ser renomeado.
+        header = bytes.fromhex(state['header'])
+        decryptor = ChunkedDecryptor(self.encryption_key, header)
+        if decryptor.compression:
+            # Registros comprimidos têm tamanho variável: a posição no blob só é conhecida
+            # pelo ponto de retomada salvo quando a conexão caiu.
+            if 'resume' not in state or os.path.getsize(part_path) < state['resume'][0]:
+                return 0, None
+            plaintext_length, decryptor.consumed, decryptor.index = state['resume']
+        else:
+            decryptor.index = max(0, (os.path.getsize(part_path) - 1) // decryptor.chunk_size)
+            plaintext_length = decryptor.index * decryptor.chunk_size
+            decryptor.consumed = len(header) + decryptor.index * (decryptor.chunk_size + GCM_TAG_SIZE)
+        with open(part_path, 'r+b') as f:
+            f.truncate(plaintext_length)
+        return decryptor.consumed, decryptor
+
+
+    def _receive_file_range(self, conn, server_path, part_path, state_path, start_time):
+        # Blobs no formato em blocos são descriptografados enquanto chegam: o .part só recebe texto
+        # claro já verificado. Blobs no formato antigo só podem ser verificados no fim, então
+        # nesse caso o .part guarda o conteúdo criptografado. Retorna o estado do download.
+        with conn.lock:
+            while True:
+                state = load_download_state(state_path) if os.path.exists(part_path) else None
+                offset, decryptor = self._resume_point(part_path, state)
+                conn.send_request("DOWNLOAD_RANGE", server_path, offset)
+
+                response = conn.read_response()
+                if not response.ok:
+                    raise Exception(f"Erro do servidor: {response.meta}")
+
+                total_size, mtime = response.meta.split('|')
+                current = {'login': self.username, 'server_path': server_path, 'total_size': int(total_size), 'mtime': mtime}
+                if not offset or (offset <= current['total_size'] and all(state.get(key) == value for key, value in current.items())):
+                    break
+                # O .part é de outro arquivo ou o arquivo mudou no servidor: recomeça do zero.
+                conn.discard_body(response)
+                os.remove(part_path)
+
+            if not offset:
+                state = None
+            head = b''
+            bytes_received = offset
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                try:
+                    for chunk in conn.iter_body(response.body_length):
+                        bytes_received += len(chunk)
+                        self._schedule_gui_update(self._update_progress_display, bytes_received, current['total_size'], start_time, "Baixando")
+
+                        if state is None:
+                            # Os primeiros bytes dizem o formato do blob.
+                            head += chunk
+                            if len(head) < COMPRESSED_HEADER.size and bytes_received < current['total_size']:
+                                continue
+                            state, chunk = current, head
+                            if is_chunked_blob(head):
+                                decryptor = ChunkedDecryptor(self.encryption_key, head)
+                                state['header'], chunk = decryptor.header.hex(), head[decryptor.header_size:]
+                            save_transfer_state(state_path, state)
+
+                        f.write(decryptor.update(chunk) if decryptor else chunk)
+
+                    if bytes_received < current['total_size']:
+                        raise ConnectionError("A conexão caiu durante o download.")
+                except ConnectionError:
+                    if decryptor and decryptor.compression:
+                        state['resume'] = [f.tell(), decryptor.consumed, decryptor.index]
+                        save_transfer_state(state_path, state)
+                    raise
+                if decryptor:
+                    f.write(decryptor.finalize())
+        return state
+
+
+    def _plan_ranged_download(self, conn, server_path, part_path, state_path, state):
+        # Confere o arquivo no servidor (intervalo vazio) e, se ele não mudou, mantém o
+        # progresso salvo; senão divide o arquivo entre as conexões concedidas pelo servidor.
+        response = conn.request("DOWNLOAD_RANGE", server_path, 0, 0)
+        if not response.ok:
+            raise Exception(f"Erro do servidor: {response.meta}")
+
+        total_size, mtime = response.meta.split('|')
+        current = {'login': self.username, 'server_path': server_path, 'total_size': int(total_size), 'mtime': mtime}
+        if state and all(state.get(key) == value for key, value in current.items()):
+            return state
+
+        streams = self._negotiate_streams(current['total_size'])
+        if streams == 1:
+            for path in (part_path, state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+
+        # Cada intervalo é [próximo_byte, fim); o .part é criado já com o tamanho final.
+        current['ranges'] = [[start, start + size] for start, size in split_ranges(current['total_size'], streams)]
+        with open(part_path, 'wb') as f:
+            f.truncate(current['total_size'])
+        save_transfer_state(state_path, current)
+        return current
+
+
+    def _receive_ranges(self, server_path, part_path, state_path, state, start_time):
+        # Cada conexão grava o seu intervalo na posição certa do .part; o avanço de cada
+        # intervalo fica no estado, para que uma nova tentativa peça só o que faltou.
+        ranges = state['ranges']
+        expected_meta = f"{state['total_size']}|{state['mtime']}"
+        initial_offsets = [byte_range[0] for byte_range in ranges]
+        progress = TransferProgress(self, state['total_size'], start_time, "Baixando")
+        progress.update('done', state['total_size'] - sum(end - offset for offset, end in ranges))
+
+        def receive_range(conn, index):
+            byte_range = ranges[index]
+            with conn.lock:
+                conn.send_request("DOWNLOAD_RANGE", server_path, byte_range[0], byte_range[1] - byte_range[0])
+                response = conn.read_response()
+                if not response.ok:
+                    raise Exception(f"Erro do servidor: {response.meta}")
+                if response.meta != expected_meta:
+                    conn.discard_body(response)
+                    raise Exception("O arquivo mudou no servidor durante o download.")
+
+                with open(part_path, 'r+b') as f:
+                    f.seek(byte_range[0])
+                    for chunk in conn.iter_body(response.body_length):
+                        f.write(chunk)
+                        byte_range[0] += len(chunk)
+                        progress.update(index, byte_range[0] - initial_offsets[index])
+
+            if byte_range[0] < byte_range[1]:
+                raise ConnectionError("A conexão caiu durante o download.")
+
+        pending = [index for index, (offset, end) in enumerate(ranges) if offset < end]
+        try:
+            if pending:
+                streams = min(len(pending), self._negotiate_streams(state['total_size']))
+                self._run_on_parallel_connections(receive_range, pending, streams)
         finally:
-            self._schedule_gui_update(self._enable_actions)
-            self.root.after(2000, lambda: self.progress_bar.config(value=0))
+            save_transfer_state(state_path, state)
+
+
+    def _download_folder_zip(self, server_path, save_path):
+        # O ZIP criptografado vai para um arquivo temporário e os membros são descriptografados
+        # um a um, em fluxo, direto no ZIP final (também temporário até o fim).
+        with tempfile.TemporaryFile() as encrypted_download:
+            def receive(conn):
+                # Uma nova tentativa recomeça o ZIP do início.
+                encrypted_download.seek(0)
+                encrypted_download.truncate()
+                conn.send_request("DOWNLOAD_FOLDER_AS_ZIP", server_path)
+
+                response = conn.read_response()
+                if not response.ok:
+                    return response.meta
+
+                # ZIPs de pastas chegam em partes; o primeiro quadro traz o tamanho previsto.
+                filesize, bytes_received = int(response.meta), 0
+
+                start_time = time.time()
+                self._schedule_gui_update(self._update_progress_display, 0, filesize, start_time, "Baixando")
+
+                for chunk in conn.iter_chunked_body(response):
+                    encrypted_download.write(chunk)
+                    bytes_received += len(chunk)
+                    self._schedule_gui_update(self._update_progress_display, bytes_received, filesize, start_time, "Baixando")
+                return None
+
+            error = self._with_reconnect(receive)
+            if error is not None:
+                self.update_status(f"Erro do servidor: {error}"); return
+
+            self.update_status("Processando e descriptografando o .zip...")
+            encrypted_download.seek(0)
+            with zipfile.ZipFile(encrypted_download, 'r') as encrypted_zip:
+                write_atomically(save_path, lambda f_out: self._decrypt_zip_members(encrypted_zip, f_out))
+
+        self.update_status(f"Arquivo '{os.path.basename(save_path)}' salvo com sucesso!")
+
+
+    def _decrypt_zip_members(self, encrypted_zip, f_out):
+        with zipfile.ZipFile(f_out, 'w', zipfile.ZIP_DEFLATED) as decrypted_zip:
+            for item_info in encrypted_zip.infolist():
+                encrypted_path = item_info.filename
+                path_parts = encrypted_path.replace('\\', '/').rstrip('/').split('/')
+                decrypted_parts = [self.names.decrypt(part) for part in path_parts]
+                decrypted_path = "/".join(decrypted_parts)
+
+                if item_info.is_dir():
+                    decrypted_zip.writestr(decrypted_path + '/', b'')
+                else:
+                    with encrypted_zip.open(item_info) as member_in, decrypted_zip.open(decrypted_path, 'w', force_zip64=True) as member_out:
+                        decrypt_stream(self.encryption_key, member_in, item_info.file_size, member_out)
 
 
     def download_file(self):
@@ -467,63 +1461,184 @@ class CloudClient:
         item_path_on_server = os.path.join(self.current_path, encrypted_filename).replace("\\", "/")
 
         
+        expected_size = next((item['size'] for item in self.file_data if item['name'] == encrypted_filename), 0)
         if save_path:
-            self.run_in_thread(self._download_task, item_path_on_server, save_path, is_folder=False)
+            self.run_in_thread(self._download_task, item_path_on_server, save_path, is_folder=False, expected_size=expected_size)
 
 
     def _upload_task(self, local_path, remote_path):
-        self._schedule_gui_update(self._disable_actions)
-        temp_encrypted_path = local_path + ".enc"
+        # Upload em sessão: o servidor guarda o que já recebeu, então uma queda de conexão só
+        # exige reenviar o restante. O arquivo é criptografado enquanto é enviado, sem cópia
+        # temporária; como o prefixo do nonce fica no estado, qualquer trecho do blob pode ser
+        # regerado. Se as tentativas se esgotarem, o estado fica no disco e o próximo upload do
+        # mesmo arquivo para a mesma pasta continua de onde parou.
+        self._schedule_gui_update(self._disable_transfer_actions)
+        state_path = local_path + UPLOAD_STATE_SUFFIX
+        keep_partial_upload = False
         try:
-            self.update_status("Criptografando arquivo localmente...")
-            key = self.encryption_key
-            encrypt_file(key, local_path, temp_encrypted_path)
-            
-            filesize = os.path.getsize(temp_encrypted_path)
+            state = load_upload_state(state_path, local_path, self.username, self.current_path)
+            if state and ('nonce_prefix' not in state or 'source_sha256' not in state):
+                state = None
+            if state and not all(response.ok for response in self._control_pipeline(*[("UPLOAD_STATUS", part[0]) for part in state['parts']])):
+                state = None
+
+            # Com compressão o tamanho do blob só é conhecido depois de comprimir o arquivo inteiro.
+            self.update_status("Preparando arquivo...")
+            if state:
+                # Tamanho e mtime não bastam: se o conteúdo mudou, o mesmo prefixo de nonce cifraria
+                # dados diferentes (reuso de nonce no AES-GCM). Nesse caso o upload recomeça com
+                # prefixo e sessões novos.
+                layout = EncryptedLayout(local_path, state.get('compression', COMPRESSION_NONE), hash_source=True)
+                if sum(part[2] for part in state['parts']) != layout.size or layout.source_sha256 != state['source_sha256']:
+                    state = None
+
+            if state:
+                self.update_status("Retomando upload interrompido...")
+            else:
+                layout = plan_upload_layout(local_path)
+                parts = self._begin_upload_parts(remote_path, layout.size)
+
+                stats = os.stat(local_path)
+                state = {'parts': parts, 'nonce_prefix': os.urandom(7).hex(), 'compression': layout.compression, 'remote_path': remote_path,
+                         'login': self.username, 'remote_folder': self.current_path, 'source_size': stats.st_size, 'source_mtime': stats.st_mtime,
+                         'source_sha256': layout.source_sha256}
+                save_transfer_state(state_path, state)
+
+            filesize = layout.size
+            encrypted_range = functools.partial(iter_encrypted_range, self.encryption_key, layout, bytes.fromhex(state['nonce_prefix']))
             start_time = time.time()
             self._schedule_gui_update(self._update_progress_display, 0, filesize, start_time, "Iniciando Upload")
-            
-            self.sock.send(f"UPLOAD|{remote_path}|{filesize}".encode('utf-8'))
-            if self.sock.recv(BUFFER_SIZE).decode('utf-8') != "OK":
-                self.update_status("Upload recusado pelo servidor.")
-                return
 
-            bytes_sent = 0
-            with open(temp_encrypted_path, 'rb') as f:
-                while True:
-                    chunk = f.read(BUFFER_SIZE)
-                    if not chunk: break
-                    self.sock.sendall(chunk)
-                    bytes_sent += len(chunk)
-                    self._schedule_gui_update(self._update_progress_display, bytes_sent, filesize, start_time, "Enviando")
+            try:
+                if len(state['parts']) == 1:
+                    final_response, changes_response = self._with_reconnect(self._send_upload_session, state['parts'][0][0], encrypted_range, filesize, start_time)
+                else:
+                    final_response, changes_response = self._send_upload_parts(state['parts'], encrypted_range, filesize, start_time)
+            except (ConnectionError, OSError):
+                keep_partial_upload = True
+                raise
 
-            final_response = self.sock.recv(BUFFER_SIZE).decode('utf-8').split('|')
-            if final_response[0] != "OK":
-                raise Exception(f"Erro no servidor após upload: {final_response[1] if len(final_response) > 1 else 'Resposta inválida'}")
+            if not final_response.ok:
+                raise Exception(f"Erro no servidor após upload: {final_response.meta}")
 
             self.update_status(f"Upload de '{os.path.basename(local_path)}' concluído!")
-            self.refresh_files()
+            self._apply_changes(changes_response)
 
         except Exception as e:
-            self.update_status(f"Erro no upload: {e}")
+            if keep_partial_upload:
+                self.update_status(f"Upload interrompido: {e}. Envie o arquivo novamente para continuar.")
+            else:
+                self.update_status(f"Erro no upload: {e}")
             traceback.print_exc()
 
         finally:
-            if os.path.exists(temp_encrypted_path):
-                os.remove(temp_encrypted_path)
-            self._schedule_gui_update(self._enable_actions)
+            if not keep_partial_upload and os.path.exists(state_path):
+                os.remove(state_path)
+            self._schedule_gui_update(self._enable_transfer_actions)
             self.root.after(2000, lambda: self.progress_bar.config(value=0))
 
 
+    def _begin_upload_parts(self, remote_path, filesize):
+        # Uma sessão de upload por intervalo do arquivo: [id_da_sessão, início, tamanho]
+        ranges = split_ranges(filesize, self._negotiate_streams(filesize))
+        responses = self._control_pipeline(*[("UPLOAD_BEGIN", remote_path, size) for _, size in ranges])
+        for response in responses:
+            if not response.ok:
+                raise Exception(f"Erro no servidor: {response.meta}")
+        return [[response.meta, start, size] for response, (start, size) in zip(responses, ranges)]
+
+
+    def _append_upload_part(self, conn, upload_id, encrypted_range, start, size, on_progress, digest=None):
+        # Pergunta ao servidor quantos bytes da sessão ele já tem e envia só o restante do
+        # intervalo, criptografado durante o envio. Retorna o id do UPLOAD_APPEND; quem chama
+        # lê a resposta. Com digest, o trecho que o servidor já tem é regerado só para o hash.
+        status = conn.request("UPLOAD_STATUS", upload_id)
+        if not status.ok:
+            raise Exception(f"Erro no servidor: {status.meta}")
+        offset = int(status.meta.split('|')[0])
+
+        if digest is not None and offset:
+            for chunk in iter_pipelined(encrypted_range(start, start + offset)):
+                digest.update(chunk)
+
+        append_request = conn.send_request("UPLOAD_APPEND", upload_id, offset, body_length=size - offset)
+        bytes_sent = offset
+        on_progress(bytes_sent)
+        for chunk in iter_pipelined(encrypted_range(start + offset, start + size)):
+            conn.send_body(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            bytes_sent += len(chunk)
+            on_progress(bytes_sent)
+        return append_request
+
+
+    def _send_upload_session(self, conn, upload_id, encrypted_range, filesize, start_time):
+        # Envia o restante da sessão seguido do commit e da listagem, sem esperar as respostas.
+        def on_progress(bytes_sent):
+            self._schedule_gui_update(self._update_progress_display, bytes_sent, filesize, start_time, "Enviando")
+
+        with conn.lock:
+            append_request = self._append_upload_part(conn, upload_id, encrypted_range, 0, filesize, on_progress)
+            commit_request = conn.send_request("UPLOAD_COMMIT", upload_id)
+            changes_request = conn.send_request(*self._changes_request())
+            append_response, commit_response, changes_response = conn.collect_responses([append_request, commit_request, changes_request])
+
+        if not append_response.ok:
+            # Offset fora de sincronia ou sessão ainda presa a uma conexão antiga: tenta de novo.
+            raise ConnectionError(append_response.meta)
+        return commit_response, changes_response
+
+
+    def _send_upload_parts(self, parts, encrypted_range, filesize, start_time):
+        # Cada intervalo vai por uma conexão; no commit o servidor junta as partes, na ordem,
+        # e confere o SHA-256 de cada uma.
+        progress = TransferProgress(self, filesize, start_time, "Enviando")
+        digests = {}
+
+        def send_part(conn, part):
+            upload_id, start, size = part
+            digest = hashlib.sha256()
+            with conn.lock:
+                append_request = self._append_upload_part(conn, upload_id, encrypted_range, start, size,
+                                                          lambda bytes_sent: progress.update(upload_id, bytes_sent), digest)
+                append_response, = conn.collect_responses([append_request])
+            if not append_response.ok:
+                raise ConnectionError(append_response.meta)
+            digests[upload_id] = digest.hexdigest()
+
+        streams = min(len(parts), self._negotiate_streams(filesize))
+        self._run_on_parallel_connections(send_part, parts, streams)
+
+        self.update_status("Verificando o arquivo no servidor...")
+        upload_ids = ','.join(part[0] for part in parts)
+        part_digests = ','.join(digests[part[0]] for part in parts)
+        return self._with_reconnect(lambda conn: conn.pipeline(("UPLOAD_COMMIT", upload_ids, part_digests), self._changes_request()))
+
+
+    def _negotiate_streams(self, size):
+        # O servidor decide quantas conexões paralelas aceita, de acordo com a carga.
+        if size < PARALLEL_TRANSFER_MIN_SIZE:
+            return 1
+        response, = self._control_pipeline(("TRANSFER_STREAMS", PARALLEL_TRANSFER_STREAMS))
+        return int(response.meta) if response.ok else 1
+
+
+    def _run_on_parallel_connections(self, worker, jobs, streams):
+        # Executa worker(conexão, job) para cada job em conexões de dados próprias. Se uma conexão
+        # cair ela é substituída e o job repetido; o worker deve continuar de onde parou.
+        with ThreadPoolExecutor(max_workers=streams) as executor:
+            return list(executor.map(lambda job: self._with_reconnect(worker, job), jobs))
+
+
     def upload_file(self):
         local_filepath = filedialog.askopenfilename()
         if not local_filepath:
             return
 
-        key = self.encryption_key
         original_filename = os.path.basename(local_filepath)
         
-        encrypted_filename = encrypt_filename(key, original_filename)
+        encrypted_filename = self.names.encrypt(original_filename)
         
         upload_path = os.path.join(self.current_path, encrypted_filename).replace("\\", "/")
         
@@ -534,16 +1649,14 @@ class CloudClient:
         try:
             self.update_status(f"Deletando '{os.path.basename(item_path)}'...")
             
-            self.sock.send(f"DELETE|{item_path}".encode('utf-8'))
+            response, changes_response = self._control_pipeline(("DELETE", item_path), self._changes_request())
             
-            response = self.sock.recv(BUFFER_SIZE).decode('utf-8').split('|')
-            
-            if response[0] == "OK":
+            if response.ok:
                 self.update_status("Item deletado com sucesso.")
-                self.refresh_files()
+                self._apply_changes(changes_response)
             else:
-                self.update_status(f"Erro ao deletar: {response[1]}")
-                messagebox.showerror("Erro", f"Não foi possível deletar o item: {response[1]}")
+                self.update_status(f"Erro ao deletar: {response.meta}")
+                messagebox.showerror("Erro", f"Não foi possível deletar o item: {response.meta}")
 
         except Exception as e:
             self.update_status(f"Falha na comunicação: {e}")
@@ -614,20 +1727,25 @@ class CloudClient:
 
 
     def _upload_zip_task(self, zip_filepath, root_folder_name):
-        self._schedule_gui_update(self._disable_actions)
+        self._schedule_gui_update(self._disable_transfer_actions)
         key = self.encryption_key
+        spooled_zip = None
         try:
             self.update_status("Processando .zip e criptografando conteúdo...")
             
+            # O mesmo nome vira o mesmo nome criptografado dentro deste upload (pastas repetidas
+            # nos caminhos do ZIP); o cache da sessão também aprende cada nome.
             filename_cache = {}
             
             def encrypt_filename_cached(filename):
                 if filename not in filename_cache:
-                    filename_cache[filename] = encrypt_filename(key, filename)
+                    filename_cache[filename] = self.names.encrypt(filename)
                 return filename_cache[filename]
             
-            memory_zip = io.BytesIO()
-            with zipfile.ZipFile(memory_zip, 'w', zipfile.ZIP_DEFLATED) as encrypted_zip:
+            # O ZIP criptografado vai para um arquivo temporário, membro a membro, em vez de
+            # ficar inteiro na memória.
+            spooled_zip = tempfile.TemporaryFile()
+            with zipfile.ZipFile(spooled_zip, 'w', zipfile.ZIP_STORED) as encrypted_zip:
                 with zipfile.ZipFile(zip_filepath, 'r') as original_zip:
                     
                     for item_info in original_zip.infolist():
@@ -657,104 +1775,227 @@ class CloudClient:
                             
                             encrypted_path = '/'.join(encrypted_parts)
                             
-                            file_content = original_zip.read(item_info.filename)
-                            encrypted_content = encrypt_data(key, file_content)
-                            encrypted_zip.writestr(encrypted_path, encrypted_content)
+                            with original_zip.open(item_info) as source, encrypted_zip.open(encrypted_path, 'w', force_zip64=True) as destination:
+                                sample = source.read(ENCRYPTION_CHUNK_SIZE)
+                                compression = choose_compression(path_parts[-1], sample)
+                                encrypt_stream(key, source, destination, compression, sample)
             
-            memory_zip.seek(0)
-            zip_data = memory_zip.getvalue()
-            filesize = len(zip_data)
+            filesize = spooled_zip.seek(0, os.SEEK_END)
             
             self.update_status("Enviando .zip processado para o servidor...")
             
             encrypted_root_folder_name = encrypt_filename_cached(root_folder_name)
             remote_zip_path = os.path.join(self.current_path, encrypted_root_folder_name).replace("\\", "/")
             
-            command = f"UPLOAD_ZIP_AS_FOLDER|{remote_zip_path}|{filesize}"
-            self.sock.send(command.encode('utf-8'))
-            response = self.sock.recv(BUFFER_SIZE).decode('utf-8')
-            if response != "OK":
-                self.update_status("Upload recusado pelo servidor.")
-                return
+            extraction_start = []
+
+            def on_extraction_progress(response):
+                # Quadros FLAG_MORE do servidor: "bytes_extraídos|bytes_totais"
+                extracted_bytes, total_bytes = map(int, response.meta.split('|'))
+                if not extraction_start:
+                    extraction_start.append(time.time())
+                self._schedule_gui_update(self._update_progress_display, extracted_bytes, total_bytes, extraction_start[0], "Extraindo no servidor")
+
+            def send(conn):
+                # Uma nova tentativa reenvia o ZIP inteiro.
+                spooled_zip.seek(0)
+                start_time = time.time()
+                bytes_sent = 0
+                upload_request = conn.send_request("UPLOAD_ZIP_AS_FOLDER", remote_zip_path, body_length=filesize)
+
+                while bytes_sent < filesize:
+                    chunk = spooled_zip.read(BUFFER_SIZE)
+                    conn.send_body(chunk)
+                    bytes_sent += len(chunk)
+                    self._schedule_gui_update(self._update_progress_display, bytes_sent, filesize, start_time, "Enviando")
 
-            start_time = time.time()
-            bytes_sent = 0
-            chunk_size = BUFFER_SIZE
-            
-            while bytes_sent < filesize:
-                chunk = zip_data[bytes_sent:bytes_sent + chunk_size]
-                self.sock.sendall(chunk)
-                bytes_sent += len(chunk)
-                self._schedule_gui_update(self._update_progress_display, bytes_sent, filesize, start_time, "Enviando")
+                changes_request = conn.send_request(*self._changes_request())
+                return conn.collect_responses([upload_request, changes_request], on_extraction_progress)
 
-            final_response = self.sock.recv(BUFFER_SIZE).decode('utf-8').split('|')
-            if final_response[0] != "OK":
-                raise Exception(f"Erro no servidor: {final_response[1] if len(final_response) > 1 else 'Resposta inválida'}")
+            final_response, changes_response = self._with_reconnect(send)
+
+            if not final_response.ok:
+                raise Exception(f"Erro no servidor: {final_response.meta}")
 
             self.update_status("Upload do .zip concluído!")
-            self.refresh_files()
+            self._apply_changes(changes_response)
         except Exception as e:
             self.update_status(f"Erro durante o upload do .zip: {e}")
             traceback.print_exc()
         finally:
-            self._schedule_gui_update(self._enable_actions)
+            if spooled_zip is not None:
+                spooled_zip.close()
+            self._schedule_gui_update(self._enable_transfer_actions)
             self.root.after(2000, lambda: self.progress_bar.config(value=0))
 
 
-    def _refresh_files_task(self):
+    def _refresh_files_task(self, use_cache=True):
         try:
             self._schedule_gui_update(self.path_label.config, {'text': f"Caminho: /{self.decrypted_path.replace('/', ' / ')}"})
-            
-            self.update_status("Atualizando lista de arquivos...")
-            
 
-            self.sock.send(f"LIST|{self.current_path}".encode('utf-8'))
-            
+            cached = self.listing_cache.load(self.current_path) if use_cache and self.listing_cache else None
+            if cached and (cached['cursor'] is None or tuple(cached['sort']) == self.sort_state):
+                # Pasta já visitada: aparece na hora e depois recebe só o que mudou desde então.
+                self._schedule_gui_update(self._show_listing, cached)
+                response, = self._control_pipeline(("CHANGES_SINCE", cached['seq']))
+                self._apply_changes(response)
+                return
 
-            header_bytes = self.sock.recv(10)
-            if not header_bytes:
-                raise ConnectionError("A conexão com o servidor foi perdida.")
-            
-            message_length = int(header_bytes.decode('utf-8').strip())
-
-            full_response_bytes = b''
-            bytes_received = 0
-            while bytes_received < message_length:
-                remaining = message_length - bytes_received
-                chunk = self.sock.recv(min(remaining, BUFFER_SIZE))
-                if not chunk:
-                    raise ConnectionError("A conexão foi perdida durante o recebimento da lista.")
-                full_response_bytes += chunk
-                bytes_received += len(chunk)
+            self.update_status("Atualizando lista de arquivos...")
             
-            self.file_data = json.loads(full_response_bytes.decode('utf-8'))
 
-            self._on_sort_select() 
-            self.update_status("Lista de arquivos atualizada.")
+            response, = self._control_pipeline(self._list_request())
+            self._apply_listing(response)
             
         except Exception as e:
             self.update_status(f"Erro ao obter lista de arquivos: {e}")
 
 
-    def refresh_files(self):
-        self.run_in_thread(self._refresh_files_task)
+    def _decrypt_names(self, items):
+        # Os nomes são descriptografados aqui, fora da thread do Tk, em lotes; ordenar de novo
+        # ou redesenhar a lista só lê display_name.
+        for start in range(0, len(items), FILENAME_BATCH_SIZE):
+            if len(items) > FILENAME_BATCH_SIZE:
+                self.update_status(f"Descriptografando nomes... {start}/{len(items)}")
+            for item in items[start:start + FILENAME_BATCH_SIZE]:
+                item['display_name'] = self.names.decrypt(item['name'])
+
+
+    def _apply_listing(self, response):
+        # Resposta do LIST_PAGE com a primeira página da pasta atual
+        if not response.ok:
+            self.update_status(f"Erro ao obter lista de arquivos: {response.meta}")
+            return
+
+        page = json.loads(response.meta)
+        self._decrypt_names(page['items'])
+        self._schedule_gui_update(self._show_listing, page)
+        self.update_status("Lista de arquivos atualizada.")
+
+
+    def _show_listing(self, page):
+        # Uma nova listagem invalida as páginas que ainda estavam a caminho.
+        self.list_generation += 1
+        self.loading_page = False
+        self.file_data = list(page['items'])
+        self.list_cursor = page['cursor']
+        self.change_seq = page['seq']
+        self._sort_and_display()
+        self._save_listing()
+
+
+    def _save_listing(self):
+        if self.listing_cache is None or self.change_seq is None:
+            return
+        self.listing_cache.store(self.current_path, {'items': list(self.file_data), 'cursor': self.list_cursor,
+                                                     'sort': self.sort_state, 'seq': self.change_seq})
+
+
+    def _apply_changes(self, response):
+        # Resposta do CHANGES_SINCE: só os itens alterados desde change_seq
+        if not response.ok:
+            self.update_status(f"Erro ao obter lista de arquivos: {response.meta}")
+            return
+
+        feed = json.loads(response.meta)
+        if feed['reset']:
+            response, = self._control_pipeline(self._list_request())
+            self._apply_listing(response)
+            return
+
+        self._decrypt_names([change for change in feed['changes'] if not change.get('deleted')])
+        self._schedule_gui_update(self._merge_changes, feed['seq'], feed['changes'])
+        self.update_status("Lista de arquivos atualizada.")
+
+
+    def _merge_changes(self, change_seq, changes):
+        # Cada alteração traz o estado atual do item, então aplicar a mesma duas vezes não muda
+        # nada; só respostas mais antigas que a lista exibida são ignoradas.
+        if self.change_seq is not None and change_seq < self.change_seq:
+            return
+        self.change_seq = change_seq
+
+        changed = {change['name']: change for change in changes if change['path'] == self.current_path}
+        for name in changed:
+            if self.tree.exists(name):
+                self.tree.delete(name)
+        if changed:
+            self.file_data = [item for item in self.file_data if item['name'] not in changed]
+            self._insert_sorted([change for change in changed.values() if not change.get('deleted')])
+        self._save_listing()
+
+
+    def _on_tree_scroll(self, first, last):
+        self.tree_scrollbar.set(first, last)
+        if self.list_cursor and not self.loading_page and float(last) >= LIST_PREFETCH_FRACTION:
+            self.loading_page = True
+            self.run_in_thread(self._load_next_page_task, self.list_generation, self.list_cursor)
+
+
+    def _load_next_page_task(self, generation, cursor):
+        try:
+            response, = self._control_pipeline(self._list_request(cursor))
+            if not response.ok:
+                raise Exception(response.meta)
+            page = json.loads(response.meta)
+            self._decrypt_names(page['items'])
+            self._schedule_gui_update(self._append_page, generation, page)
+        except Exception as e:
+            self.update_status(f"Erro ao carregar mais arquivos: {e}")
+            self._schedule_gui_update(self._append_page, generation, None)
+
+
+    def _insert_sorted(self, items):
+        # Cada item novo entra na posição que ocupa na lista ordenada; como as inserções seguem
+        # a ordem da lista, o índice já conta os itens anteriores.
+        new_items = {id(item) for item in items}
+        self.file_data.extend(items)
+        self._sort_file_data()
+        offset = 1 if self.current_path else 0
+        for index, item in enumerate(self.file_data):
+            if id(item) in new_items:
+                self._insert_tree_item(item, index + offset)
+
+
+    def _append_page(self, generation, page):
+        if generation != self.list_generation:
+            return
+        self.loading_page = False
+        if page is None:
+            return
+
+        # Itens que já chegaram pelo CHANGES_SINCE não entram de novo.
+        loaded = {item['name'] for item in self.file_data}
+        self.list_cursor = page['cursor']
+        self._insert_sorted([item for item in page['items'] if item['name'] not in loaded])
+        self._save_listing()
+        self.update_status(f"{len(self.file_data)} itens carregados" + ("." if self.list_cursor is None else "; role para ver mais."))
+
+
+    def refresh_files(self, use_cache=True):
+        self.run_in_thread(self._refresh_files_task, use_cache)
+
+
+    def reload_files(self):
+        # "Atualizar": ignora o cache local e lista a pasta de novo
+        self.refresh_files(use_cache=False)
 
 
     def _get_stats_task(self):
         try:
             self.update_status("Buscando estatísticas...")
-            self.sock.send("GET_STATS".encode('utf-8'))
-            response = self.sock.recv(BUFFER_SIZE).decode('utf-8').split('|')
+            response, = self._control_pipeline(("GET_STATS",))
 
-            if response[0] == "STATS":
-                up_count, down_count, up_bytes, down_bytes = response[1], response[2], format_bytes(int(response[3])), format_bytes(int(response[4]))
+            if response.ok:
+                stats = response.meta.split('|')
+                up_count, down_count, up_bytes, down_bytes = stats[0], stats[1], format_bytes(int(stats[2])), format_bytes(int(stats[3]))
                 stats_message = (f"Estatísticas de Uso - {self.username}\n\n"
                                  f"Uploads:\n  - Arquivos enviados: {up_count}\n  - Total de dados: {up_bytes}\n\n"
                                  f"Downloads:\n  - Arquivos baixados: {down_count}\n  - Total de dados: {down_bytes}")
                 messagebox.showinfo("Minhas Estatísticas", stats_message)
                 self.update_status("Estatísticas exibidas.")
             else:
-                messagebox.showerror("Erro", response[1])
+                messagebox.showerror("Erro", response.meta)
 
         except Exception as e:
             self.update_status(f"Falha na comunicação: {e}")
@@ -785,14 +2026,8 @@ class CloudClient:
             return False
 
         try:
-            cert_path = resource_path("cert.pem")
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cert_path)
-            context.check_hostname = False
-            
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            self.sock = context.wrap_socket(sock, server_hostname=host)
-            self.sock.connect((host, port))
+            self.server_address = (host, port)
+            self.conn = self._open_connection(host, port)
             return True
         
         except FileNotFoundError:
@@ -804,6 +2039,86 @@ class CloudClient:
             return False
         
 
+    def _open_connection(self, host, port):
+        if self.tls is None:
+            self.tls = TLSConnector(resource_path("cert.pem"))
+        return FramedConnection(self.tls.connect(host, port))
+
+
+    def _send_initial_command(self, conn, address, command, *args):
+        # Um servidor sobrecarregado responde BUSY|ms; reconecta após o intervalo sugerido.
+        for attempt in range(BUSY_MAX_RETRIES + 1):
+            try:
+                response = conn.request(command, *args)
+                self.tls.save_session(address, conn.sock)
+                return conn, response
+            except ServerBusyError as e:
+                conn.close()
+                if attempt == BUSY_MAX_RETRIES:
+                    raise
+                self.update_status(f"Servidor ocupado, tentando novamente em {e.retry_after_ms} ms...")
+                time.sleep(e.retry_after_ms / 1000)
+                conn = self._open_connection(*address)
+
+
+    def _open_authenticated_connection(self):
+        conn = self._open_connection(*self.server_address)
+        # Conexões extras e reconexões usam o token de sessão do login, sem a senha; cada RESUME
+        # devolve um token renovado.
+        conn, response = self._send_initial_command(conn, self.server_address, "RESUME", self.session_token)
+        if not response.ok:
+            conn.close()
+            raise ConnectionError(response.meta)
+        self.session_token = response.meta
+        return conn
+
+
+    def _control_pipeline(self, *requests):
+        # Comandos curtos vão pela conexão de controle; se ela caiu, é refeita uma vez.
+        conn = self.conn
+        try:
+            return conn.pipeline(*requests)
+        except (ConnectionError, OSError):
+            return self._reconnect(conn).pipeline(*requests)
+
+
+    def _reconnect(self, failed_conn):
+        # Substitui a conexão de controle que caiu por uma nova, já autenticada. Se outra
+        # thread já a substituiu, usa a nova.
+        with self.reconnect_lock:
+            if self.conn is failed_conn:
+                try:
+                    failed_conn.close()
+                except OSError:
+                    pass
+                self.conn = self._open_authenticated_connection()
+            return self.conn
+
+
+    def _with_reconnect(self, operation, *args):
+        # Executa operation(conexão, *args) em uma conexão de dados do pool e a repete em uma
+        # nova conexão enquanto a falha for de rede. A conexão só volta ao pool após sucesso.
+        for attempt in range(TRANSFER_MAX_RETRIES + 1):
+            conn = None
+            try:
+                conn = self.data_pool.acquire()
+                result = operation(conn, *args)
+            except (ConnectionError, OSError, ServerBusyError) as e:
+                if conn is not None:
+                    conn.close()
+                if attempt == TRANSFER_MAX_RETRIES:
+                    raise ConnectionError(str(e))
+                self.update_status(f"Conexão perdida ({e}). Tentando novamente em {TRANSFER_RETRY_DELAY} s...")
+                time.sleep(TRANSFER_RETRY_DELAY)
+                continue
+            except BaseException:
+                if conn is not None:
+                    conn.close()
+                raise
+            self.data_pool.release(conn)
+            return result
+
+
     def login(self):
         self.username = self.login_entry.get()
         password = self.password_entry.get()
@@ -814,29 +2129,66 @@ class CloudClient:
         if not self.connect_to_server():
             return
         
-        self.sock.send(f"AUTH|{self.username}|{password}".encode('utf-8'))
-        response = self.sock.recv(BUFFER_SIZE).decode('utf-8').split('|')
-        
-        if response[0] == "OK":
-            salt_hex = response[1]
+        try:
+            self.conn, response = self._send_initial_command(self.conn, self.server_address, "AUTH", self.username, password)
+        except ServerBusyError:
+            messagebox.showerror("Servidor Ocupado", "O servidor está sobrecarregado. Tente novamente mais tarde.")
+            return
+        except Exception as e:
+            messagebox.showerror("Erro de Conexão", f"Falha ao se comunicar com o servidor: {e}")
+            self.conn.close()
+            return
+
+        if response.ok:
+            salt_hex, self.session_token = response.meta.split('|')
             self.user_salt = bytes.fromhex(salt_hex)
             self.encryption_key = derive_key(password, self.user_salt)
+            self.names = FilenameCache(self.encryption_key)
+            self.listing_cache = self._open_listing_cache()
+            self.data_pool = ConnectionPool(self._open_authenticated_connection)
             self.switch_to_main_view()
         else:
-            messagebox.showerror("Falha na Autenticação", response[1])
-            self.sock.close()
+            messagebox.showerror("Falha na Autenticação", response.meta)
+            self.conn.close()
+
+
+    def _open_listing_cache(self):
+        cache_name = hashlib.sha256(f"{self.server_address[0]}:{self.server_address[1]}:{self.username}".encode('utf-8')).hexdigest()
+        try:
+            return ListingCache(os.path.join(LISTING_CACHE_DIR, cache_name + ".db"), self.encryption_key)
+        except (OSError, sqlite3.Error) as e:
+            # Sem cache local tudo continua funcionando, só sem a navegação instantânea.
+            print(f"Cache local de pastas indisponível: {e}")
+            return None
+
+
+    def _close_listing_cache(self):
+        if self.listing_cache:
+            try:
+                self.listing_cache.close()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Erro ao gravar o cache local de pastas: {e}")
+        self.listing_cache = None
 
 
     def logout(self):
-        if self.sock:
+        if self.conn:
             try:
-                self.sock.close()
+                self.conn.close()
             except Exception as e:
                 self.update_status(f"Erro ao desconectar: {e}")
+        if self.data_pool:
+            self.data_pool.close()
+        self._close_listing_cache()
         
-        self.sock = None
+        self.conn = None
+        self.data_pool = None
         self.username = ""
+        self.session_token = None
+        self.names = None
         self.file_data = []
+        self.list_cursor = None
+        self.change_seq = None
 
         self.switch_to_login_view()
 
@@ -861,29 +2213,26 @@ class CloudClient:
             messagebox.showerror("Erro de Conexão", "A porta deve ser um número válido.")
             return
         
-        temp_sock = None
+        temp_conn = None
 
         try:
-            cert_path = resource_path("cert.pem")
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cert_path)
-            context.check_hostname = False
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            temp_sock = context.wrap_socket(sock, server_hostname=host)
-            temp_sock.connect((host, port))
-            temp_sock.send(f"REGISTER|{login}|{password}".encode('utf-8'))
-            response = temp_sock.recv(BUFFER_SIZE).decode('utf-8').split('|')
-
-            if response[0] == "OK":
-                messagebox.showinfo("Sucesso", f"{response[1]}\nAgora você pode fazer o login.")
+            temp_conn = self._open_connection(host, port)
+            temp_conn, response = self._send_initial_command(temp_conn, (host, port), "REGISTER", login, password)
+
+            if response.ok:
+                messagebox.showinfo("Sucesso", f"{response.meta}\nAgora você pode fazer o login.")
             else:
-                messagebox.showerror("Erro no Registro", response[1])
+                messagebox.showerror("Erro no Registro", response.meta)
+
+        except ServerBusyError:
+            messagebox.showerror("Servidor Ocupado", "O servidor está sobrecarregado. Tente novamente mais tarde.")
 
         except Exception as e:
             messagebox.showerror("Erro no Registro", f"Não foi possível conectar: {e}")
 
         finally:
-            if temp_sock:
-                temp_sock.close()
+            if temp_conn:
+                temp_conn.close()
 
 
     def switch_to_login_view(self):
@@ -961,6 +2310,7 @@ class CloudClient:
         self.sort_combobox = ttk.Combobox(sort_frame, values=list(self.sort_options.keys()), state="readonly")
         self.sort_combobox.pack(fill='x', pady=(5,0))
         self.sort_combobox.set("Nome (A-Z)") 
+        self.sort_state = self.sort_options["Nome (A-Z)"]
         self.sort_combobox.bind("<<ComboboxSelected>>", self._on_sort_select)
 
         ttk.Separator(left_panel, orient='horizontal').pack(fill='x', pady=10, padx=5)
@@ -971,7 +2321,7 @@ class CloudClient:
         self.download_button = Button(left_panel, text="Fazer Download", command=self.download_file)
         self.download_button.pack(fill='x', padx=10, pady=5)
         
-        self.refresh_button = Button(left_panel, text="Atualizar Lista", command=self.refresh_files)
+        self.refresh_button = Button(left_panel, text="Atualizar Lista", command=self.reload_files)
         self.refresh_button.pack(fill='x', padx=10, pady=5)
 
         ttk.Separator(left_panel, orient='horizontal').pack(fill='x', pady=10, padx=5)
@@ -984,10 +2334,9 @@ class CloudClient:
         self.logout_button.pack(side=tk.BOTTOM, fill='x', padx=10, pady=10)
         
 
-        self.action_buttons = [
-            self.upload_button, self.download_button, 
-            self.refresh_button, self.stats_button, self.logout_button
-        ]
+        # Listagem, estatísticas e navegação usam a conexão de controle e seguem disponíveis
+        # durante uma transferência.
+        self.transfer_buttons = [self.upload_button, self.download_button, self.logout_button]
         
         # Parte Principal da Tela
 
@@ -998,8 +2347,8 @@ class CloudClient:
         tree_frame.pack(fill="both", expand=True, pady=5)
 
         self.tree = ttk.Treeview(tree_frame, columns=('Tamanho', 'Data de Modificação'), show='tree headings')
-        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree_scrollbar = scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self._on_tree_scroll)
         
         self.tree.bind("<Double-1>", self._on_item_double_click)
         self.tree.bind("<Button-3>", self._show_context_menu)
@@ -1022,32 +2371,27 @@ class CloudClient:
         self.refresh_files()
 
 
-    def _disable_actions(self):
-        for button in self.action_buttons:
+    def _disable_transfer_actions(self):
+        for button in self.transfer_buttons:
             button.config(state=tk.DISABLED)
 
-        for menu in [self.file_context_menu, self.folder_context_menu, self.empty_context_menu]:
-            last_index = menu.index('end')
-            if last_index is not None:
-                for i in range(last_index + 1):
-                    if menu.type(i) == 'command':
-                        menu.entryconfig(i, state=tk.DISABLED)
+        for menu, index in self.transfer_menu_items:
+            menu.entryconfig(index, state=tk.DISABLED)
 
 
-    def _enable_actions(self):
-        for button in self.action_buttons:
+    def _enable_transfer_actions(self):
+        for button in self.transfer_buttons:
             button.config(state=tk.NORMAL)
 
-        for menu in [self.file_context_menu, self.folder_context_menu, self.empty_context_menu]:
-            last_index = menu.index('end')
-            if last_index is not None:
-                for i in range(last_index + 1):
-                    if menu.type(i) == 'command':
-                        menu.entryconfig(i, state=tk.NORMAL)
+        for menu, index in self.transfer_menu_items:
+            menu.entryconfig(index, state=tk.NORMAL)
 
     def on_closing(self):
-        if self.sock:
-            self.sock.close()
+        if self.conn:
+            self.conn.close()
+        if self.data_pool:
+            self.data_pool.close()
+        self._close_listing_cache()
         self.root.destroy()
 
 
@@ -1,13 +1,26 @@
 import socket
 import threading
+import queue
+import collections
+import struct
 import os
 import sqlite3
 import hashlib
 import ssl
 import json
 import zipfile
-import io
+import tempfile
+import shutil
 import time
+import sys
+import asyncio
+import functools
+import atexit
+import hmac
+import base64
+import binascii
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 from datetime import datetime
 
 HOST = 'localhost'
@@ -15,36 +28,235 @@ PORT = 65432
 STORAGE_DIR = "storage"
 DB_DIR = "database"
 DB_FILE = "./database/database.db"
+TEMP_DIR = "tmp"
+UPLOAD_STAGING_DIR = "staging"
 BUFFER_SIZE = 4096
+WRITE_BUFFER_SIZE = 256 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+ZIP_STREAM_CHUNK_SIZE = 1024 * 1024
+ZIP_IMPORT_STEP_BYTES = 8 * 1024 * 1024
+ZIP_IMPORT_STEP_MEMBERS = 500
+ASYNC_IO_WORKERS = 32
+SSL_HANDSHAKE_TIMEOUT = 10
+
+# Controle de admissão
+MAX_SESSIONS = 64
+ASYNC_MAX_SESSIONS = 5000
+MAX_PENDING_CONNECTIONS = 128
+MAX_PENDING_WAIT = 5
+LISTEN_BACKLOG = 128
+BUSY_RETRY_MS = 500
+# Recusas são atendidas por BUSY_WORKERS threads com prazos curtos, para que um cliente lento
+# no handshake não atrase as recusas seguintes justamente quando o servidor está sobrecarregado
+BUSY_WORKERS = 4
+BUSY_HANDSHAKE_TIMEOUT = 1
+BUSY_REPLY_TIMEOUT = 0.5
+BUSY_SWEEP_INTERVAL = 0.5
+
+# Banco de dados: leituras em conexões por thread, escritas agrupadas por uma thread única
+DB_BUSY_TIMEOUT = 30
+DB_WRITE_BATCH_SIZE = 256
+DB_SCHEMA_VERSION = 5
+CONSISTENCY_CHECK_INTERVAL = 3600
+CONSISTENCY_CHECK_BATCH = 500
+
+# Layout dos blobs em storage/<login>/: "flat" (<nome>) ou "sharded" (ab/cd/<nome>).
+# Com --migrate-storage uma thread move em segundo plano os blobs que estão no outro layout.
+STORAGE_LAYOUT = "flat"
+STORAGE_SHARD_LEVELS = 2
+STORAGE_SHARD_WIDTH = 2
+STORAGE_MIGRATION_BATCH = 500
+STORAGE_MIGRATION_PAUSE = 0.05
+
+# Senhas: scrypt (log2 de N, r, p) com salt próprio, calculado em um pool de processos para que
+# uma rajada de logins não ocupe as sessões. Hashes antigos (SHA-256) são trocados no login.
+PASSWORD_KDF = "scrypt$14$8$1"
+PASSWORD_SALT_SIZE = 16
+PASSWORD_HASH_WORKERS = os.cpu_count() or 2
+
+# Tokens de sessão assinados (HMAC) emitidos no AUTH; RESUME autentica uma nova conexão com o
+# token, sem a senha. O segredo fica em disco para que os tokens sobrevivam a um reinício.
+# Cada RESUME renova o token por SESSION_TOKEN_TTL segundos, mas nunca além de
+# SESSION_MAX_AGE contados do AUTH; depois disso é preciso a senha de novo.
+SESSION_TOKEN_TTL = 30 * 60
+SESSION_MAX_AGE = 12 * 3600
+SESSION_SECRET_FILE = "./database/session_secret"
+
+# LIST_PAGE: páginas de no máximo LIST_PAGE_MAX_SIZE itens em ordem estável (coluna, id).
+# O cursor é a posição do último item enviado, então inserções e remoções não repetem nem pulam itens.
+LIST_PAGE_MAX_SIZE = 1000
+LIST_DATE_EXPRESSION = "COALESCE(mtime, (created_date - 2440587.5) * 86400)"
+LIST_SORT_COLUMNS = {'name': "logical_name", 'size': "size", 'date': LIST_DATE_EXPRESSION}
+
+# Feed de alterações: cada alteração no metadata recebe o próximo change_seq do usuário e itens
+# apagados deixam uma lápide. Com mais de CHANGES_MAX_ITEMS alterações, ou lápides já descartadas
+# (mais velhas que CHANGE_TOMBSTONE_TTL), CHANGES_SINCE pede ao cliente que liste a pasta de novo.
+CHANGES_MAX_ITEMS = 2000
+CHANGE_TOMBSTONE_TTL = 30 * 24 * 3600
+
+# Transferências paralelas: um arquivo grande pode usar até MAX_TRANSFER_STREAMS conexões;
+# conexões extras só são concedidas enquanto sobrarem TRANSFER_STREAMS_RESERVE sessões livres.
+MAX_TRANSFER_STREAMS = 8
+TRANSFER_STREAMS_RESERVE = 8
+
+# Uploads retomáveis: sessões sem atividade por UPLOAD_SESSION_TTL segundos são descartadas
+UPLOAD_SESSION_TTL = 24 * 3600
+UPLOAD_GC_INTERVAL = 600
+
+# Log de atividades: no máximo ACTIVITY_MAX_UNFLUSHED eventos ainda não gravados (0 = gravação síncrona)
+ACTIVITY_MAX_UNFLUSHED = 1000
+ACTIVITY_FLUSH_INTERVAL = 0.2
+ACTIVITY_FLUSH_BATCH = 500
+
+# Protocolo binário: magic, versão, opcode, flags, id da requisição, tamanho do payload
+FRAME_MAGIC = b'SB'
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sBBBIQ')
+META_LENGTH = struct.Struct('!I')
+MAX_META_LENGTH = 64 * 1024
+FLAG_ERROR = 0x01
+FLAG_MORE = 0x02
+OPCODES = {
+    1: "AUTH",
+    2: "REGISTER",
+    3: "LIST",
+    4: "CREATE_FOLDER",
+    5: "UPLOAD",
+    6: "DOWNLOAD",
+    7: "DOWNLOAD_FOLDER_AS_ZIP",
+    8: "UPLOAD_ZIP_AS_FOLDER",
+    9: "DELETE",
+    10: "GET_STATS",
+    11: "UPLOAD_BEGIN",
+    12: "UPLOAD_STATUS",
+    13: "UPLOAD_APPEND",
+    14: "UPLOAD_COMMIT",
+    15: "DOWNLOAD_RANGE",
+    16: "TRANSFER_STREAMS",
+    17: "RESUME",
+    18: "LIST_PAGE",
+    19: "CHANGES_SINCE",
+}
+
+# Tamanhos fixos das estruturas de um ZIP_STORED gravado em fluxo (sem seek)
+ZIP_LOCAL_HEADER_SIZE = 30
+ZIP_CENTRAL_HEADER_SIZE = 46
+ZIP_END_RECORD_SIZE = 22
+ZIP_DESCRIPTOR_SIZE = 16
+ZIP64_DESCRIPTOR_SIZE = 24
+ZIP64_EXTRA_SIZE = 20
+ZIP64_EXTRA_HEADER_SIZE = 4
+ZIP64_EXTRA_FIELD_SIZE = 8
+ZIP64_END_RECORD_SIZE = 56
+ZIP64_END_LOCATOR_SIZE = 20
 
 class DatabaseManager:
     def __init__(self, db_file):
         db_dir = os.path.dirname(db_file)
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        self.create_user_table()
-        self.create_metadata_table()
-        self.create_activity_log_table()
+        self.db_file = db_file
+        self.local = threading.local()
+        self.write_queue = queue.Queue()
 
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        self.create_user_table(conn)
+        self.create_metadata_table(conn)
+        self.create_metadata_closure_table(conn)
+        self.create_metadata_tombstones_table(conn)
+        self.create_activity_log_table(conn)
+        self.create_upload_sessions_table(conn)
+        self.migrate_schema(conn)
+        conn.close()
 
-    def create_user_table(self):
+
+    def start(self):
+        threading.Thread(target=self._writer_loop, name="savebox-db-writer", daemon=True).start()
+
+
+    def _connect(self, isolation_level=''):
+        conn = sqlite3.connect(self.db_file, timeout=DB_BUSY_TIMEOUT, isolation_level=isolation_level)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+
+    def _reader(self):
+        # Cada thread lê pela sua própria conexão; no modo WAL as leituras não esperam pelo escritor.
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+
+    def _write(self, job):
+        # Entrega job(conn) à thread escritora e espera o commit do grupo em que ele entrou.
+        future = Future()
+        self.write_queue.put((job, future))
+        return future.result()
+
+
+    def _writer_loop(self):
+        # Todas as alterações passam por aqui: os jobs que chegaram juntos são gravados em uma
+        # única transação (group commit), cada um dentro do próprio savepoint para que a falha
+        # de um não desfaça os outros.
+        conn = self._connect(isolation_level=None)
+        while True:
+            batch = [self.write_queue.get()]
+            while len(batch) < DB_WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            results = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for job, future in batch:
+                    conn.execute("SAVEPOINT job")
+                    try:
+                        results.append((future, job(conn), None))
+                        conn.execute("RELEASE job")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO job")
+                        conn.execute("RELEASE job")
+                        results.append((future, None, e))
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+    def create_user_table(self, conn):
         sql = """
         CREATE TABLE IF NOT EXISTS usuarios (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             login TEXT NOT NULL UNIQUE,
             password_hash TEXT NOT NULL,
             password_salt BLOB NOT NULL,
+            auth_salt BLOB,
+            password_kdf TEXT,
             upload_count INTEGER NOT NULL DEFAULT 0,
             download_count INTEGER NOT NULL DEFAULT 0,
             total_bytes_uploaded INTEGER NOT NULL DEFAULT 0,
-            total_bytes_downloaded INTEGER NOT NULL DEFAULT 0
+            total_bytes_downloaded INTEGER NOT NULL DEFAULT 0,
+            change_seq INTEGER NOT NULL DEFAULT 0,
+            change_floor INTEGER NOT NULL DEFAULT 0
         );
         """
-        cursor = self.conn.cursor(); cursor.execute(sql); self.conn.commit()
+        conn.execute(sql); conn.commit()
 
 
-    def create_metadata_table(self):
+    def create_metadata_table(self, conn):
         sql = """
         CREATE TABLE IF NOT EXISTS metadata (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -54,15 +266,164 @@ class DatabaseManager:
             physical_name TEXT NOT NULL,
             item_type TEXT NOT NULL,
             created_date REAL DEFAULT (julianday('now')),
+            parent_id INTEGER REFERENCES metadata(id),
+            size INTEGER NOT NULL DEFAULT 0,
+            mtime REAL,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            change_seq INTEGER NOT NULL DEFAULT 0,
             UNIQUE(user_login, parent_path_logical, logical_name)
         );
         """
-        cursor = self.conn.cursor()
-        cursor.execute(sql)
-        self.conn.commit()
+        conn.execute(sql)
+        conn.commit()
+
+
+    def create_metadata_closure_table(self, conn):
+        # Uma linha por par (ancestral, descendente), incluindo o próprio item com depth 0:
+        # as consultas de subárvore custam o tamanho da subárvore, não a árvore do usuário.
+        sql = """
+        CREATE TABLE IF NOT EXISTS metadata_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        );
+        """
+        conn.execute(sql)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_closure_descendant ON metadata_closure(descendant_id)")
+        conn.commit()
+
+
+    def create_metadata_tombstones_table(self, conn):
+        # Itens apagados, para que CHANGES_SINCE também informe as exclusões
+        sql = """
+        CREATE TABLE IF NOT EXISTS metadata_tombstones (
+            user_login TEXT NOT NULL,
+            parent_path_logical TEXT NOT NULL,
+            logical_name TEXT NOT NULL,
+            change_seq INTEGER NOT NULL,
+            deleted_at REAL NOT NULL,
+            PRIMARY KEY (user_login, parent_path_logical, logical_name)
+        );
+        """
+        conn.execute(sql)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_tombstones_seq ON metadata_tombstones(user_login, change_seq)")
+        conn.commit()
+
+
+    def migrate_schema(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self.migrate_to_folder_tree(conn)
+        if version < 2:
+            self.migrate_to_stored_stats(conn)
+        if version < 3:
+            self.migrate_to_password_kdf(conn)
+        if version < 4:
+            self.migrate_to_listing_indexes(conn)
+        if version < 5:
+            self.migrate_to_change_feed(conn)
+        conn.execute(f"PRAGMA user_version = {DB_SCHEMA_VERSION}")
+        conn.commit()
+
+
+    def migrate_to_folder_tree(self, conn):
+        # Versão 1: preenche parent_id e metadata_closure a partir de parent_path_logical. Pastas
+        # que só existiam implicitamente (ZIPs sem entradas de diretório) passam a ter linha própria.
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(metadata)")]
+        if 'parent_id' not in columns:
+            conn.execute("ALTER TABLE metadata ADD COLUMN parent_id INTEGER REFERENCES metadata(id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_parent ON metadata(parent_id)")
+
+        rows = conn.execute("SELECT id, user_login, parent_path_logical, logical_name, item_type FROM metadata").fetchall()
+        folder_ids = {(login, join_logical_path(parent, name)): item_id
+                      for item_id, login, parent, name, item_type in rows if item_type == 'folder'}
+
+        def folder_id(login, path):
+            if not path:
+                return None
+            if (login, path) not in folder_ids:
+                parent, name = split_logical_path(path)
+                parent_id = folder_id(login, parent)
+                cursor = conn.execute("INSERT INTO metadata (user_login, parent_path_logical, logical_name, physical_name, item_type, parent_id) VALUES (?, ?, ?, ?, 'folder', ?)",
+                                      (login, parent, name, hashlib.sha1(name.encode()).hexdigest() + "_folder", parent_id))
+                folder_ids[(login, path)] = cursor.lastrowid
+                parents[cursor.lastrowid] = parent_id
+            return folder_ids[(login, path)]
+
+        parents = {}
+        for item_id, login, parent, _, _ in rows:
+            parents[item_id] = folder_id(login, parent)
+        conn.executemany("UPDATE metadata SET parent_id = ? WHERE id = ?", [(parent_id, item_id) for item_id, parent_id in parents.items()])
+
+        conn.execute("DELETE FROM metadata_closure")
+        closure = []
+        for item_id in parents:
+            ancestor_id, depth = item_id, 0
+            while ancestor_id is not None:
+                closure.append((ancestor_id, item_id, depth))
+                ancestor_id, depth = parents[ancestor_id], depth + 1
+        conn.executemany("INSERT INTO metadata_closure (ancestor_id, descendant_id, depth) VALUES (?, ?, ?)", closure)
+        conn.commit()
+
+
+    def migrate_to_stored_stats(self, conn):
+        # Versão 2: tamanho, data de modificação e número de itens passam a ficar no metadata. O
+        # tamanho e a data dos arquivos já existentes são preenchidos pela verificação de consistência.
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(metadata)")]
+        for column, definition in (('size', 'INTEGER NOT NULL DEFAULT 0'), ('mtime', 'REAL'), ('item_count', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE metadata ADD COLUMN {column} {definition}")
+        conn.execute("""UPDATE metadata SET item_count = (SELECT COUNT(*) FROM metadata AS child WHERE child.parent_id = metadata.id)
+                        WHERE item_type = 'folder'""")
+        conn.commit()
+
+    
+    def migrate_to_password_kdf(self, conn):
+        # Versão 3: salt e KDF próprios da senha. password_salt continua sendo o salt da chave
+        # de criptografia do cliente; contas com password_kdf NULL ainda têm o SHA-256 antigo.
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(usuarios)")]
+        for column, definition in (('auth_salt', 'BLOB'), ('password_kdf', 'TEXT')):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE usuarios ADD COLUMN {column} {definition}")
+        conn.commit()
+
+
+    def migrate_to_listing_indexes(self, conn):
+        # Versão 4: índices para o LIST_PAGE ordenado por tamanho ou data (o nome já usa o UNIQUE).
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_list_size ON metadata(user_login, parent_path_logical, size, id)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_metadata_list_date ON metadata(user_login, parent_path_logical, {LIST_DATE_EXPRESSION}, id)")
+        conn.commit()
+
+
+    def migrate_to_change_feed(self, conn):
+        # Versão 5: contador de alterações por usuário (change_seq) e change_seq de cada item.
+        # Itens existentes ficam com 0; clientes antigos começam por uma listagem completa.
+        for table, columns in (('usuarios', ('change_seq', 'change_floor')), ('metadata', ('change_seq',))):
+            existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            for column in columns:
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metadata_change_seq ON metadata(user_login, change_seq)")
+        conn.commit()
 
     
-    def create_activity_log_table(self):
+    def create_upload_sessions_table(self, conn):
+        # Os dados parciais ficam em UPLOAD_STAGING_DIR/<upload_id>; o offset é o tamanho desse arquivo.
+        sql = """
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            upload_id TEXT PRIMARY KEY,
+            user_login TEXT NOT NULL,
+            encrypted_path TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            updated REAL NOT NULL
+        );
+        """
+        conn.execute(sql)
+        conn.commit()
+
+
+    def create_activity_log_table(self, conn):
         sql = """
         CREATE TABLE IF NOT EXISTS activity_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -72,45 +433,91 @@ class DatabaseManager:
             activity_timestamp TEXT NOT NULL -- Data e hora da transação
         );
         """
-        self.conn.execute(sql)
-        self.conn.commit()
+        conn.execute(sql)
+        conn.commit()
+
+
+    def _find_item_id(self, conn, login, full_logical_path, item_type=None):
+        if not full_logical_path:
+            return None
+        parent_path_logical, logical_name = split_logical_path(full_logical_path)
+        row = conn.execute("SELECT id, item_type FROM metadata WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?",
+                           (login, parent_path_logical, logical_name)).fetchone()
+        if not row or (item_type and row[1] != item_type):
+            return None
+        return row[0]
+
+
+    def _next_change_seq(self, conn, login):
+        # Só a thread escritora chama: os números saem na ordem dos commits.
+        conn.execute("UPDATE usuarios SET change_seq = change_seq + 1 WHERE login = ?", (login,))
+        return conn.execute("SELECT change_seq FROM usuarios WHERE login = ?", (login,)).fetchone()[0]
+
+
+    def _insert_metadata(self, conn, login, parent_path_logical, logical_name, physical_name, item_type, size=0, mtime=None, change_seq=None):
+        if mtime is None:
+            mtime = time.time()
+        if change_seq is None:
+            change_seq = self._next_change_seq(conn, login)
+        parent_id = self._find_item_id(conn, login, parent_path_logical, 'folder')
+        sql = "INSERT OR IGNORE INTO metadata (user_login, parent_path_logical, logical_name, physical_name, item_type, parent_id, size, mtime, change_seq) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        cursor = conn.execute(sql, (login, parent_path_logical, logical_name, physical_name, item_type, parent_id, size, mtime, change_seq))
+        if cursor.rowcount == 1:
+            item_id = cursor.lastrowid
+            conn.execute("""INSERT INTO metadata_closure (ancestor_id, descendant_id, depth)
+                            SELECT ancestor_id, ?, depth + 1 FROM metadata_closure WHERE descendant_id = ?
+                            UNION ALL SELECT ?, ?, 0""", (item_id, parent_id, item_id, item_id))
+            conn.execute("UPDATE metadata SET item_count = item_count + 1, change_seq = ? WHERE id = ?", (change_seq, parent_id))
+        elif item_type == 'file':
+            conn.execute("UPDATE metadata SET size = ?, mtime = ?, change_seq = ? WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?",
+                         (size, mtime, change_seq, login, parent_path_logical, logical_name))
+
 
+    def add_metadata(self, login, parent_path_logical, logical_name, physical_name, item_type, size=0, mtime=None):
+        self._write(lambda conn: self._insert_metadata(conn, login, parent_path_logical, logical_name, physical_name, item_type, size, mtime))
 
-    def add_metadata(self, login, parent_path_logical, logical_name, physical_name, item_type):
-        sql = "INSERT OR IGNORE INTO metadata (user_login, parent_path_logical, logical_name, physical_name, item_type) VALUES (?, ?, ?, ?, ?)"
-        cursor = self.conn.cursor()
-        cursor.execute(sql, (login, parent_path_logical, logical_name, physical_name, item_type))
-        self.conn.commit()
+
+    def add_metadata_batch(self, login, rows):
+        # rows: (parent_path_logical, logical_name, physical_name, item_type, size, mtime), gravadas em uma única transação;
+        # as pastas de cima entram antes para que os filhos encontrem o parent_id.
+        rows = sorted(rows, key=lambda row: row[0].count('/'))
+
+        def insert(conn):
+            change_seq = self._next_change_seq(conn, login)
+            for row in rows:
+                self._insert_metadata(conn, login, *row, change_seq=change_seq)
+
+        self._write(insert)
 
 
     def get_metadata_item(self, login, parent_path_logical, logical_name):
         sql = "SELECT physical_name, item_type FROM metadata WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?"
-        cursor = self.conn.cursor()
+        cursor = self._reader().cursor()
         cursor.execute(sql, (login, parent_path_logical, logical_name))
         return cursor.fetchone()
     
 
     def get_physicals_to_delete(self, login, full_logical_path):
-        cursor = self.conn.cursor()
+        cursor = self._reader().cursor()
         path = full_logical_path.replace('\\', '/').strip('/')
         
         parent_path = os.path.dirname(path)
         logical_name = os.path.basename(path)
         
-        sql_main = "SELECT physical_name, item_type FROM metadata WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?"
+        sql_main = "SELECT id, physical_name, item_type FROM metadata WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?"
         cursor.execute(sql_main, (login, parent_path, logical_name))
         main_item = cursor.fetchone()
 
         if not main_item:
             return None, [] 
 
-        item_type = main_item[1]
-        physicals_to_delete = [main_item[0]]
+        item_id, physical_name, item_type = main_item
+        physicals_to_delete = [physical_name]
 
         if item_type == 'folder':       
-            path_for_like = path.rstrip('/') + '/%'
-            sql_children = "SELECT physical_name FROM metadata WHERE user_login = ? AND (parent_path_logical = ? OR parent_path_logical LIKE ?)"
-            cursor.execute(sql_children, (login, path, path_for_like))
+            sql_children = """SELECT m.physical_name FROM metadata_closure c JOIN metadata m ON m.id = c.descendant_id
+                              WHERE c.ancestor_id = ? AND c.depth > 0"""
+            cursor.execute(sql_children, (item_id,))
             children_physicals = [row[0] for row in cursor.fetchall()]
             physicals_to_delete.extend(children_physicals)
 
@@ -118,101 +525,145 @@ class DatabaseManager:
 
 
     def delete_metadata_recursive(self, login, full_logical_path):
-        cursor = self.conn.cursor()
         path = full_logical_path.replace('\\', '/').strip('/')
-        
-        cursor.execute("DELETE FROM metadata WHERE user_login = ? AND parent_path_logical LIKE ?", (login, path + '/%'))
-        
-        parent_path = os.path.dirname(path)
-        logical_name = os.path.basename(path)
-        cursor.execute("DELETE FROM metadata WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?", (login, parent_path, logical_name))
-        
-        self.conn.commit()
+
+        def delete(conn):
+            item_id = self._find_item_id(conn, login, path)
+            if item_id is None:
+                return
+            change_seq = self._next_change_seq(conn, login)
+            parent_id, = conn.execute("SELECT parent_id FROM metadata WHERE id = ?", (item_id,)).fetchone()
+            conn.execute("UPDATE metadata SET item_count = item_count - 1, change_seq = ? WHERE id = ?", (change_seq, parent_id))
+            subtree = [(row[0],) for row in conn.execute("SELECT descendant_id FROM metadata_closure WHERE ancestor_id = ?", (item_id,))]
+            conn.executemany("""INSERT OR REPLACE INTO metadata_tombstones (user_login, parent_path_logical, logical_name, change_seq, deleted_at)
+                                SELECT user_login, parent_path_logical, logical_name, ?, ? FROM metadata WHERE id = ?""",
+                             [(change_seq, time.time(), descendant_id) for descendant_id, in subtree])
+            conn.executemany("DELETE FROM metadata WHERE id = ?", subtree)
+            conn.executemany("DELETE FROM metadata_closure WHERE descendant_id = ?", subtree)
+
+        self._write(delete)
 
 
     def list_path(self, login, parent_path_logical):
-        sql = "SELECT logical_name, physical_name, item_type, created_date FROM metadata WHERE user_login = ? AND parent_path_logical = ?"
-        cursor = self.conn.cursor()
+        sql = f"""SELECT logical_name, item_type, size, {LIST_DATE_EXPRESSION}, item_count
+                  FROM metadata WHERE user_login = ? AND parent_path_logical = ?"""
+        cursor = self._reader().cursor()
         cursor.execute(sql, (login, parent_path_logical))
         return cursor.fetchall()
 
 
-    def _hash_password(self, password):
-        return hashlib.sha256(password.encode('utf-8')).hexdigest()
-    
+    def get_change_seq(self, login):
+        row = self._reader().execute("SELECT change_seq FROM usuarios WHERE login = ?", (login,)).fetchone()
+        return row[0] if row else 0
+
+
+    def get_changes_since(self, login, since_seq, limit):
+        # (change_seq atual, linhas) ou (change_seq atual, None) se o cliente precisa listar de novo.
+        # Linhas: (change_seq, parent_path_logical, logical_name, item_type, size, date, item_count),
+        # com item_type NULL para itens apagados. Tudo é lido no mesmo snapshot.
+        sql = f"""SELECT change_seq, parent_path_logical, logical_name, item_type, size, {LIST_DATE_EXPRESSION}, item_count
+                  FROM metadata WHERE user_login = ? AND change_seq > ?
+                  UNION ALL
+                  SELECT change_seq, parent_path_logical, logical_name, NULL, NULL, NULL, NULL
+                  FROM metadata_tombstones WHERE user_login = ? AND change_seq > ?
+                  ORDER BY 1 LIMIT ?"""
+        conn = self._reader()
+        conn.execute("BEGIN")
+        try:
+            current_seq, change_floor = conn.execute("SELECT change_seq, change_floor FROM usuarios WHERE login = ?", (login,)).fetchone()
+            if not change_floor <= since_seq <= current_seq:
+                return current_seq, None
+            rows = conn.execute(sql, (login, since_seq, login, since_seq, limit + 1)).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        return current_seq, rows if len(rows) <= limit else None
+
+
+    def prune_tombstones(self, cutoff):
+        # Descarta lápides antigas; change_floor guarda o maior change_seq descartado de cada usuário.
+        def prune(conn):
+            floors = conn.execute("SELECT user_login, MAX(change_seq) FROM metadata_tombstones WHERE deleted_at < ? GROUP BY user_login",
+                                  (cutoff,)).fetchall()
+            conn.executemany("UPDATE usuarios SET change_floor = MAX(change_floor, ?) WHERE login = ?",
+                             [(change_floor, login) for login, change_floor in floors])
+            return conn.execute("DELETE FROM metadata_tombstones WHERE deleted_at < ?", (cutoff,)).rowcount
+
+        return self._write(prune)
+
+
+    def list_page(self, login, parent_path_logical, sort_key, descending, limit, after=None):
+        # Linhas (id, chave, logical_name, item_type, size, date, item_count) depois de after=(chave, id)
+        column = LIST_SORT_COLUMNS[sort_key]
+        direction, comparison = ("DESC", "<") if descending else ("ASC", ">")
+        sql = f"""SELECT id, {column}, logical_name, item_type, size, {LIST_DATE_EXPRESSION}, item_count
+                  FROM metadata WHERE user_login = ? AND parent_path_logical = ?"""
+        params = [login, parent_path_logical]
+        if after is not None:
+            sql += f" AND ({column} {comparison} ? OR ({column} = ? AND id {comparison} ?))"
+            params += [after[0], after[0], after[1]]
+        sql += f" ORDER BY {column} {direction}, id {direction} LIMIT ?"
+        params.append(limit)
+        cursor = self._reader().cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
 
-    def register_user(self, login, password):
-        password_hash = self._hash_password(password)
+
+    def register_user(self, login, password_hash, auth_salt, password_kdf):
         salt = os.urandom(16)
-        sql = "INSERT INTO usuarios (login, password_hash, password_salt) VALUES (?, ?, ?)"
+        sql = "INSERT INTO usuarios (login, password_hash, password_salt, auth_salt, password_kdf) VALUES (?, ?, ?, ?, ?)"
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(sql, (login, password_hash, salt))
-            self.conn.commit()
+            self._write(lambda conn: conn.execute(sql, (login, password_hash, salt, auth_salt, password_kdf)))
             return True
         except sqlite3.IntegrityError:
             return False
     
     
-    def get_user_salt(self, login):
-        sql = "SELECT password_salt FROM usuarios WHERE login = ?"
-        cursor = self.conn.cursor()
+    def get_password_record(self, login):
+        # (password_hash, auth_salt, password_kdf, password_salt) ou None se o usuário não existe
+        sql = "SELECT password_hash, auth_salt, password_kdf, password_salt FROM usuarios WHERE login = ?"
+        cursor = self._reader().cursor()
         cursor.execute(sql, (login,))
-        result = cursor.fetchone()
-        if result:
-            return result[0]
-        else:
-            return None
+        return cursor.fetchone()
 
 
-    def check_credentials(self, login, password):
-        password_hash = self._hash_password(password)
-        sql = "SELECT id FROM usuarios WHERE login = ? AND password_hash = ?"
-        cursor = self.conn.cursor()
-        cursor.execute(sql, (login, password_hash))
-        return cursor.fetchone() is not None
+    def set_password_hash(self, login, password_hash, auth_salt, password_kdf):
+        sql = "UPDATE usuarios SET password_hash = ?, auth_salt = ?, password_kdf = ? WHERE login = ?"
+        self._write(lambda conn: conn.execute(sql, (password_hash, auth_salt, password_kdf, login)))
     
     
-    def log_upload(self, login, filesize):
-        update_sql = "UPDATE usuarios SET upload_count = upload_count + 1, total_bytes_uploaded = total_bytes_uploaded + ? WHERE login = ?"
-        self.conn.execute(update_sql, (filesize, login))
-        
+    def log_activity_batch(self, events):
+        # events: (login, 'UPLOAD' ou 'DOWNLOAD', tamanho, timestamp), gravados em um único job
+        upload_sql = "UPDATE usuarios SET upload_count = upload_count + ?, total_bytes_uploaded = total_bytes_uploaded + ? WHERE login = ?"
+        download_sql = "UPDATE usuarios SET download_count = download_count + ?, total_bytes_downloaded = total_bytes_downloaded + ? WHERE login = ?"
         insert_sql = """
         INSERT INTO activity_log (user_login, activity_type, file_size_bytes, activity_timestamp)
         VALUES (?, ?, ?, ?)
         """
-        timestamp = datetime.now().isoformat()
-        self.conn.execute(insert_sql, (login, 'UPLOAD', filesize, timestamp))
-        
-        self.conn.commit()
 
-    
-    def log_download(self, login, filesize):
-        update_sql = "UPDATE usuarios SET download_count = download_count + 1, total_bytes_downloaded = total_bytes_downloaded + ? WHERE login = ?"
-        self.conn.execute(update_sql, (filesize, login))
-        
-        insert_sql = """
-        INSERT INTO activity_log (user_login, activity_type, file_size_bytes, activity_timestamp)
-        VALUES (?, ?, ?, ?)
-        """
-        timestamp = datetime.now().isoformat()
-        self.conn.execute(insert_sql, (login, 'DOWNLOAD', filesize, timestamp))
-        
-        self.conn.commit()
+        totals = {}
+        for login, activity_type, filesize, _ in events:
+            count, total_bytes = totals.get((login, activity_type), (0, 0))
+            totals[(login, activity_type)] = (count + 1, total_bytes + filesize)
+
+        def log(conn):
+            for (login, activity_type), (count, total_bytes) in totals.items():
+                update_sql = upload_sql if activity_type == 'UPLOAD' else download_sql
+                conn.execute(update_sql, (count, total_bytes, login))
+            conn.executemany(insert_sql, events)
+
+        self._write(log)
 
     
     def get_user_stats(self, login):
         sql = "SELECT upload_count, download_count, total_bytes_uploaded, total_bytes_downloaded FROM usuarios WHERE login = ?"
-        cursor = self.conn.cursor()
+        cursor = self._reader().cursor()
         cursor.execute(sql, (login,))
         return cursor.fetchone()
 
 
     def update_modification_date(self, login, parent_path_logical, logical_name):
-        sql = "UPDATE metadata SET created_date = julianday('now') WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?"
-        cursor = self.conn.cursor()
-        cursor.execute(sql, (login, parent_path_logical, logical_name))
-        self.conn.commit()
+        sql = "UPDATE metadata SET created_date = julianday('now'), mtime = ?, change_seq = ? WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?"
+        self._write(lambda conn: conn.execute(sql, (time.time(), self._next_change_seq(conn, login), login, parent_path_logical, logical_name)))
     
 
     def update_parent_folders_dates(self, login, child_path_logical):
@@ -223,6 +674,7 @@ class DatabaseManager:
             
         path_parts = path.split('/')
         
+        folders = []
         current_path = ""
         for i, part in enumerate(path_parts[:-1]):
             if i == 0:
@@ -232,16 +684,75 @@ class DatabaseManager:
                 parent_path = current_path
                 logical_name = part
             
-            self.update_modification_date(login, parent_path, logical_name)
+            folders.append((login, parent_path, logical_name))
             
             if current_path:
                 current_path += "/" + part
             else:
                 current_path = part
 
+        if folders:
+            sql = "UPDATE metadata SET created_date = julianday('now'), mtime = ?, change_seq = ? WHERE user_login = ? AND parent_path_logical = ? AND logical_name = ?"
+            now = time.time()
+
+            def update(conn):
+                change_seq = self._next_change_seq(conn, login)
+                conn.executemany(sql, [(now, change_seq, *folder) for folder in folders])
+
+            self._write(update)
+
+
+    def create_upload_session(self, upload_id, login, encrypted_path, total_size):
+        sql = "INSERT INTO upload_sessions (upload_id, user_login, encrypted_path, total_size, updated) VALUES (?, ?, ?, ?, ?)"
+        self._write(lambda conn: conn.execute(sql, (upload_id, login, encrypted_path, total_size, time.time())))
+
+
+    def get_upload_session(self, upload_id):
+        sql = "SELECT user_login, encrypted_path, total_size FROM upload_sessions WHERE upload_id = ?"
+        cursor = self._reader().cursor()
+        cursor.execute(sql, (upload_id,))
+        return cursor.fetchone()
+
+
+    def touch_upload_session(self, upload_id):
+        sql = "UPDATE upload_sessions SET updated = ? WHERE upload_id = ?"
+        self._write(lambda conn: conn.execute(sql, (time.time(), upload_id)))
+
+
+    def delete_upload_sessions(self, upload_ids):
+        sql = "DELETE FROM upload_sessions WHERE upload_id = ?"
+        self._write(lambda conn: conn.executemany(sql, [(upload_id,) for upload_id in upload_ids]))
+
+
+    def get_upload_sessions_before(self, cutoff):
+        cursor = self._reader().cursor()
+        cursor.execute("SELECT upload_id FROM upload_sessions WHERE updated < ?", (cutoff,))
+        return [row[0] for row in cursor.fetchall()]
+
+
+    def get_file_stats_page(self, after_id, limit):
+        sql = """SELECT id, user_login, physical_name, size, mtime FROM metadata
+                 WHERE item_type = 'file' AND id > ? ORDER BY id LIMIT ?"""
+        cursor = self._reader().cursor()
+        cursor.execute(sql, (after_id, limit))
+        return cursor.fetchall()
+
+
+    def update_file_stats(self, updates):
+        # updates: (size, mtime, id, login)
+        sql = "UPDATE metadata SET size = ?, mtime = ?, change_seq = ? WHERE id = ?"
+
+        def update(conn):
+            change_seqs = {}
+            for login in {update[3] for update in updates}:
+                change_seqs[login] = self._next_change_seq(conn, login)
+            conn.executemany(sql, [(size, mtime, change_seqs[login], item_id) for size, mtime, item_id, login in updates])
+
+        self._write(update)
+
 
     def get_all_files_in_folder_recursive(self, login, folder_path_logical):
-        cursor = self.conn.cursor()
+        cursor = self._reader().cursor()
         
         folder_path = folder_path_logical.replace('\\', '/').strip('/')
         
@@ -249,18 +760,17 @@ class DatabaseManager:
             sql = "SELECT parent_path_logical, logical_name, physical_name FROM metadata WHERE user_login = ? AND item_type = 'file'"
             cursor.execute(sql, (login,))
         else:
-            like_pattern = folder_path + '/%'
-            sql = """SELECT parent_path_logical, logical_name, physical_name 
-                     FROM metadata 
-                     WHERE user_login = ? AND item_type = 'file' 
-                     AND (parent_path_logical = ? OR parent_path_logical LIKE ?)"""
-            cursor.execute(sql, (login, folder_path, like_pattern))
+            folder_id = self._find_item_id(cursor.connection, login, folder_path, 'folder')
+            sql = """SELECT m.parent_path_logical, m.logical_name, m.physical_name
+                     FROM metadata_closure c JOIN metadata m ON m.id = c.descendant_id
+                     WHERE c.ancestor_id = ? AND c.depth > 0 AND m.item_type = 'file'"""
+            cursor.execute(sql, (folder_id,))
         
         return cursor.fetchall()
 
 
     def get_all_folders_in_folder_recursive(self, login, folder_path_logical):
-        cursor = self.conn.cursor()
+        cursor = self._reader().cursor()
         
         folder_path = folder_path_logical.replace('\\', '/').strip('/')
         
@@ -268,26 +778,186 @@ class DatabaseManager:
             sql = "SELECT parent_path_logical, logical_name FROM metadata WHERE user_login = ? AND item_type = 'folder'"
             cursor.execute(sql, (login,))
         else:
-            like_pattern = folder_path + '/%'
-            sql = """SELECT parent_path_logical, logical_name 
-                     FROM metadata 
-                     WHERE user_login = ? AND item_type = 'folder' 
-                     AND (parent_path_logical = ? OR parent_path_logical LIKE ?)"""
-            cursor.execute(sql, (login, folder_path, like_pattern))
+            folder_id = self._find_item_id(cursor.connection, login, folder_path, 'folder')
+            sql = """SELECT m.parent_path_logical, m.logical_name
+                     FROM metadata_closure c JOIN metadata m ON m.id = c.descendant_id
+                     WHERE c.ancestor_id = ? AND c.depth > 0 AND m.item_type = 'folder'"""
+            cursor.execute(sql, (folder_id,))
         
         return cursor.fetchall()
 
-def get_safe_path(base_dir, client_path):
+def storage_relative_path(physical_name, layout):
+    shard_chars = STORAGE_SHARD_LEVELS * STORAGE_SHARD_WIDTH
+    if layout != 'sharded' or len(physical_name) < shard_chars or '/' in physical_name or '\\' in physical_name:
+        return physical_name
+    shards = [physical_name[i:i + STORAGE_SHARD_WIDTH] for i in range(0, shard_chars, STORAGE_SHARD_WIDTH)]
+    return os.path.join(*shards, physical_name)
+
+
+def get_safe_path(base_dir, client_path, for_write=False):
+    # Escritas vão sempre para STORAGE_LAYOUT; leituras procuram primeiro nele e depois no
+    # outro layout, para que blobs ainda não migrados continuem acessíveis.
     client_path = client_path.lstrip('/\\')
-    full_path = os.path.join(base_dir, client_path)
-    real_path = os.path.abspath(full_path)
-    if os.path.commonprefix([real_path, os.path.abspath(base_dir)]) != os.path.abspath(base_dir):
-        return None
-        
-    return real_path
+    layouts = [STORAGE_LAYOUT] if for_write else [STORAGE_LAYOUT, 'flat' if STORAGE_LAYOUT == 'sharded' else 'sharded']
+
+    candidates = []
+    for layout in layouts:
+        full_path = os.path.join(base_dir, storage_relative_path(client_path, layout))
+        real_path = os.path.abspath(full_path)
+        if os.path.commonprefix([real_path, os.path.abspath(base_dir)]) != os.path.abspath(base_dir):
+            return None
+        candidates.append(real_path)
+
+    if for_write:
+        return candidates[0]
+    for real_path in candidates:
+        if os.path.exists(real_path):
+            return real_path
+    return candidates[0]
+
+
+def make_blob_dir(full_physical_path):
+    # O diretório do shard só é criado na hora de gravar o blob, não ao resolver o caminho.
+    os.makedirs(os.path.dirname(full_physical_path), exist_ok=True)
+
+
+blob_locks = collections.defaultdict(threading.Lock)
+blob_locks_lock = threading.Lock()
+
+
+def user_blob_lock(login):
+    # Serializa, por usuário, a migração de cada blob com a remoção feita por um DELETE: sem
+    # isso um DELETE entre o link e a remoção da cópia antiga deixaria um blob órfão.
+    with blob_locks_lock:
+        return blob_locks[login]
+
+
+def split_logical_path(relative_path):
+    parent_path_logical = os.path.dirname(relative_path).replace('\\', '/')
+    logical_name = os.path.basename(relative_path)
+    return parent_path_logical, logical_name
+
+
+def join_logical_path(parent_path_logical, logical_name):
+    return parent_path_logical + '/' + logical_name if parent_path_logical else logical_name
+
+
+class ActivityLogger:
+    # Tira o registro de uploads/downloads do caminho da resposta: os eventos vão para uma fila
+    # e uma thread os grava em lotes a cada ACTIVITY_FLUSH_INTERVAL segundos ou ACTIVITY_FLUSH_BATCH
+    # eventos. Uma queda perde no máximo max_unflushed eventos; ao atingir esse limite, record()
+    # espera o próximo lote ser gravado.
+    def __init__(self, db, max_unflushed, flush_interval, flush_batch):
+        self.db = db
+        self.max_unflushed = max_unflushed
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.events = queue.Queue()
+        if max_unflushed > 0:
+            self.unflushed_slots = threading.BoundedSemaphore(max_unflushed)
+
+    def start(self):
+        if self.max_unflushed > 0:
+            threading.Thread(target=self._flusher_loop, name="savebox-activity-log", daemon=True).start()
+            atexit.register(self.flush)
+
+    def record(self, login, activity_type, filesize):
+        event = (login, activity_type, filesize, datetime.now().isoformat())
+        if self.max_unflushed == 0:
+            self.db.log_activity_batch([event])
+            return
+        self.unflushed_slots.acquire()
+        self.events.put(event)
+
+    def flush(self):
+        # Espera a gravação de todos os eventos registrados até agora.
+        if self.max_unflushed == 0:
+            return
+        marker = Future()
+        self.events.put(marker)
+        marker.result()
+
+    def _flusher_loop(self):
+        while True:
+            batch, markers = [], []
+            item = self.events.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, Future):
+                    markers.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.flush_batch:
+                    break
+                try:
+                    item = self.events.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self.db.log_activity_batch(batch)
+                except Exception as e:
+                    print(f"[ERRO] Falha ao gravar {len(batch)} evento(s) do log de atividades: {e}")
+                for _ in batch:
+                    self.unflushed_slots.release()
+
+            for marker in markers:
+                marker.set_result(None)
 
 
 db_manager = DatabaseManager(DB_FILE)
+activity_logger = ActivityLogger(db_manager, ACTIVITY_MAX_UNFLUSHED, ACTIVITY_FLUSH_INTERVAL, ACTIVITY_FLUSH_BATCH)
+blocking_executor = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix="savebox-io")
+
+
+def watch_server_process(server_pid):
+    # Os processos do pool de senhas terminam junto com o servidor, mesmo se ele for morto por um sinal.
+    def watch():
+        while os.getppid() == server_pid:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def create_password_executor():
+    # Processos criados por fork não reimportam este módulo (que abre o banco ao ser importado);
+    # sem fork ficam threads, o que ainda funciona porque hashlib.scrypt libera o GIL.
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=watch_server_process, initargs=(os.getpid(),))
+    return ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="savebox-kdf")
+
+
+def start_password_workers():
+    # Com fork todos os processos nascem no primeiro submit e herdam os descritores e o estado
+    # das threads desse momento; por isso o pool é criado aqui, antes do socket de escuta e de
+    # qualquer thread (um lock preso por outra thread no fork ficaria preso para sempre no filho).
+    global password_executor
+    password_executor = create_password_executor()
+    password_executor.submit(int).result()
+
+
+def start_background_threads():
+    start_password_workers()
+    db_manager.start()
+    activity_logger.start()
+
+
+def load_session_secret():
+    try:
+        with open(SESSION_SECRET_FILE, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        secret = os.urandom(32)
+        fd = os.open(SESSION_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secret)
+        return secret
+
+
+password_executor = None
+session_secret = load_session_secret()
 
 
 def setup_storage():
@@ -295,17 +965,952 @@ def setup_storage():
         os.makedirs(STORAGE_DIR)
     if not os.path.exists(DB_DIR):
         os.makedirs(DB_DIR)
+    if not os.path.exists(TEMP_DIR):
+        os.makedirs(TEMP_DIR)
+    if not os.path.exists(UPLOAD_STAGING_DIR):
+        os.makedirs(UPLOAD_STAGING_DIR)
+    threading.Thread(target=consistency_checker, name="savebox-consistency", daemon=True).start()
+    threading.Thread(target=upload_session_collector, name="savebox-upload-gc", daemon=True).start()
+    if "--migrate-storage" in sys.argv:
+        threading.Thread(target=migrate_storage_layout, name="savebox-storage-migration", daemon=True).start()
 
 
-def handle_client(secure_conn, addr):
+def create_server_context():
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile="cert.pem", keyfile="key.pem")
+    # Pede ao OpenSSL que use kernel TLS quando o kernel e a cifra negociada permitirem.
+    context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+    return context
+
+
+# Só versões do Python com OP_ENABLE_KTLS conseguem usar sendfile com kTLS; nas demais o
+# SSLSocket.sendfile cairia em send() de pequenos blocos e o envio fica com o buffer da sessão.
+KTLS_SENDFILE_SUPPORTED = hasattr(ssl, 'OP_ENABLE_KTLS')
+
+
+# --- Operações bloqueantes (banco de dados e disco) compartilhadas pelos dois modos ---
+
+def listing_entry(logical_name, item_type, size, date, item_count):
+    return {
+        'name': logical_name,
+        'size': size,
+        'date': date if date is not None else time.time(),
+        'type': item_type,
+        'items': item_count
+    }
+
+
+def build_file_listing(login, user_base_folder, encrypted_relative_path):
+    # Tudo vem do metadata; o disco só é consultado pela verificação de consistência.
+    return [listing_entry(*row) for row in db_manager.list_path(login, encrypted_relative_path)]
+
+
+def encode_list_cursor(sort_value, item_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, item_id]).encode()).decode()
+
+
+def decode_list_cursor(cursor):
+    try:
+        sort_value, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as e:
+        raise ValueError("Cursor inválido.") from e
+    return sort_value, int(item_id)
+
+
+def build_file_listing_page(login, encrypted_relative_path, sort_key, descending, limit, cursor):
+    # Pede um item a mais para saber se existe próxima página sem um COUNT separado. A primeira
+    # página leva o change_seq lido antes da listagem, ponto de partida para o CHANGES_SINCE.
+    after = decode_list_cursor(cursor) if cursor else None
+    change_seq = None if cursor else db_manager.get_change_seq(login)
+    rows = db_manager.list_page(login, encrypted_relative_path, sort_key, descending, limit + 1, after)
+    next_cursor = encode_list_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    page = {'items': [listing_entry(*row[2:]) for row in rows[:limit]], 'cursor': next_cursor}
+    if change_seq is not None:
+        page['seq'] = change_seq
+    return page
+
+
+def build_changes_since(login, since_seq):
+    # Estado atual de cada item alterado depois de since_seq; reset pede uma listagem completa.
+    current_seq, rows = db_manager.get_changes_since(login, since_seq, CHANGES_MAX_ITEMS)
+    if rows is None:
+        return {'seq': current_seq, 'reset': True, 'changes': []}
+
+    changes = []
+    for _, parent_path_logical, logical_name, item_type, size, date, item_count in rows:
+        if item_type is None:
+            change = {'name': logical_name, 'deleted': True}
+        else:
+            change = listing_entry(logical_name, item_type, size, date, item_count)
+        change['path'] = parent_path_logical
+        changes.append(change)
+    return {'seq': current_seq, 'reset': False, 'changes': changes}
+
+
+def hash_password(password, auth_salt, password_kdf):
+    # Roda no pool de processos: precisa ser uma função do módulo, sem estado.
+    _, log_n, r, p = password_kdf.split('$')
+    return hashlib.scrypt(password.encode('utf-8'), salt=auth_salt, n=2 ** int(log_n), r=int(r), p=int(p)).hex()
+
+
+def legacy_password_hash(password):
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+
+async def hash_new_password(stream, password):
+    auth_salt = os.urandom(PASSWORD_SALT_SIZE)
+    password_hash = await stream.run_cpu_bound(hash_password, password, auth_salt, PASSWORD_KDF)
+    return password_hash, auth_salt
+
+
+async def register_user(stream, login, password):
+    password_hash, auth_salt = await hash_new_password(stream, password)
+    return await stream.run_blocking(db_manager.register_user, login, password_hash, auth_salt, PASSWORD_KDF)
+
+
+async def authenticate_user(stream, login, password):
+    # Retorna (salt_hex, mensagem_de_erro)
+    record = await stream.run_blocking(db_manager.get_password_record, login)
+    if record is None:
+        return None, "Usuário ou senha inválidos"
+    password_hash, auth_salt, password_kdf, salt = record
+
+    if password_kdf is None:
+        # Conta antiga: confere o SHA-256 e já grava o hash no KDF atual.
+        if not hmac.compare_digest(legacy_password_hash(password), password_hash):
+            return None, "Usuário ou senha inválidos"
+        new_hash, new_salt = await hash_new_password(stream, password)
+        await stream.run_blocking(db_manager.set_password_hash, login, new_hash, new_salt, PASSWORD_KDF)
+    elif not hmac.compare_digest(await stream.run_cpu_bound(hash_password, password, auth_salt, password_kdf), password_hash):
+        return None, "Usuário ou senha inválidos"
+
+    await stream.run_blocking(functools.partial(os.makedirs, os.path.join(STORAGE_DIR, login), exist_ok=True))
+    return salt.hex(), None
+
+
+def issue_session_token(login, issued=None):
+    # emissão.expiração.login_em_base64.assinatura; não tem '|', então cabe no meta de um quadro.
+    # Na renovação a emissão original é mantida, o que limita a sessão a SESSION_MAX_AGE.
+    now = int(time.time())
+    if issued is None:
+        issued = now
+    expires = min(now + SESSION_TOKEN_TTL, issued + SESSION_MAX_AGE)
+    payload = f"{issued}.{expires}.{base64.urlsafe_b64encode(login.encode('utf-8')).decode('ascii')}"
+    return f"{payload}.{hmac.new(session_secret, payload.encode('ascii'), hashlib.sha256).hexdigest()}"
+
+
+def verify_session_token(token):
+    # Retorna (login, emissão) do token, ou None se a assinatura não confere ou o token expirou.
+    try:
+        issued, expires, login_b64, signature = token.split('.')
+        payload = f"{issued}.{expires}.{login_b64}"
+        expected = hmac.new(session_secret, payload.encode('ascii'), hashlib.sha256).hexdigest().encode('ascii')
+        # Compara bytes: compare_digest recusa str com caracteres fora do ASCII (TypeError).
+        if not hmac.compare_digest(signature.encode('utf-8'), expected):
+            return None
+        issued, expires = int(issued), int(expires)
+        if expires < time.time() or expires > issued + SESSION_MAX_AGE:
+            return None
+        return base64.urlsafe_b64decode(login_b64).decode('utf-8'), issued
+    except (ValueError, UnicodeError, binascii.Error):
+        return None
+
+
+def load_user_stats(login):
+    # Grava os eventos pendentes antes da leitura, para que as últimas transferências apareçam.
+    activity_logger.flush()
+    return db_manager.get_user_stats(login)
+
+
+def check_metadata_consistency():
+    # Confere tamanho e data guardados no metadata com os arquivos em disco, em páginas,
+    # e corrige as diferenças (arquivos ausentes ficam com tamanho 0).
+    fixed, after_id = 0, 0
+    while True:
+        rows = db_manager.get_file_stats_page(after_id, CONSISTENCY_CHECK_BATCH)
+        if not rows:
+            break
+
+        updates = []
+        for item_id, login, physical_name, size, mtime in rows:
+            full_physical_path = get_safe_path(os.path.join(STORAGE_DIR, login), physical_name)
+            try:
+                stats = os.stat(full_physical_path)
+            except (OSError, TypeError):
+                if size != 0:
+                    updates.append((0, mtime, item_id, login))
+                continue
+
+            if stats.st_size != size or mtime is None or abs(stats.st_mtime - mtime) > 1:
+                updates.append((stats.st_size, stats.st_mtime, item_id, login))
+
+        if updates:
+            db_manager.update_file_stats(updates)
+            fixed += len(updates)
+        after_id = rows[-1][0]
+
+    if fixed:
+        print(f"[CONSISTÊNCIA] {fixed} item(ns) do metadata atualizados a partir do disco.")
+
+
+def consistency_checker():
+    while True:
+        try:
+            check_metadata_consistency()
+            db_manager.prune_tombstones(time.time() - CHANGE_TOMBSTONE_TTL)
+        except Exception as e:
+            print(f"[ERRO] Falha na verificação de consistência: {e}")
+        time.sleep(CONSISTENCY_CHECK_INTERVAL)
+
+
+def iter_misplaced_blobs(user_base_folder):
+    # Blobs de um usuário que não estão no caminho do STORAGE_LAYOUT atual: (caminho, nome físico)
+    if STORAGE_LAYOUT == 'sharded':
+        with os.scandir(user_base_folder) as entries:
+            for entry in entries:
+                if entry.is_file() and storage_relative_path(entry.name, 'sharded') != entry.name:
+                    yield entry.path, entry.name
+        return
+
+    with os.scandir(user_base_folder) as entries:
+        shard_dirs = [entry.path for entry in entries if entry.is_dir()]
+    for shard_dir in shard_dirs:
+        for dir_path, _, file_names in os.walk(shard_dir):
+            for file_name in file_names:
+                yield os.path.join(dir_path, file_name), file_name
+
+
+def move_blob(source_path, target_path):
+    # link + remove: o blob sempre existe em pelo menos um dos layouts, então as leituras
+    # (que procuram nos dois) não falham durante a migração.
+    try:
+        make_blob_dir(target_path)
+        os.link(source_path, target_path)
+    except FileExistsError:
+        pass  # já regravado no layout atual; a cópia antiga está obsoleta
+    except FileNotFoundError:
+        return False  # removido por um DELETE nesse meio tempo
+    except OSError:
+        # Sistema de arquivos sem hard links: rename simples
+        if not os.path.exists(target_path):
+            os.replace(source_path, target_path)
+            return True
+    remove_file_if_exists(source_path)
+    return True
+
+
+def remove_empty_shard_dirs(user_base_folder):
+    with os.scandir(user_base_folder) as entries:
+        shard_dirs = [entry.path for entry in entries if entry.is_dir()]
+    for shard_dir in shard_dirs:
+        for dir_path, _, _ in os.walk(shard_dir, topdown=False):
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                pass
+
+
+def migrate_storage_layout():
+    # Migração online: move os blobs para STORAGE_LAYOUT em lotes, com pausas entre eles
+    # para não disputar o disco com as sessões.
+    print(f"[MIGRAÇÃO] Movendo blobs para o layout '{STORAGE_LAYOUT}'...")
+    moved = 0
+    try:
+        for login in sorted(os.listdir(STORAGE_DIR)):
+            user_base_folder = os.path.join(STORAGE_DIR, login)
+            if not os.path.isdir(user_base_folder):
+                continue
+
+            for source_path, physical_name in iter_misplaced_blobs(user_base_folder):
+                with user_blob_lock(login):
+                    blob_moved = move_blob(source_path, get_safe_path(user_base_folder, physical_name, for_write=True))
+                if blob_moved:
+                    moved += 1
+                    if moved % STORAGE_MIGRATION_BATCH == 0:
+                        time.sleep(STORAGE_MIGRATION_PAUSE)
+
+            if STORAGE_LAYOUT == 'flat':
+                with user_blob_lock(login):
+                    remove_empty_shard_dirs(user_base_folder)
+    except Exception as e:
+        print(f"[ERRO] Falha na migração do armazenamento: {e}")
+        return
+
+    print(f"[MIGRAÇÃO] Concluída: {moved} blob(s) movido(s) para o layout '{STORAGE_LAYOUT}'.")
+
+
+def create_folder(login, encrypted_relative_path):
+    parent_path_logical, logical_name = split_logical_path(encrypted_relative_path)
+    physical_name = hashlib.sha1(logical_name.encode()).hexdigest() + "_folder"
+
+    db_manager.add_metadata(login, parent_path_logical, logical_name, physical_name, 'folder')
+    db_manager.update_parent_folders_dates(login, encrypted_relative_path)
+
+
+def register_uploaded_file(login, encrypted_relative_path, physical_name, bytes_received):
+    parent_path_logical, logical_name = split_logical_path(encrypted_relative_path)
+    stats = os.stat(get_safe_path(os.path.join(STORAGE_DIR, login), physical_name))
+
+    db_manager.add_metadata(login, parent_path_logical, logical_name, physical_name, 'file', stats.st_size, stats.st_mtime)
+    activity_logger.record(login, 'UPLOAD', bytes_received)
+    db_manager.update_parent_folders_dates(login, encrypted_relative_path)
+
+
+def remove_file_if_exists(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+# --- Sessões de upload retomáveis ---
+
+active_uploads = set()
+active_uploads_lock = threading.Lock()
+
+
+def staging_path(upload_id):
+    return os.path.join(UPLOAD_STAGING_DIR, upload_id)
+
+
+def begin_upload_session(login, encrypted_relative_path, total_size):
+    upload_id = os.urandom(16).hex()
+    open(staging_path(upload_id), 'wb').close()
+    db_manager.create_upload_session(upload_id, login, encrypted_relative_path, total_size)
+    return upload_id
+
+
+def get_upload_status(login, upload_id):
+    # Retorna (offset, tamanho_total, mensagem_de_erro)
+    session = db_manager.get_upload_session(upload_id)
+    if not session or session[0] != login or not os.path.exists(staging_path(upload_id)):
+        return 0, 0, "Sessão de upload não encontrada."
+    return os.path.getsize(staging_path(upload_id)), session[2], None
+
+
+def acquire_upload_session(upload_id):
+    # Impede que duas conexões escrevam na mesma sessão ao mesmo tempo.
+    with active_uploads_lock:
+        if upload_id in active_uploads:
+            return False
+        active_uploads.add(upload_id)
+        return True
+
+
+def release_upload_session(upload_id):
+    with active_uploads_lock:
+        active_uploads.discard(upload_id)
+
+
+def assemble_upload_parts(upload_ids, expected_digests):
+    # Concatena as partes na primeira sessão conferindo o SHA-256 de cada uma.
+    digests = [hashlib.sha256()]
+    with open(staging_path(upload_ids[0]), 'r+b') as target:
+        for chunk in iter(lambda: target.read(WRITE_BUFFER_SIZE), b''):
+            digests[0].update(chunk)
+        for upload_id in upload_ids[1:]:
+            digests.append(hashlib.sha256())
+            with open(staging_path(upload_id), 'rb') as source:
+                for chunk in iter(lambda: source.read(WRITE_BUFFER_SIZE), b''):
+                    digests[-1].update(chunk)
+                    target.write(chunk)
+    for upload_id in upload_ids[1:]:
+        remove_file_if_exists(staging_path(upload_id))
+
+    if expected_digests and [digest.hexdigest() for digest in digests] != [digest.lower() for digest in expected_digests]:
+        return "Falha na verificação: o SHA-256 das partes não confere."
+    return None
+
+
+def commit_upload_session(login, upload_ids, expected_digests=None):
+    # Retorna a mensagem de erro, ou None se o arquivo foi movido para o armazenamento.
+    # Uploads paralelos chegam em várias sessões, uma por intervalo e na ordem do arquivo.
+    acquired = []
+    try:
+        for upload_id in upload_ids:
+            if not acquire_upload_session(upload_id):
+                return "Sessão de upload em uso por outra conexão."
+            acquired.append(upload_id)
+
+        encrypted_paths = set()
+        for upload_id in upload_ids:
+            offset, total_size, error = get_upload_status(login, upload_id)
+            if error:
+                return error
+            if offset != total_size:
+                return f"Upload incompleto: {offset} de {total_size} bytes recebidos."
+            encrypted_paths.add(db_manager.get_upload_session(upload_id)[1])
+        if len(encrypted_paths) != 1:
+            return "As partes pertencem a uploads diferentes."
+
+        if len(upload_ids) > 1 or expected_digests:
+            error = assemble_upload_parts(upload_ids, expected_digests)
+            if error:
+                db_manager.delete_upload_sessions(upload_ids)
+                remove_file_if_exists(staging_path(upload_ids[0]))
+                return error
+
+        encrypted_relative_path = encrypted_paths.pop()
+        logical_name = os.path.basename(encrypted_relative_path)
+        physical_name = hashlib.sha1(logical_name.encode()).hexdigest()
+        full_physical_path = get_safe_path(os.path.join(STORAGE_DIR, login), physical_name, for_write=True)
+
+        total_size = os.path.getsize(staging_path(upload_ids[0]))
+        with user_blob_lock(login):
+            make_blob_dir(full_physical_path)
+            shutil.move(staging_path(upload_ids[0]), full_physical_path)
+        register_uploaded_file(login, encrypted_relative_path, physical_name, total_size)
+        db_manager.delete_upload_sessions(upload_ids)
+    finally:
+        for upload_id in acquired:
+            release_upload_session(upload_id)
+
+    print(f"[UPLOAD] Arquivo '{logical_name}' salvo em '{full_physical_path}' ({len(upload_ids)} sessão(ões)).")
+    return None
+
+
+class SessionCounter:
+    # Sessões em andamento (nos dois modos), usado para limitar as transferências paralelas.
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, delta):
+        with self.lock:
+            self.value += delta
+
+
+active_sessions = SessionCounter()
+# Sessões simultâneas do modo em execução; main() e main_async() definem o valor.
+session_capacity = MAX_SESSIONS
+
+
+def granted_transfer_streams(requested):
+    spare_sessions = session_capacity - active_sessions.value - TRANSFER_STREAMS_RESERVE
+    return max(1, min(requested, MAX_TRANSFER_STREAMS, 1 + spare_sessions))
+
+
+def collect_abandoned_uploads():
+    # As sessões saem da tabela ainda com o lock: um UPLOAD_APPEND ou UPLOAD_COMMIT que reserve a
+    # sessão depois disso já não a encontra, e só então os arquivos são apagados.
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    with active_uploads_lock:
+        expired = [upload_id for upload_id in db_manager.get_upload_sessions_before(cutoff) if upload_id not in active_uploads]
+        if expired:
+            db_manager.delete_upload_sessions(expired)
+
+    # Também remove dados parciais antigos que não pertencem a nenhuma sessão.
+    for upload_id in os.listdir(UPLOAD_STAGING_DIR):
+        path = staging_path(upload_id)
+        if upload_id in expired or (os.path.getmtime(path) < cutoff and not db_manager.get_upload_session(upload_id)):
+            remove_file_if_exists(path)
+
+    if expired:
+        print(f"[UPLOAD] {len(expired)} sessão(ões) de upload abandonada(s) descartada(s).")
+
+
+def upload_session_collector():
+    while True:
+        try:
+            collect_abandoned_uploads()
+        except Exception as e:
+            print(f"[ERRO] Falha ao descartar sessões de upload: {e}")
+        time.sleep(UPLOAD_GC_INTERVAL)
+
+
+def find_file_for_download(login, user_base_folder, encrypted_relative_path):
+    parent_path_logical, logical_name = split_logical_path(encrypted_relative_path)
+
+    item_metadata = db_manager.get_metadata_item(login, parent_path_logical, logical_name)
+    if not item_metadata or item_metadata[1] != 'file':
+        return None, "Arquivo não encontrado."
+
+    full_physical_path = get_safe_path(user_base_folder, item_metadata[0])
+    if not full_physical_path or not os.path.isfile(full_physical_path):
+        return None, "Arquivo físico não encontrado no disco."
+
+    return full_physical_path, None
+
+
+def collect_folder_zip_entries(login, user_base_folder, relative_path):
+    # Retorna ([(nome_no_zip, caminho_físico_ou_None, tamanho)], mensagem_de_erro)
+    if relative_path:
+        parent_path_logical, logical_name = split_logical_path(relative_path)
+        folder_metadata = db_manager.get_metadata_item(login, parent_path_logical, logical_name)
+
+        if not folder_metadata or folder_metadata[1] != 'folder':
+            return None, "Pasta não encontrada."
+
+    files_in_folder = db_manager.get_all_files_in_folder_recursive(login, relative_path)
+    folders_in_folder = db_manager.get_all_folders_in_folder_recursive(login, relative_path)
+
+    if not files_in_folder and not folders_in_folder:
+        return None, "Pasta vazia."
+
+    entries = []
+    for parent_path_logical, logical_name in folders_in_folder:
+        if parent_path_logical:
+            full_logical_path = parent_path_logical + '/' + logical_name
+        else:
+            full_logical_path = logical_name
+
+        if relative_path:
+            if full_logical_path.startswith(relative_path + '/'):
+                archive_name = full_logical_path[len(relative_path) + 1:] + '/'
+            elif full_logical_path == relative_path:
+                continue
+            else:
+                archive_name = logical_name + '/'
+        else:
+            archive_name = full_logical_path + '/'
+
+        entries.append((archive_name, None, 0))
+
+    for parent_path_logical, logical_name, physical_name in files_in_folder:
+        if parent_path_logical:
+            full_logical_path = parent_path_logical + '/' + logical_name
+        else:
+            full_logical_path = logical_name
+
+        full_physical_path = get_safe_path(user_base_folder, physical_name)
+
+        if full_physical_path and os.path.isfile(full_physical_path):
+            if relative_path:
+                if full_logical_path.startswith(relative_path + '/'):
+                    archive_name = full_logical_path[len(relative_path) + 1:]
+                else:
+                    archive_name = logical_name
+            else:
+                archive_name = full_logical_path
+
+            entries.append((archive_name, full_physical_path, os.path.getsize(full_physical_path)))
+
+    return entries, None
+
+
+def estimate_stored_zip_size(entries):
+    # Tamanho de um ZIP_STORED gravado em fluxo (cabeçalho local, dados, descritor de dados
+    # e diretório central por membro). Serve para a barra de progresso do cliente. Segue as
+    # regras do zipfile: membros grandes levam extra ZIP64 e descritor de 64 bits, membros que
+    # começam depois de ZIP64_LIMIT levam o offset no extra do diretório central e, passando
+    # dos limites do ZIP32, o arquivo termina com os registros ZIP64 de fim de diretório.
+    offset, central_size, member_count = 0, 0, 0
+    for archive_name, full_physical_path, size in entries:
+        name_length = len(archive_name.encode('utf-8'))
+        header_offset = offset
+        offset += ZIP_LOCAL_HEADER_SIZE + name_length + size
+        if size * 1.05 > zipfile.ZIP64_LIMIT:
+            offset += ZIP64_EXTRA_SIZE + ZIP64_DESCRIPTOR_SIZE
+        else:
+            offset += ZIP_DESCRIPTOR_SIZE
+
+        central_size += ZIP_CENTRAL_HEADER_SIZE + name_length
+        zip64_fields = (2 if size > zipfile.ZIP64_LIMIT else 0) + (1 if header_offset > zipfile.ZIP64_LIMIT else 0)
+        if zip64_fields:
+            central_size += ZIP64_EXTRA_HEADER_SIZE + zip64_fields * ZIP64_EXTRA_FIELD_SIZE
+        member_count += 1
+
+    total = offset + central_size + ZIP_END_RECORD_SIZE
+    if member_count > zipfile.ZIP_FILECOUNT_LIMIT or offset > zipfile.ZIP64_LIMIT or central_size > zipfile.ZIP64_LIMIT:
+        total += ZIP64_END_RECORD_SIZE + ZIP64_END_LOCATOR_SIZE
+    return total
+
+
+def build_folder_zip(login, user_base_folder, relative_path):
+    # Retorna (arquivo_temporário, tamanho_do_zip, bytes_originais, mensagem_de_erro).
+    # O ZIP é montado em disco para não manter a pasta inteira na memória.
+    entries, error = collect_folder_zip_entries(login, user_base_folder, relative_path)
+    if error:
+        return None, 0, 0, error
+
+    zip_file = tempfile.TemporaryFile(dir=TEMP_DIR)
+    try:
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_STORED) as zf:
+            for archive_name, full_physical_path, _ in entries:
+                if full_physical_path is None:
+                    zf.writestr(archive_name, b'')
+                else:
+                    zf.write(full_physical_path, arcname=archive_name)
+        zip_size = zip_file.tell()
+    except Exception:
+        zip_file.close()
+        raise
+
+    total_size = sum(size for _, _, size in entries)
+    return zip_file, zip_size, total_size, None
+
+
+def delete_item(login, user_base_folder, encrypted_relative_path):
+    item_type, physical_names_to_delete = db_manager.get_physicals_to_delete(login, encrypted_relative_path)
+
+    if item_type is None:
+        return False
+
+    for physical_name in physical_names_to_delete:
+        with user_blob_lock(login):
+            item_to_delete_path = get_safe_path(user_base_folder, physical_name)
+
+            if item_to_delete_path and os.path.exists(item_to_delete_path):
+                item_name = os.path.basename(item_to_delete_path)
+                if os.path.isfile(item_to_delete_path):
+                    os.remove(item_to_delete_path)
+                    print(f"[DELETE] Item '{item_name}' foi deletado por '{login}'.")
+
+    db_manager.delete_metadata_recursive(login, encrypted_relative_path)
+    db_manager.update_parent_folders_dates(login, encrypted_relative_path)
+    return True
+
+
+def create_zip_root_folder(login, encrypted_folder_path):
+    parent_path_logical, logical_folder_name = split_logical_path(encrypted_folder_path)
+    physical_folder_name = hashlib.sha1(logical_folder_name.encode()).hexdigest() + "_folder"
+
+    db_manager.add_metadata(login, parent_path_logical, logical_folder_name, physical_folder_name, 'folder')
+
+
+class ZipImport:
+    # Extrai um .zip já gravado em disco em etapas curtas, para que a sessão possa relatar
+    # o progresso entre elas. Os metadados só são gravados em commit(), todos de uma vez.
+    def __init__(self, login, user_base_folder, encrypted_folder_path, zip_path):
+        self.login = login
+        self.user_base_folder = user_base_folder
+        self.encrypted_folder_path = encrypted_folder_path
+        self.zf = zipfile.ZipFile(zip_path, 'r')
+        self.members = self.zf.infolist()
+        self.position = 0
+        self.total_bytes = sum(item_info.file_size for item_info in self.members)
+        self.extracted_bytes = 0
+        self.metadata_rows = []
+        self.known_folders = set()
+        self.written_paths = []
+
+    def done(self):
+        return self.position >= len(self.members)
+
+    def extract_step(self):
+        step_bytes, step_members = 0, 0
+        while not self.done() and step_bytes < ZIP_IMPORT_STEP_BYTES and step_members < ZIP_IMPORT_STEP_MEMBERS:
+            item_info = self.members[self.position]
+            self.position += 1
+            step_members += 1
+            step_bytes += self.extract_member(item_info)
+        self.extracted_bytes += step_bytes
+
+    def extract_member(self, item_info):
+        archive_path = item_info.filename.replace('\\', '/').rstrip('/')
+        if not archive_path:
+            return 0
+
+        full_logical_path = os.path.join(self.encrypted_folder_path, archive_path).replace('\\', '/')
+        parent_logical = os.path.dirname(full_logical_path)
+        logical_name = os.path.basename(full_logical_path)
+
+        self.add_folder(parent_logical)
+        if item_info.is_dir():
+            self.add_folder(full_logical_path)
+            return 0
+
+        physical_name = hashlib.sha1(logical_name.encode()).hexdigest()
+        full_physical_path = get_safe_path(self.user_base_folder, physical_name, for_write=True)
+
+        self.written_paths.append(full_physical_path)
+        make_blob_dir(full_physical_path)
+        with self.zf.open(item_info) as source, open(full_physical_path, 'wb') as target:
+            shutil.copyfileobj(source, target, WRITE_BUFFER_SIZE)
+        stats = os.stat(full_physical_path)
+
+        self.metadata_rows.append((parent_logical, logical_name, physical_name, 'file', stats.st_size, stats.st_mtime))
+        return item_info.file_size
+
+    def add_folder(self, full_logical_path):
+        # Cria também as pastas intermediárias que o .zip não lista como entradas próprias.
+        if full_logical_path == self.encrypted_folder_path or full_logical_path in self.known_folders:
+            return
+        self.known_folders.add(full_logical_path)
+        parent_logical, logical_name = split_logical_path(full_logical_path)
+        self.add_folder(parent_logical)
+        physical_name = hashlib.sha1(logical_name.encode()).hexdigest() + "_folder"
+        self.metadata_rows.append((parent_logical, logical_name, physical_name, 'folder', 0, None))
+
+    def commit(self, bytes_received):
+        db_manager.add_metadata_batch(self.login, self.metadata_rows)
+        activity_logger.record(self.login, 'UPLOAD', bytes_received)
+        db_manager.update_parent_folders_dates(self.login, self.encrypted_folder_path)
+
+    def discard(self):
+        # Em caso de falha nenhum metadado foi gravado; os arquivos já extraídos são removidos.
+        for full_physical_path in self.written_paths:
+            remove_file_if_exists(full_physical_path)
+
+    def close(self):
+        self.zf.close()
+
+
+# --- Adaptadores de conexão ---
+# A sessão do cliente é escrita uma única vez como corrotina. No modo com threads o
+# SocketStream faz chamadas bloqueantes diretamente; no modo asyncio o AsyncioStream
+# usa o StreamReader/StreamWriter e manda o trabalho bloqueante para um executor.
+
+class BufferedStream:
+    # bytes_read conta o que já foi consumido do fluxo; a sessão binária usa a contagem para
+    # descartar a parte do corpo de um quadro que o handler não leu.
+    def __init__(self):
+        self.pending = bytearray()
+        self.bytes_read = 0
+
+    async def recv(self, size):
+        if self.pending:
+            data = bytes(self.pending[:size])
+            del self.pending[:size]
+        else:
+            data = await self.read_raw(size)
+        self.bytes_read += len(data)
+        return data
+
+    async def recv_exact(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = await self.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("Conexão encerrada no meio de uma mensagem.")
+            data += chunk
+        return bytes(data)
+
+    async def discard(self, size):
+        while size > 0:
+            chunk = await self.recv(min(size, WRITE_BUFFER_SIZE))
+            if not chunk:
+                raise ConnectionResetError("Conexão encerrada no meio de uma mensagem.")
+            size -= len(chunk)
+
+    def unread(self, data):
+        self.pending[:0] = data
+        self.bytes_read -= len(data)
+
+
+class SocketStream(BufferedStream):
+    def __init__(self, secure_conn):
+        super().__init__()
+        self.conn = secure_conn
+        self.send_buffer = None
+
+    async def read_raw(self, size):
+        return self.conn.recv(size)
+
+    async def send(self, data):
+        self.conn.sendall(data)
+
+    async def send_file(self, f, offset, count):
+        if KTLS_SENDFILE_SUPPORTED:
+            try:
+                self.conn.sendfile(f, offset, count)
+                return
+            except (NotImplementedError, ValueError):
+                pass
+
+        if self.send_buffer is None:
+            self.send_buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+        buffer = self.send_buffer
+        f.seek(offset)
+        remaining = count
+        while remaining > 0:
+            bytes_read = f.readinto(buffer[:min(remaining, DOWNLOAD_CHUNK_SIZE)])
+            if not bytes_read: break
+            self.conn.sendall(buffer[:bytes_read])
+            remaining -= bytes_read
+
+    async def run_blocking(self, func, *args):
+        return func(*args)
+
+    async def run_cpu_bound(self, func, *args):
+        return password_executor.submit(func, *args).result()
+
+    async def close(self):
+        self.conn.close()
+
+
+class AsyncioStream(BufferedStream):
+    def __init__(self, reader, writer):
+        super().__init__()
+        self.reader = reader
+        self.writer = writer
+        self.send_buffer = None
+
+    async def read_raw(self, size):
+        return await self.reader.read(size)
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def send_file(self, f, offset, count):
+        # O transporte SSL do asyncio guarda referências ao que recebe em write(),
+        # então cada bloco lido no buffer reaproveitado é copiado antes do envio.
+        if self.send_buffer is None:
+            self.send_buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+        buffer = self.send_buffer
+        await self.run_blocking(f.seek, offset)
+        remaining = count
+        while remaining > 0:
+            bytes_read = await self.run_blocking(f.readinto, buffer[:min(remaining, DOWNLOAD_CHUNK_SIZE)])
+            if not bytes_read: break
+            await self.send(bytes(buffer[:bytes_read]))
+            remaining -= bytes_read
+
+    async def run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(blocking_executor, functools.partial(func, *args))
+
+    async def run_cpu_bound(self, func, *args):
+        return await asyncio.wrap_future(password_executor.submit(func, *args))
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ssl.SSLError, ConnectionError):
+            pass
+
+
+# --- Transferências compartilhadas pelos protocolos texto e binário ---
+
+async def receive_to_file(stream, full_physical_path, filesize, mode='wb'):
+    # Sempre consome os filesize bytes do fluxo, mesmo se a escrita falhar,
+    # para que a conexão continue alinhada na próxima mensagem. O que chegou antes
+    # de uma queda da conexão também é gravado (usado pelos uploads retomáveis).
+    bytes_received = 0
+    write_error = None
+    pending = bytearray()
+
+    async def write_pending():
+        nonlocal write_error
+        if write_error is None:
+            try:
+                await stream.run_blocking(f.write, bytes(pending))
+            except OSError as e:
+                write_error = e
+        pending.clear()
+
+    await stream.run_blocking(make_blob_dir, full_physical_path)
+    f = await stream.run_blocking(open, full_physical_path, mode)
+    try:
+        while bytes_received < filesize:
+            chunk = await stream.recv(min(filesize - bytes_received, WRITE_BUFFER_SIZE))
+            if not chunk: break
+            pending += chunk
+            bytes_received += len(chunk)
+            if len(pending) >= WRITE_BUFFER_SIZE:
+                await write_pending()
+    finally:
+        if pending:
+            await write_pending()
+        await stream.run_blocking(f.close)
+
+    if write_error is not None:
+        raise write_error
+    return bytes_received
+
+
+async def receive_to_temp_file(stream, filesize, suffix=''):
+    fd, temp_path = await stream.run_blocking(tempfile.mkstemp, suffix, 'upload_', TEMP_DIR)
+    await stream.run_blocking(os.close, fd)
+    try:
+        bytes_received = await receive_to_file(stream, temp_path, filesize)
+    except BaseException:
+        await stream.run_blocking(remove_file_if_exists, temp_path)
+        raise
+    return temp_path, bytes_received
+
+
+async def send_file_body(stream, full_physical_path, filesize, offset=0):
+    f = await stream.run_blocking(open, full_physical_path, 'rb')
+    try:
+        await stream.send_file(f, offset, filesize)
+    finally:
+        await stream.run_blocking(f.close)
+
+
+class ZipChunkSink:
+    # Destino sem seek() para o ZipFile: os membros saem com descritor de dados
+    # e os bytes ficam acumulados até serem enviados em blocos.
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        chunk = bytes(self.data)
+        self.data.clear()
+        return chunk
+
+
+def copy_zip_member_chunk(f, member):
+    data = f.read(ZIP_STREAM_CHUNK_SIZE)
+    member.write(data)
+    return len(data)
+
+
+async def import_uploaded_zip(stream, login, user_base_folder, encrypted_folder_path, zip_path, bytes_received, report_progress=None):
+    zip_import = await stream.run_blocking(ZipImport, login, user_base_folder, encrypted_folder_path, zip_path)
+    try:
+        while not zip_import.done():
+            await stream.run_blocking(zip_import.extract_step)
+            if report_progress is not None:
+                await report_progress(zip_import.extracted_bytes, zip_import.total_bytes)
+        await stream.run_blocking(zip_import.commit, bytes_received)
+    except BaseException:
+        await stream.run_blocking(zip_import.discard)
+        raise
+    finally:
+        await stream.run_blocking(zip_import.close)
+
+
+async def stream_folder_zip(stream, entries, send_chunk):
+    # Grava um ZIP_STORED membro a membro, lendo do disco e enviando conforme avança.
+    sink = ZipChunkSink()
+    zf = zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED)
+    for archive_name, full_physical_path, _ in entries:
+        if full_physical_path is None:
+            zinfo = zipfile.ZipInfo(archive_name, time.localtime()[:6])
+            zinfo.external_attr = 0o40775 << 16 | 0x10
+            zf.open(zinfo, 'w').close()
+            continue
+
+        zinfo = await stream.run_blocking(zipfile.ZipInfo.from_file, full_physical_path, archive_name)
+        f = await stream.run_blocking(open, full_physical_path, 'rb')
+        try:
+            with zf.open(zinfo, 'w') as member:
+                while await stream.run_blocking(copy_zip_member_chunk, f, member):
+                    if len(sink.data) >= ZIP_STREAM_CHUNK_SIZE:
+                        await send_chunk(sink.take())
+        finally:
+            await stream.run_blocking(f.close)
+
+    zf.close()
+    await send_chunk(sink.take())
+
+
+async def client_session(stream, addr):
     print(f"[NOVA CONEXÃO] {addr} conectado.")
     authenticated_user = None
+    active_sessions.add(1)
     try:
+        # Clientes novos falam o protocolo binário (quadros com FRAME_MAGIC);
+        # versões antigas do cliente.py continuam no protocolo texto.
+        first_data = await stream.recv(BUFFER_SIZE)
+        stream.unread(first_data)
+        if first_data.startswith(FRAME_MAGIC[:1]):
+            await binary_session(stream, addr)
+            return
+
         while True:
-            data = secure_conn.recv(BUFFER_SIZE).decode('utf-8')
+            data = (await stream.recv(BUFFER_SIZE)).decode('utf-8')
             if not data:
                 break
-            
+
             parts = data.split('|')
             command = parts[0]
 
@@ -314,146 +1919,85 @@ def handle_client(secure_conn, addr):
                 login, password = parts[1], parts[2]
 
                 if command == "AUTH":
-                    if db_manager.check_credentials(login, password):
-                        authenticated_user = login
-                        user_base_folder = os.path.join(STORAGE_DIR, authenticated_user)
-                        os.makedirs(user_base_folder, exist_ok=True)
-                        
-                        salt = db_manager.get_user_salt(login)
-                        
-                        if salt:
-                            salt_hex = salt.hex()
-                            secure_conn.send(f"OK|{salt_hex}".encode('utf-8'))
-                            print(f"[AUTH] Usuário '{authenticated_user}' autenticado de {addr}.")
-                        else:
-                            secure_conn.send("ERRO|Falha ao obter dados de segurança do usuário.".encode('utf-8'))
+                    salt_hex, error = await authenticate_user(stream, login, password)
+                    if error:
+                        await stream.send(f"ERRO|{error}".encode('utf-8'))
                     else:
-                        secure_conn.send("ERRO|Usuário ou senha inválidos".encode('utf-8'))
+                        authenticated_user = login
+                        await stream.send(f"OK|{salt_hex}".encode('utf-8'))
+                        print(f"[AUTH] Usuário '{authenticated_user}' autenticado de {addr}.")
 
                 elif command == "REGISTER":
-                    if db_manager.register_user(login, password):
-                        secure_conn.send("OK|Registrado com sucesso!".encode('utf-8'))
+                    if await register_user(stream, login, password):
+                        await stream.send("OK|Registrado com sucesso!".encode('utf-8'))
 
                     else:
-                        secure_conn.send("ERRO|Usuário já existe.".encode('utf-8'))
-            
+                        await stream.send("ERRO|Usuário já existe.".encode('utf-8'))
+
             # --- Bloco de Comandos Autenticados ---
             elif authenticated_user:
                 user_base_folder = os.path.join(STORAGE_DIR, authenticated_user)
 
                 if command == "CREATE_FOLDER":
                     encrypted_relative_path = parts[1]
-                    parent_path_logical = os.path.dirname(encrypted_relative_path).replace('\\', '/')
-                    logical_name = os.path.basename(encrypted_relative_path)
-                    physical_name = hashlib.sha1(logical_name.encode()).hexdigest() + "_folder"
-                    
-                    db_manager.add_metadata(authenticated_user, parent_path_logical, logical_name, physical_name, 'folder')
-                    
-                    db_manager.update_parent_folders_dates(authenticated_user, encrypted_relative_path)
-                    
-                    secure_conn.send("OK|Pasta criada.".encode('utf-8'))
+                    await stream.run_blocking(create_folder, authenticated_user, encrypted_relative_path)
+                    await stream.send("OK|Pasta criada.".encode('utf-8'))
 
 
                 elif command == "LIST":
                     # LIST|caminho/logico/relativo
                     encrypted_relative_path = parts[1].replace('\\', '/')
-                    
-                    items_in_db = db_manager.list_path(authenticated_user, encrypted_relative_path)
-                    
-                    file_details = []
-                    for logical_name, physical_name, item_type, created_date in items_in_db:
-                        
-                        full_physical_path = get_safe_path(user_base_folder, physical_name)
-                        
-                        size, date = 0, 0
-                        if full_physical_path and os.path.exists(full_physical_path):
-                            stats = os.stat(full_physical_path)
-                            size, date = stats.st_size, stats.st_mtime
-                        else:
-                            julian_days = created_date if created_date else 0
-                            if julian_days > 0:
-                                date = (julian_days - 2440587.5) * 86400
-                            else:
-                                date = time.time()
-                        
-                        file_details.append({
-                            'name': logical_name,
-                            'size': size,
-                            'date': date,
-                            'type': item_type
-                        })
-                    
+
+                    file_details = await stream.run_blocking(build_file_listing, authenticated_user, user_base_folder, encrypted_relative_path)
+
                     response_json = json.dumps(file_details)
                     header = f"{len(response_json):<10}".encode('utf-8')
-                    secure_conn.sendall(header + response_json.encode('utf-8'))
+                    await stream.send(header + response_json.encode('utf-8'))
 
                 elif command == "UPLOAD":
                     # UPLOAD|caminho/criptografado/arquivo_cripto.enc|tamanho
                     encrypted_relative_path, filesize = parts[1], int(parts[2])
-                    parent_path_logical = os.path.dirname(encrypted_relative_path).replace('\\', '/')
                     logical_name = os.path.basename(encrypted_relative_path)
                     physical_name = hashlib.sha1(logical_name.encode()).hexdigest()
-                    
-                    full_physical_path = get_safe_path(user_base_folder, physical_name)
-                    
-                    secure_conn.send("OK".encode('utf-8'))
-                    
-                    bytes_received = 0
+
+                    full_physical_path = await stream.run_blocking(get_safe_path, user_base_folder, physical_name, True)
+
+                    await stream.send("OK".encode('utf-8'))
+
                     try:
-                        with open(full_physical_path, 'wb') as f:
-                            while bytes_received < filesize:
-                                chunk = secure_conn.recv(BUFFER_SIZE)
-                                if not chunk: break
-                                f.write(chunk)
-                                bytes_received += len(chunk)
-                        
+                        bytes_received = await receive_to_file(stream, full_physical_path, filesize)
+
                         if bytes_received < filesize:
-                            os.remove(full_physical_path)
-                            secure_conn.send("ERRO|Upload incompleto.".encode('utf-8'))
+                            await stream.run_blocking(os.remove, full_physical_path)
+                            await stream.send("ERRO|Upload incompleto.".encode('utf-8'))
                         else:
-                            db_manager.add_metadata(authenticated_user, parent_path_logical, logical_name, physical_name, 'file')
-                            db_manager.log_upload(authenticated_user, bytes_received)
-                            
-                            db_manager.update_parent_folders_dates(authenticated_user, encrypted_relative_path)
-                            
-                            secure_conn.send("OK|UPLOAD_SUCCESS".encode('utf-8'))
+                            await stream.run_blocking(register_uploaded_file, authenticated_user, encrypted_relative_path, physical_name, bytes_received)
+
+                            await stream.send("OK|UPLOAD_SUCCESS".encode('utf-8'))
                             print(f"[UPLOAD] Arquivo '{logical_name}' salvo em '{full_physical_path}'.")
-                            
+
                     except Exception as e:
                         print(f"Erro durante o upload para {full_physical_path}: {e}")
-                        if os.path.exists(full_physical_path): os.remove(full_physical_path)
-                        secure_conn.send(f"ERRO|{e}".encode('utf-8'))
+                        await stream.run_blocking(remove_file_if_exists, full_physical_path)
+                        await stream.send(f"ERRO|{e}".encode('utf-8'))
 
                 elif command == "DOWNLOAD":
                     # DOWNLOAD|caminho/relativo/arquivo.txt
                     encrypted_relative_path = parts[1]
-                    parent_path_logical = os.path.dirname(encrypted_relative_path).replace('\\', '/')
-                    logical_name = os.path.basename(encrypted_relative_path)
 
-                    item_metadata = db_manager.get_metadata_item(authenticated_user, parent_path_logical, logical_name)
-                    if not item_metadata or item_metadata[1] != 'file':
-                        secure_conn.send("ERRO|Arquivo não encontrado.".encode('utf-8'))
+                    full_physical_path, error = await stream.run_blocking(find_file_for_download, authenticated_user, user_base_folder, encrypted_relative_path)
+                    if error:
+                        await stream.send(f"ERRO|{error}".encode('utf-8'))
                         continue
 
-                    physical_name = item_metadata[0]
-                    full_physical_path = get_safe_path(user_base_folder, physical_name)
-
-                    if not full_physical_path or not os.path.isfile(full_physical_path):
-                        secure_conn.send("ERRO|Arquivo físico não encontrado no disco.".encode('utf-8'))
-                        continue
-                    
                     try:
-                        filesize = os.path.getsize(full_physical_path)
-                        secure_conn.send(f"OK|{filesize}".encode('utf-8'))
-                        secure_conn.recv(BUFFER_SIZE)
-
-                        with open(full_physical_path, 'rb') as f:
-                            while True:
-                                chunk = f.read(BUFFER_SIZE)
-                                if not chunk: break
-                                secure_conn.sendall(chunk)
-                        
-                        db_manager.log_download(authenticated_user, filesize)
+                        filesize = await stream.run_blocking(os.path.getsize, full_physical_path)
+                        await stream.send(f"OK|{filesize}".encode('utf-8'))
+                        await stream.recv(BUFFER_SIZE)
+
+                        await send_file_body(stream, full_physical_path, filesize)
+
+                        await stream.run_blocking(activity_logger.record, authenticated_user, 'DOWNLOAD', filesize)
                         print(f"[DOWNLOAD] Arquivo em '{encrypted_relative_path}' enviado para '{authenticated_user}'.")
                     except Exception as e:
                         print(f"ERRO ao enviar o arquivo {full_physical_path}: {e}")
@@ -461,198 +2005,86 @@ def handle_client(secure_conn, addr):
                 elif command == "DOWNLOAD_FOLDER_AS_ZIP":
                     # DOWNLOAD_FOLDER_AS_ZIP|caminho/relativo/da/pasta
                     relative_path = parts[1]
-                    
-
-                    if relative_path:
-                        parent_path_logical = os.path.dirname(relative_path).replace('\\', '/')
-                        logical_name = os.path.basename(relative_path)
-                        folder_metadata = db_manager.get_metadata_item(authenticated_user, parent_path_logical, logical_name)
-                        
-                        if not folder_metadata or folder_metadata[1] != 'folder':
-                            secure_conn.send("ERRO|Pasta não encontrada.".encode('utf-8'))
+
+                    try:
+                        zip_file, zip_size, total_size, error = await stream.run_blocking(build_folder_zip, authenticated_user, user_base_folder, relative_path)
+                        if error:
+                            await stream.send(f"ERRO|{error}".encode('utf-8'))
                             continue
-                    
-                    files_in_folder = db_manager.get_all_files_in_folder_recursive(authenticated_user, relative_path)
-                    folders_in_folder = db_manager.get_all_folders_in_folder_recursive(authenticated_user, relative_path)
-                    
-                    if not files_in_folder and not folders_in_folder:
-                        secure_conn.send("ERRO|Pasta vazia.".encode('utf-8'))
-                        continue
 
-                    memory_zip = io.BytesIO()
-                    total_size = 0
+                        try:
+                            await stream.send(f"OK|{zip_size}".encode('utf-8'))
+                            await stream.recv(BUFFER_SIZE)
+                            await stream.send_file(zip_file, 0, zip_size)
+                        finally:
+                            await stream.run_blocking(zip_file.close)
 
-                    try:
-                        with zipfile.ZipFile(memory_zip, 'w', zipfile.ZIP_DEFLATED) as zf:
-                            for parent_path_logical, logical_name in folders_in_folder:
-                                if parent_path_logical:
-                                    full_logical_path = parent_path_logical + '/' + logical_name
-                                else:
-                                    full_logical_path = logical_name
-                                
-                                if relative_path:
-                                    if full_logical_path.startswith(relative_path + '/'):
-                                        archive_name = full_logical_path[len(relative_path) + 1:] + '/'
-                                    elif full_logical_path == relative_path:
-                                        continue 
-                                    else:
-                                        archive_name = logical_name + '/'
-                                else:
-                                    archive_name = full_logical_path + '/'
-                                
-                                zf.writestr(archive_name, b'')
-                            
-                            for parent_path_logical, logical_name, physical_name in files_in_folder:
-                                if parent_path_logical:
-                                    full_logical_path = parent_path_logical + '/' + logical_name
-                                else:
-                                    full_logical_path = logical_name
-                                
-                                full_physical_path = get_safe_path(user_base_folder, physical_name)
-                                
-                                if full_physical_path and os.path.isfile(full_physical_path):
-                                    if relative_path:
-                                        if full_logical_path.startswith(relative_path + '/'):
-                                            archive_name = full_logical_path[len(relative_path) + 1:]
-                                        else:
-                                            archive_name = logical_name
-                                    else:
-                                        archive_name = full_logical_path
-                                    
-                                    zf.write(full_physical_path, arcname=archive_name)
-                                    total_size += os.path.getsize(full_physical_path)
-
-                        zip_size = memory_zip.getbuffer().nbytes
-                        secure_conn.send(f"OK|{zip_size}".encode('utf-8'))
-                        secure_conn.recv(BUFFER_SIZE)
-
-                        memory_zip.seek(0)
-
-                        while True:
-                            chunk = memory_zip.read(BUFFER_SIZE)
-                            if not chunk:
-                                break
-                            secure_conn.sendall(chunk)
-
-                        db_manager.log_download(authenticated_user, total_size)
+                        await stream.run_blocking(activity_logger.record, authenticated_user, 'DOWNLOAD', total_size)
                         print(f"[ZIP] Pasta '{relative_path}' compactada e enviada para '{authenticated_user}'. Tamanho: {zip_size} bytes.")
-                        
+
                     except Exception as e:
                         print(f"ERRO ao criar ZIP da pasta {relative_path}: {e}")
-                        secure_conn.send(f"ERRO|Falha ao criar arquivo ZIP: {e}".encode('utf-8'))
-                
+                        await stream.send(f"ERRO|Falha ao criar arquivo ZIP: {e}".encode('utf-8'))
+
                 elif command == "DELETE":
                     # DELETE|caminho/relativo/criptografado/do_item
                     encrypted_relative_path = parts[1]
 
-                    item_type, physical_names_to_delete = db_manager.get_physicals_to_delete(authenticated_user, encrypted_relative_path)
-
-                    if item_type is None:
-                        secure_conn.send("ERRO|Item não encontrado.".encode('utf-8'))
-                        continue
-                    
                     try:
-                        for physical_name in physical_names_to_delete:
-                            item_to_delete_path = get_safe_path(user_base_folder, physical_name)
-                            
-                            if item_to_delete_path and os.path.exists(item_to_delete_path):
-                                item_name = os.path.basename(item_to_delete_path)
-                                if os.path.isfile(item_to_delete_path):
-                                    os.remove(item_to_delete_path)
-                                    print(f"[DELETE] Item '{item_name}' foi deletado por '{authenticated_user}'.")
-                        
-                        db_manager.delete_metadata_recursive(authenticated_user, encrypted_relative_path)
-                        
-                        db_manager.update_parent_folders_dates(authenticated_user, encrypted_relative_path)
-                        
-                        secure_conn.send("OK|Item(s) deletado(s) com sucesso.".encode('utf-8'))
-                        
+                        if not await stream.run_blocking(delete_item, authenticated_user, user_base_folder, encrypted_relative_path):
+                            await stream.send("ERRO|Item não encontrado.".encode('utf-8'))
+                            continue
+
+                        await stream.send("OK|Item(s) deletado(s) com sucesso.".encode('utf-8'))
 
                     except Exception as e:
                         print(f"ERRO ao deletar itens físicos: {e}")
-                        secure_conn.send("ERRO|Falha ao deletar o item no servidor.".encode('utf-8'))
+                        await stream.send("ERRO|Falha ao deletar o item no servidor.".encode('utf-8'))
 
                 elif command == "GET_STATS":
-                    stats = db_manager.get_user_stats(authenticated_user)
+                    stats = await stream.run_blocking(load_user_stats, authenticated_user)
 
                     if stats:
                         response = f"STATS|{stats[0]}|{stats[1]}|{stats[2]}|{stats[3]}"
-                        secure_conn.send(response.encode('utf-8'))
+                        await stream.send(response.encode('utf-8'))
 
                     else:
-                        secure_conn.send("ERRO|Não foi possível obter estatísticas.".encode('utf-8'))
+                        await stream.send("ERRO|Não foi possível obter estatísticas.".encode('utf-8'))
 
                 elif command == "UPLOAD_ZIP_AS_FOLDER":
                     # UPLOAD_ZIP_AS_FOLDER|caminho_pasta_raiz_criptografado|tamanho_zip
                     encrypted_folder_path, filesize = parts[1], int(parts[2])
-                    
-                    parent_path_logical = os.path.dirname(encrypted_folder_path).replace('\\', '/')
                     logical_folder_name = os.path.basename(encrypted_folder_path)
-                    physical_folder_name = hashlib.sha1(logical_folder_name.encode()).hexdigest() + "_folder"
-                    
-                    db_manager.add_metadata(authenticated_user, parent_path_logical, logical_folder_name, physical_folder_name, 'folder')
-                    
-                    secure_conn.send("OK".encode('utf-8'))
-                    
-                    bytes_received = 0
-                    zip_content = io.BytesIO()
-                    
+
+                    await stream.run_blocking(create_zip_root_folder, authenticated_user, encrypted_folder_path)
+
+                    await stream.send("OK".encode('utf-8'))
+
+                    zip_path = None
                     try:
-                        while bytes_received < filesize:
-                            chunk = secure_conn.recv(min(filesize - bytes_received, BUFFER_SIZE))
-                            if not chunk: 
-                                break
-                            zip_content.write(chunk)
-                            bytes_received += len(chunk)
-                        
+                        zip_path, bytes_received = await receive_to_temp_file(stream, filesize, '.zip')
+
                         if bytes_received < filesize:
-                            secure_conn.send("ERRO|Upload do .zip incompleto.".encode('utf-8'))
+                            await stream.send("ERRO|Upload do .zip incompleto.".encode('utf-8'))
                             continue
-                        
-                        zip_content.seek(0)
-                        
-                        with zipfile.ZipFile(zip_content, 'r') as zf:
-                            for item_info in zf.infolist():
-                                archive_path = item_info.filename.replace('\\', '/').rstrip('/')
-                                if not archive_path:
-                                    continue
-                                
-                                if item_info.is_dir():
-                                    full_logical_path = os.path.join(encrypted_folder_path, archive_path).replace('\\', '/')
-                                    parent_logical = os.path.dirname(full_logical_path)
-                                    folder_logical_name = os.path.basename(full_logical_path)
-                                    physical_name = hashlib.sha1(folder_logical_name.encode()).hexdigest() + "_folder"
-                                    
-                                    db_manager.add_metadata(authenticated_user, parent_logical, folder_logical_name, physical_name, 'folder')
-                                else:
-
-                                    full_logical_path = os.path.join(encrypted_folder_path, archive_path).replace('\\', '/')
-                                    parent_logical = os.path.dirname(full_logical_path)
-                                    file_logical_name = os.path.basename(full_logical_path)
-                                    physical_name = hashlib.sha1(file_logical_name.encode()).hexdigest()
-                                    
-                                    full_physical_path = get_safe_path(user_base_folder, physical_name)
-                                    encrypted_file_content = zf.read(item_info.filename)
-                                    
-                                    with open(full_physical_path, 'wb') as f:
-                                        f.write(encrypted_file_content)
-                                    
-                                    db_manager.add_metadata(authenticated_user, parent_logical, file_logical_name, physical_name, 'file')
-                        
-                        db_manager.log_upload(authenticated_user, bytes_received)
-                        db_manager.update_parent_folders_dates(authenticated_user, encrypted_folder_path)
-                        
-                        secure_conn.send("OK|Upload e extração do .zip concluídos!".encode('utf-8'))
+
+                        await import_uploaded_zip(stream, authenticated_user, user_base_folder, encrypted_folder_path, zip_path, bytes_received)
+
+                        await stream.send("OK|Upload e extração do .zip concluídos!".encode('utf-8'))
                         print(f"[UPLOAD_ZIP] Pasta '{logical_folder_name}' criada e .zip extraído para {authenticated_user}.")
-                        
+
                     except Exception as e:
-                        secure_conn.send(f"ERRO|Falha ao processar .zip: {e}".encode('utf-8'))
+                        await stream.send(f"ERRO|Falha ao processar .zip: {e}".encode('utf-8'))
+
+                    finally:
+                        if zip_path:
+                            await stream.run_blocking(remove_file_if_exists, zip_path)
 
                 else:
-                    secure_conn.send("ERRO|Comando desconhecido.".encode('utf-8'))
+                    await stream.send("ERRO|Comando desconhecido.".encode('utf-8'))
 
             else:
-                secure_conn.send("ERRO|Ação não permitida. Faça a autenticação primeiro.".encode('utf-8'))
+                await stream.send("ERRO|Ação não permitida. Faça a autenticação primeiro.".encode('utf-8'))
 
     except (ssl.SSLEOFError, ConnectionResetError):
         print(f"[CONEXÃO INTERROMPIDA] {addr} desconectou abruptamente.")
@@ -661,33 +2093,618 @@ def handle_client(secure_conn, addr):
         print(f"[ERRO] Erro na conexão com {addr}: {e}")
 
     finally:
+        active_sessions.add(-1)
         print(f"[CONEXÃO FECHADA] {addr}")
+        await stream.close()
+
+
+# --- Protocolo binário ---
+# Cada requisição/resposta é um quadro: FRAME_HEADER seguido de um payload de
+# `length` bytes no formato [META_LENGTH][meta em UTF-8][corpo]. O meta carrega os
+# argumentos separados por '|' (ou a mensagem/JSON da resposta) e o corpo carrega o
+# conteúdo dos arquivos. As respostas repetem o opcode e o id da requisição, então o
+# cliente pode enviar várias requisições sem esperar as respostas (pipelining).
+
+class ProtocolError(Exception):
+    pass
+
+
+Frame = collections.namedtuple('Frame', 'opcode flags request_id meta body_length')
+
+
+async def read_frame(stream):
+    first_byte = await stream.recv(1)
+    if not first_byte:
+        return None
+
+    header = first_byte + await stream.recv_exact(FRAME_HEADER.size - 1)
+    magic, version, opcode, flags, request_id, length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Quadro inválido (versão {version}).")
+
+    meta_length, = META_LENGTH.unpack(await stream.recv_exact(META_LENGTH.size))
+    if meta_length > MAX_META_LENGTH or META_LENGTH.size + meta_length > length:
+        raise ProtocolError("Tamanho de metadados inválido.")
+
+    try:
+        meta = (await stream.recv_exact(meta_length)).decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise ProtocolError("Metadados inválidos.") from e
+    return Frame(opcode, flags, request_id, meta, length - META_LENGTH.size - meta_length)
+
+
+async def send_frame(stream, request, meta='', body=b'', flags=0, body_length=None):
+    # Com body_length informado o corpo é enviado depois pelo chamador, em partes.
+    meta_bytes = meta.encode('utf-8')
+    if body_length is None:
+        body_length = len(body)
+
+    header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, request.opcode, flags, request.request_id,
+                               META_LENGTH.size + len(meta_bytes) + body_length)
+    await stream.send(header + META_LENGTH.pack(len(meta_bytes)) + meta_bytes + body)
+
+
+async def send_error_frame(stream, request, message):
+    await send_frame(stream, request, message, flags=FLAG_ERROR)
+
+
+async def frame_create_folder(stream, frame, login):
+    await stream.run_blocking(create_folder, login, frame.meta)
+    await send_frame(stream, frame, "Pasta criada.")
+
+
+async def frame_list(stream, frame, login):
+    user_base_folder = os.path.join(STORAGE_DIR, login)
+    file_details = await stream.run_blocking(build_file_listing, login, user_base_folder, frame.meta.replace('\\', '/'))
+    await send_frame(stream, frame, json.dumps(file_details))
+
+
+async def frame_list_page(stream, frame, login):
+    # Meta: caminho|ordem (name, size ou date)|decrescente (0/1)|limite|cursor (vazio na primeira página)
+    # Resposta: {"items": [...], "cursor": próximo cursor ou null na última página}
+    try:
+        path, sort_key, descending, limit, cursor = frame.meta.split('|')
+        if sort_key not in LIST_SORT_COLUMNS:
+            raise ValueError(f"Ordem desconhecida: {sort_key}")
+        limit = max(1, min(int(limit), LIST_PAGE_MAX_SIZE))
+        page = await stream.run_blocking(build_file_listing_page, login, path.replace('\\', '/'),
+                                         sort_key, descending == '1', limit, cursor)
+    except ValueError:
+        await send_error_frame(stream, frame, "Parâmetros de listagem inválidos.")
+        return
+    await send_frame(stream, frame, json.dumps(page))
+
+
+async def frame_changes_since(stream, frame, login):
+    # Meta: change_seq da última listagem ou alteração recebida
+    # Resposta: {"seq": change_seq atual, "reset": true/false, "changes": [...]}
+    try:
+        since_seq = int(frame.meta)
+    except ValueError:
+        await send_error_frame(stream, frame, "Número de sequência inválido.")
+        return
+    changes = await stream.run_blocking(build_changes_since, login, since_seq)
+    await send_frame(stream, frame, json.dumps(changes))
+
+
+async def frame_upload(stream, frame, login):
+    # Meta: caminho/criptografado; corpo: conteúdo criptografado do arquivo
+    encrypted_relative_path = frame.meta
+    logical_name = os.path.basename(encrypted_relative_path)
+    physical_name = hashlib.sha1(logical_name.encode()).hexdigest()
+    full_physical_path = await stream.run_blocking(get_safe_path, os.path.join(STORAGE_DIR, login), physical_name, True)
+
+    try:
+        bytes_received = await receive_to_file(stream, full_physical_path, frame.body_length)
+    except OSError as e:
+        print(f"Erro durante o upload para {full_physical_path}: {e}")
+        await stream.run_blocking(remove_file_if_exists, full_physical_path)
+        await send_error_frame(stream, frame, str(e))
+        return
+
+    if bytes_received < frame.body_length:
+        await stream.run_blocking(remove_file_if_exists, full_physical_path)
+        raise ConnectionResetError("Upload incompleto.")
+
+    await stream.run_blocking(register_uploaded_file, login, encrypted_relative_path, physical_name, bytes_received)
+    await send_frame(stream, frame, "UPLOAD_SUCCESS")
+    print(f"[UPLOAD] Arquivo '{logical_name}' salvo em '{full_physical_path}'.")
+
+
+async def frame_upload_begin(stream, frame, login):
+    # Meta: caminho/criptografado|tamanho_total; resposta: id da sessão de upload
+    await stream.discard(frame.body_length)
+    try:
+        encrypted_relative_path, total_size = frame.meta.split('|')
+        total_size = int(total_size)
+    except ValueError:
+        encrypted_relative_path, total_size = "", -1
+    if not encrypted_relative_path or total_size < 0:
+        await send_error_frame(stream, frame, "Parâmetros de upload inválidos.")
+        return
+
+    upload_id = await stream.run_blocking(begin_upload_session, login, encrypted_relative_path, total_size)
+    await send_frame(stream, frame, upload_id)
+
+
+async def frame_upload_status(stream, frame, login):
+    # Meta: id da sessão; resposta: offset_já_gravado|tamanho_total
+    offset, total_size, error = await stream.run_blocking(get_upload_status, login, frame.meta)
+    if error:
+        await send_error_frame(stream, frame, error)
+        return
+    await send_frame(stream, frame, f"{offset}|{total_size}")
+
+
+async def frame_upload_append(stream, frame, login):
+    # Meta: id_da_sessão|offset; corpo: bytes a partir do offset. Resposta: novo offset
+    try:
+        upload_id, offset = frame.meta.split('|')
+        offset = int(offset)
+    except ValueError:
+        await stream.discard(frame.body_length)
+        await send_error_frame(stream, frame, "Parâmetros de upload inválidos.")
+        return
+    if not acquire_upload_session(upload_id):
+        await stream.discard(frame.body_length)
+        await send_error_frame(stream, frame, "Sessão de upload em uso por outra conexão.")
+        return
+
+    # O offset só é conferido com a sessão reservada: uma conexão antiga que ainda esteja
+    # gravando não pode mudar o tamanho do arquivo entre a conferência e a escrita.
+    try:
+        current_offset, total_size, error = await stream.run_blocking(get_upload_status, login, upload_id)
+        if not error and offset != current_offset:
+            error = f"Offset inválido: o servidor já tem {current_offset} bytes."
+        if not error and current_offset + frame.body_length > total_size:
+            error = "Os dados excedem o tamanho declarado do upload."
+        if error:
+            await stream.discard(frame.body_length)
+            await send_error_frame(stream, frame, error)
+            return
+
+        bytes_received = await receive_to_file(stream, staging_path(upload_id), frame.body_length, 'ab')
+        await stream.run_blocking(db_manager.touch_upload_session, upload_id)
+    except OSError as e:
+        if isinstance(e, ConnectionError):
+            raise
+        await send_error_frame(stream, frame, str(e))
+        return
+    finally:
+        release_upload_session(upload_id)
+
+    if bytes_received < frame.body_length:
+        raise ConnectionResetError("Upload interrompido; os dados recebidos ficam na sessão.")
+    await send_frame(stream, frame, str(current_offset + bytes_received))
+
+
+async def frame_upload_commit(stream, frame, login):
+    # Meta: id[,id2,...][|sha256[,sha256_2,...]]; várias sessões são as partes de um upload
+    # paralelo, em ordem, e cada SHA-256 confere a parte correspondente.
+    upload_ids, _, expected_digests = frame.meta.partition('|')
+    error = await stream.run_blocking(commit_upload_session, login, upload_ids.split(','),
+                                      expected_digests.split(',') if expected_digests else None)
+    if error:
+        await send_error_frame(stream, frame, error)
+        return
+    await send_frame(stream, frame, "UPLOAD_SUCCESS")
+
+
+async def frame_transfer_streams(stream, frame, login):
+    # Meta: número de conexões desejado; resposta: quantas o cliente pode abrir agora.
+    try:
+        requested = int(frame.meta)
+    except ValueError:
+        requested = 1
+    await send_frame(stream, frame, str(granted_transfer_streams(requested)))
+
+
+async def frame_download(stream, frame, login):
+    user_base_folder = os.path.join(STORAGE_DIR, login)
+    full_physical_path, error = await stream.run_blocking(find_file_for_download, login, user_base_folder, frame.meta)
+    if error:
+        await send_error_frame(stream, frame, error)
+        return
+
+    filesize = await stream.run_blocking(os.path.getsize, full_physical_path)
+    await send_frame(stream, frame, body_length=filesize)
+    await send_file_body(stream, full_physical_path, filesize)
+
+    await stream.run_blocking(activity_logger.record, login, 'DOWNLOAD', filesize)
+    print(f"[DOWNLOAD] Arquivo em '{frame.meta}' enviado para '{login}'.")
+
+
+async def frame_download_range(stream, frame, login):
+    # Meta: caminho/criptografado|offset[|tamanho]; sem tamanho, vai até o fim do arquivo.
+    # Resposta: tamanho_total|mtime e, no corpo, só os bytes do intervalo pedido.
+    parts = frame.meta.split('|')
+    try:
+        offset = int(parts[1])
+        length = int(parts[2]) if len(parts) > 2 else None
+    except (IndexError, ValueError):
+        offset = length = -1
+    if offset < 0 or (length is not None and length < 0):
+        await send_error_frame(stream, frame, "Intervalo inválido.")
+        return
+
+    user_base_folder = os.path.join(STORAGE_DIR, login)
+    full_physical_path, error = await stream.run_blocking(find_file_for_download, login, user_base_folder, parts[0])
+    if error:
+        await send_error_frame(stream, frame, error)
+        return
+
+    file_stat = await stream.run_blocking(os.stat, full_physical_path)
+    offset = min(offset, file_stat.st_size)
+    count = file_stat.st_size - offset if length is None else min(length, file_stat.st_size - offset)
+    await send_frame(stream, frame, f"{file_stat.st_size}|{file_stat.st_mtime}", body_length=count)
+    await send_file_body(stream, full_physical_path, count, offset)
+
+    await stream.run_blocking(activity_logger.record, login, 'DOWNLOAD', count)
+    print(f"[DOWNLOAD] Bytes {offset}-{offset + count} de '{parts[0]}' enviados para '{login}'.")
+
+
+async def frame_download_folder_as_zip(stream, frame, login):
+    # Resposta em partes: o primeiro quadro (FLAG_MORE) traz o tamanho previsto do ZIP,
+    # os seguintes trazem os blocos e o último, sem FLAG_MORE, traz o tamanho final.
+    user_base_folder = os.path.join(STORAGE_DIR, login)
+    relative_path = frame.meta
+
+    entries, error = await stream.run_blocking(collect_folder_zip_entries, login, user_base_folder, relative_path)
+    if error:
+        await send_error_frame(stream, frame, error)
+        return
+
+    await send_frame(stream, frame, str(estimate_stored_zip_size(entries)), flags=FLAG_MORE)
+
+    zip_size = 0
+    async def send_chunk(chunk):
+        nonlocal zip_size
+        if chunk:
+            zip_size += len(chunk)
+            await send_frame(stream, frame, body=chunk, flags=FLAG_MORE)
+
+    try:
+        await stream_folder_zip(stream, entries, send_chunk)
+    except (OSError, zipfile.LargeZipFile) as e:
+        if isinstance(e, ConnectionError):
+            raise
+        print(f"ERRO ao criar ZIP da pasta {relative_path}: {e}")
+        await send_error_frame(stream, frame, f"Falha ao criar arquivo ZIP: {e}")
+        return
+
+    await send_frame(stream, frame, str(zip_size))
+
+    total_size = sum(size for _, _, size in entries)
+    await stream.run_blocking(activity_logger.record, login, 'DOWNLOAD', total_size)
+    print(f"[ZIP] Pasta '{relative_path}' compactada e enviada para '{login}'. Tamanho: {zip_size} bytes.")
+
+
+async def frame_upload_zip_as_folder(stream, frame, login):
+    # Meta: caminho_pasta_raiz_criptografado; corpo: o .zip com o conteúdo criptografado
+    user_base_folder = os.path.join(STORAGE_DIR, login)
+    encrypted_folder_path = frame.meta
+    logical_folder_name = os.path.basename(encrypted_folder_path)
+
+    await stream.run_blocking(create_zip_root_folder, login, encrypted_folder_path)
+
+    try:
+        zip_path, bytes_received = await receive_to_temp_file(stream, frame.body_length, '.zip')
+    except OSError as e:
+        await send_error_frame(stream, frame, f"Falha ao receber .zip: {e}")
+        return
+
+    # Enquanto extrai, o servidor envia quadros FLAG_MORE com "bytes_extraídos|bytes_totais".
+    async def report_progress(extracted_bytes, total_bytes):
+        await send_frame(stream, frame, f"{extracted_bytes}|{total_bytes}", flags=FLAG_MORE)
+
+    try:
+        if bytes_received < frame.body_length:
+            raise ConnectionResetError("Upload do .zip incompleto.")
+
+        await import_uploaded_zip(stream, login, user_base_folder, encrypted_folder_path, zip_path, bytes_received, report_progress)
+    except (ConnectionError, ssl.SSLError):
+        raise
+    except Exception as e:
+        await send_error_frame(stream, frame, f"Falha ao processar .zip: {e}")
+        return
+    finally:
+        await stream.run_blocking(remove_file_if_exists, zip_path)
+
+    await send_frame(stream, frame, "Upload e extração do .zip concluídos!")
+    print(f"[UPLOAD_ZIP] Pasta '{logical_folder_name}' criada e .zip extraído para {login}.")
+
+
+async def frame_delete(stream, frame, login):
+    user_base_folder = os.path.join(STORAGE_DIR, login)
+    try:
+        if not await stream.run_blocking(delete_item, login, user_base_folder, frame.meta):
+            await send_error_frame(stream, frame, "Item não encontrado.")
+            return
+    except Exception as e:
+        print(f"ERRO ao deletar itens físicos: {e}")
+        await send_error_frame(stream, frame, "Falha ao deletar o item no servidor.")
+        return
+
+    await send_frame(stream, frame, "Item(s) deletado(s) com sucesso.")
+
+
+async def frame_get_stats(stream, frame, login):
+    stats = await stream.run_blocking(load_user_stats, login)
+    if not stats:
+        await send_error_frame(stream, frame, "Não foi possível obter estatísticas.")
+        return
+
+    await send_frame(stream, frame, f"{stats[0]}|{stats[1]}|{stats[2]}|{stats[3]}")
+
+
+FRAME_HANDLERS = {
+    "CREATE_FOLDER": frame_create_folder,
+    "LIST": frame_list,
+    "LIST_PAGE": frame_list_page,
+    "CHANGES_SINCE": frame_changes_since,
+    "UPLOAD": frame_upload,
+    "UPLOAD_BEGIN": frame_upload_begin,
+    "UPLOAD_STATUS": frame_upload_status,
+    "UPLOAD_APPEND": frame_upload_append,
+    "UPLOAD_COMMIT": frame_upload_commit,
+    "DOWNLOAD": frame_download,
+    "DOWNLOAD_RANGE": frame_download_range,
+    "TRANSFER_STREAMS": frame_transfer_streams,
+    "DOWNLOAD_FOLDER_AS_ZIP": frame_download_folder_as_zip,
+    "UPLOAD_ZIP_AS_FOLDER": frame_upload_zip_as_folder,
+    "DELETE": frame_delete,
+    "GET_STATS": frame_get_stats,
+}
+
+
+async def binary_session(stream, addr):
+    authenticated_user = None
+    while True:
+        frame = await read_frame(stream)
+        if frame is None:
+            break
+
+        command = OPCODES.get(frame.opcode)
+
+        if command == "AUTH" or command == "REGISTER":
+            await stream.discard(frame.body_length)
+            login, separator, password = frame.meta.partition('|')
+
+            if not separator or not login:
+                await send_error_frame(stream, frame, "Credenciais inválidas.")
+
+            elif command == "AUTH":
+                salt_hex, error = await authenticate_user(stream, login, password)
+                if error:
+                    await send_error_frame(stream, frame, error)
+                else:
+                    authenticated_user = login
+                    await send_frame(stream, frame, f"{salt_hex}|{issue_session_token(login)}")
+                    print(f"[AUTH] Usuário '{authenticated_user}' autenticado de {addr}.")
+
+            elif await register_user(stream, login, password):
+                await send_frame(stream, frame, "Registrado com sucesso!")
+            else:
+                await send_error_frame(stream, frame, "Usuário já existe.")
+
+        elif command == "RESUME":
+            # Nova conexão de uma sessão já autenticada: confere a assinatura do token e se a
+            # conta ainda existe, e devolve um token renovado, com a mesma emissão.
+            await stream.discard(frame.body_length)
+            session = verify_session_token(frame.meta)
+            if session is not None and await stream.run_blocking(db_manager.get_password_record, session[0]) is None:
+                session = None
+            if session is None:
+                await send_error_frame(stream, frame, "Sessão expirada. Faça login novamente.")
+            else:
+                authenticated_user, issued = session
+                await send_frame(stream, frame, issue_session_token(authenticated_user, issued))
+
+        elif not authenticated_user:
+            await stream.discard(frame.body_length)
+            await send_error_frame(stream, frame, "Ação não permitida. Faça a autenticação primeiro.")
+
+        elif command in FRAME_HANDLERS:
+            # Só os handlers de upload leem o corpo; o que sobrar é descartado aqui para que o
+            # próximo quadro comece no lugar certo.
+            body_start = stream.bytes_read
+            await FRAME_HANDLERS[command](stream, frame, authenticated_user)
+            await stream.discard(frame.body_length - (stream.bytes_read - body_start))
+
+        else:
+            await stream.discard(frame.body_length)
+            await send_error_frame(stream, frame, "Comando desconhecido.")
+
+
+def handle_client(secure_conn, addr):
+    # Modo com threads: a mesma sessão roda em um laço de eventos próprio da thread,
+    # mas todas as operações do SocketStream são bloqueantes.
+    asyncio.run(client_session(SocketStream(secure_conn), addr))
+
+
+def busy_message():
+    return f"BUSY|{BUSY_RETRY_MS}".encode('utf-8')
+
+
+def reject_busy(context, conn, addr):
+    # Completa o handshake, responde BUSY|ms e consome o primeiro comando do cliente
+    # antes de fechar, para que a resposta não se perca com um RST.
+    try:
+        conn.settimeout(BUSY_HANDSHAKE_TIMEOUT)
+        secure_conn = context.wrap_socket(conn, server_side=True)
+        secure_conn.settimeout(BUSY_REPLY_TIMEOUT)
+        secure_conn.sendall(busy_message())
+        secure_conn.recv(BUFFER_SIZE)
         secure_conn.close()
+    except (ssl.SSLError, OSError):
+        conn.close()
+    print(f"[OCUPADO] Conexão de {addr} recusada. Nova tentativa sugerida em {BUSY_RETRY_MS} ms.")
+
+
+class PendingConnections:
+    def __init__(self, max_pending):
+        self.items = collections.deque()
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+
+    def put(self, conn, addr):
+        with self.condition:
+            if len(self.items) >= self.max_pending:
+                return False
+            self.items.append((conn, addr, time.monotonic()))
+            self.condition.notify()
+            return True
+
+    def get(self):
+        with self.condition:
+            while not self.items:
+                self.condition.wait()
+            conn, addr, _ = self.items.popleft()
+            return conn, addr
+
+    def pop_expired(self, max_wait):
+        expired = []
+        now = time.monotonic()
+        with self.condition:
+            while self.items and now - self.items[0][2] > max_wait:
+                conn, addr, _ = self.items.popleft()
+                expired.append((conn, addr))
+        return expired
+
+
+def session_worker(context, pending_connections):
+    while True:
+        conn, addr = pending_connections.get()
+
+        try:
+            conn.settimeout(SSL_HANDSHAKE_TIMEOUT)
+            secure_conn = context.wrap_socket(conn, server_side=True)
+            secure_conn.settimeout(None)
+        except (ssl.SSLError, OSError) as e:
+            print(f"[AVISO SSL] Uma conexão de {addr} falhou no handshake: {e}")
+            conn.close()
+            continue
+
+        handle_client(secure_conn, addr)
+
+
+def busy_worker(context, busy_connections):
+    while True:
+        conn, addr = busy_connections.get()
+        reject_busy(context, conn, addr)
+
+
+def pending_sweeper(pending_connections, busy_connections):
+    # Manda para a recusa as conexões que esperaram mais que MAX_PENDING_WAIT na fila.
+    while True:
+        time.sleep(BUSY_SWEEP_INTERVAL)
+        for conn, addr in pending_connections.pop_expired(MAX_PENDING_WAIT):
+            try:
+                busy_connections.put_nowait((conn, addr))
+            except queue.Full:
+                conn.close()
+
+
+class SessionLimiter:
+    def __init__(self, max_sessions, max_pending):
+        self.slots = asyncio.Semaphore(max_sessions)
+        self.max_pending = max_pending
+        self.pending = 0
+
+    def is_full(self):
+        return self.slots.locked() and self.pending >= self.max_pending
+
+
+async def reject_busy_async(stream, addr):
+    try:
+        await stream.send(busy_message())
+        await asyncio.wait_for(stream.recv(BUFFER_SIZE), BUSY_REPLY_TIMEOUT)
+    except (asyncio.TimeoutError, ssl.SSLError, ConnectionError):
+        pass
+    finally:
+        await stream.close()
+    print(f"[OCUPADO] Conexão de {addr} recusada. Nova tentativa sugerida em {BUSY_RETRY_MS} ms.")
+
+
+async def handle_client_async(reader, writer, limiter):
+    addr = writer.get_extra_info('peername')
+    stream = AsyncioStream(reader, writer)
+
+    if limiter.is_full():
+        await reject_busy_async(stream, addr)
+        return
+
+    limiter.pending += 1
+    try:
+        await asyncio.wait_for(limiter.slots.acquire(), MAX_PENDING_WAIT)
+    except asyncio.TimeoutError:
+        await reject_busy_async(stream, addr)
+        return
+    finally:
+        limiter.pending -= 1
+
+    try:
+        await client_session(stream, addr)
+    finally:
+        limiter.slots.release()
 
 
 def main():
+    global session_capacity
+    session_capacity = MAX_SESSIONS
     setup_storage()
 
-    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    context.load_cert_chain(certfile="cert.pem", keyfile="key.pem")
+    context = create_server_context()
+
+    # Conexões aceitas esperam em uma fila limitada até que um dos MAX_SESSIONS
+    # workers fique livre; quando a fila enche o cliente recebe BUSY|ms.
+    pending_connections = PendingConnections(MAX_PENDING_CONNECTIONS)
+    busy_connections = queue.Queue(maxsize=MAX_PENDING_CONNECTIONS)
+
+    for _ in range(MAX_SESSIONS):
+        threading.Thread(target=session_worker, args=(context, pending_connections), daemon=True).start()
+    for _ in range(BUSY_WORKERS):
+        threading.Thread(target=busy_worker, args=(context, busy_connections), daemon=True).start()
+    threading.Thread(target=pending_sweeper, args=(pending_connections, busy_connections), daemon=True).start()
 
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.bind((HOST, PORT))
-    server.listen(5)
-    print(f"[ESCUTANDO] Servidor seguro está escutando em {HOST}:{PORT}")
+    server.listen(LISTEN_BACKLOG)
+    print(f"[ESCUTANDO] Servidor seguro está escutando em {HOST}:{PORT} ({MAX_SESSIONS} sessões simultâneas)")
 
     while True:
         try:
             conn, addr = server.accept()
-            secure_conn = context.wrap_socket(conn, server_side=True)
-            thread = threading.Thread(target=handle_client, args=(secure_conn, addr))
-            thread.start()
-        except ssl.SSLError as e:
-            print(f"[AVISO SSL] Uma conexão de {addr if 'addr' in locals() else 'endereço desconhecido'} falhou no handshake: {e}")
-        
+            if not pending_connections.put(conn, addr):
+                try:
+                    busy_connections.put_nowait((conn, addr))
+                except queue.Full:
+                    conn.close()
+
         except Exception as e:
             print(f"[ERRO CRÍTICO NO LOOP PRINCIPAL] {e}")
 
 
+async def main_async():
+    global session_capacity
+    session_capacity = ASYNC_MAX_SESSIONS
+    setup_storage()
+
+    context = create_server_context()
+    limiter = SessionLimiter(ASYNC_MAX_SESSIONS, MAX_PENDING_CONNECTIONS)
+
+    server = await asyncio.start_server(functools.partial(handle_client_async, limiter=limiter), HOST, PORT,
+                                        ssl=context, backlog=LISTEN_BACKLOG,
+                                        ssl_handshake_timeout=SSL_HANDSHAKE_TIMEOUT)
+    print(f"[ESCUTANDO] Servidor seguro (asyncio) está escutando em {HOST}:{PORT} ({ASYNC_MAX_SESSIONS} sessões simultâneas)")
+
+    async with server:
+        await server.serve_forever()
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    start_background_threads()
+    if "--async" in sys.argv:
+        asyncio.run(main_async())
+    else:
+        main()